@@ -0,0 +1,84 @@
+"""
+Measures the throughput of creating blocks, referencing their attributes
+(including repeated references to the same block), and serializing them into the format used by Terraform JSON files.
+Also compares creating many similar blocks individually with bulk_block().
+
+Usage: python benchmarks/bench_blocks.py
+
+"""
+
+import json
+import time
+from typing import Any, Callable
+
+from pretf.api import bulk_block, labels
+from pretf.blocks import resource
+from pretf.render import json_default, unwrap_yielded
+
+BLOCKS = 100000
+
+
+def create_blocks() -> list:
+    blocks = []
+    for index in range(BLOCKS):
+        bucket = resource.aws_s3_bucket[f"bucket{index}"](bucket=f"bucket{index}")
+        blocks.append(bucket)
+    return blocks
+
+
+def reference_attributes(blocks: list) -> list:
+    return [str(bucket.arn) for bucket in blocks]
+
+
+def reference_repeated(blocks: list) -> list:
+    return [str(resource.aws_s3_bucket.shared.arn) for bucket in blocks]
+
+
+def serialize_blocks(blocks: list) -> list:
+    return [serialized for bucket in blocks for serialized in unwrap_yielded(bucket)]
+
+
+def dump_json(blocks: list) -> str:
+    return json.dumps(serialize_blocks(blocks), indent=2, default=json_default)
+
+
+def create_objects() -> list:
+    blocks = []
+    for index in range(BLOCKS):
+        key = f"files/{index}.txt"
+        label = labels.clean(key)
+        blocks.append(resource.aws_s3_bucket_object[label](bucket="x", key=key))
+    return serialize_blocks(blocks)
+
+
+def create_objects_bulk() -> list:
+    keys = (f"files/{index}.txt" for index in range(BLOCKS))
+    objects = bulk_block(
+        "resource",
+        "aws_s3_bucket_object",
+        items=keys,
+        body=lambda key: {"bucket": "x", "key": key},
+    )
+    return serialize_blocks([objects])
+
+
+def measure(func: Callable, *args: Any) -> Any:
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{func.__name__}: {BLOCKS / elapsed:,.0f} blocks/s ({elapsed:.3f}s)")
+    return result
+
+
+def main() -> None:
+    blocks = measure(create_blocks)
+    measure(reference_attributes, blocks)
+    measure(reference_repeated, blocks)
+    measure(serialize_blocks, blocks)
+    measure(dump_json, blocks)
+    measure(create_objects)
+    measure(create_objects_bulk)
+
+
+if __name__ == "__main__":
+    main()
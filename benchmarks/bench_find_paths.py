@@ -0,0 +1,76 @@
+"""
+Compares util.find_paths() with globbing once per pattern,
+using a synthetic directory tree with 100k entries. The glob results
+are filtered to also skip paths inside excluded directories, like
+find_paths() does, and both must return the same paths.
+
+Usage: python benchmarks/bench_find_paths.py
+
+"""
+
+import tempfile
+import time
+from fnmatch import fnmatch
+from pathlib import Path
+
+from pretf import util
+
+PATH_PATTERNS = ["**/*.tf", "**/*.tf.py", "**/*.tfvars"]
+EXCLUDE_NAME_PATTERNS = [".*", "_*"]
+
+
+def create_tree(root: Path, entries: int = 100000) -> None:
+    count = 0
+    module = 0
+    while count < entries:
+        module_dir = root / f"module{module}"
+        for subdir in ("", "_vendor", ".terraform"):
+            dir_path = module_dir / subdir
+            dir_path.mkdir(parents=True, exist_ok=True)
+            count += 1
+            for index in range(30):
+                suffix = (".tf", ".tf.py", ".tfvars", ".json", ".md")[index % 5]
+                (dir_path / f"file{index}{suffix}").touch()
+                count += 1
+        module += 1
+
+
+def glob_per_pattern(cwd: Path) -> list:
+    results = []
+    for pattern in PATH_PATTERNS:
+        for path in cwd.glob(pattern):
+            for name in path.relative_to(cwd).parts:
+                if any(fnmatch(name, p) for p in EXCLUDE_NAME_PATTERNS):
+                    break
+            else:
+                results.append(path)
+    return results
+
+
+def find_paths(cwd: Path) -> list:
+    util.directory_index.clear()
+    return list(
+        util.find_paths(
+            path_patterns=PATH_PATTERNS,
+            exclude_name_patterns=EXCLUDE_NAME_PATTERNS,
+            cwd=cwd,
+        )
+    )
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        create_tree(root)
+        results = []
+        for func in (glob_per_pattern, find_paths):
+            start = time.perf_counter()
+            paths = func(root)
+            elapsed = time.perf_counter() - start
+            print(f"{func.__name__}: {len(paths)} paths in {elapsed:.3f}s")
+            results.append(sorted(paths))
+        assert results[0] == results[1], "find_paths() returned different paths"
+
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,9 @@ def pretf_workflow(path):
     workflow.require_files("*.*.auto.tfvars")
 
     # Flatten the directory structure into the working directory.
-    workflow.delete_links()
-    created = workflow.link_files("*.tf", "*.tf.py", "*.tfvars.py", "modules")
+    # Only missing or stale symlinks are changed on each run.
+    workflow.sync_links("*.tf", "*.tf.py", "*.tfvars.py", "modules")
 
     # Now run the standard Pretf workflow which generates files
-    # and then executes Terraform. Pass in the mirrored files
-    # so they can be cleaned up.
-    return workflow.default(created=created)
+    # and then executes Terraform.
+    return workflow.default()
@@ -1,71 +1,193 @@
+import atexit
+import hashlib
 import json
 import os
-from functools import lru_cache, wraps
-from threading import RLock
-from time import sleep
-from typing import Any, Callable, Optional
-
-from boto3 import Session
+import shlex
+import shutil
+import socket
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import wraps
+from getpass import getpass
+from importlib.util import find_spec
+from threading import Lock, RLock, Thread
+from time import monotonic, sleep, time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+from weakref import WeakKeyDictionary
 
 from pretf.api import block, log
 from pretf.blocks import Block
+from pretf.util import (
+    SingleFlight,
+    read_json_file,
+    register_run_cache,
+    write_json_file,
+)
 
-try:
-    import boto_source_profile_mfa
+if TYPE_CHECKING:
+    from boto3 import Session
 
-    use_boto_source_profile_mfa = True
-except ImportError:
-    use_boto_source_profile_mfa = False
+# Importing boto3 is slow, so it is only imported when it is used.
+use_boto_source_profile_mfa = find_spec("boto_source_profile_mfa") is not None
 
 
-# Use this lock on anything that might trigger an MFA prompt,
-# because otherwise it is possible for multiple threads to
-# prompt the user at the same time, resulting in confusing
-# and broken prompts for the user. This is a flaw in boto3.
+# Use this lock when prompting the user, because otherwise it is
+# possible for multiple threads to prompt the user at the same time,
+# resulting in confusing and broken prompts for the user. MFA prompts
+# from boto3 and boto-source-profile-mfa use this lock too.
 lock = RLock()
 
+# Credentials for different profiles are resolved concurrently, but
+# each profile is resolved by one thread at a time, using these locks.
+# Credentials are resolved before making any other API calls, so those
+# calls can run without holding the lock. Profiles using MFA share the
+# lock of their source profile, so that after one of them prompts for
+# an MFA token, the others can reuse the MFA session without prompting.
+# Sessions are held weakly, so that these do not keep them alive.
+_credential_locks: Dict[Any, RLock] = {}
+_credential_locks_lock = Lock()
+_session_credential_locks: "WeakKeyDictionary[Session, RLock]" = WeakKeyDictionary()
+_session_lock_keys: "WeakKeyDictionary[Session, Any]" = WeakKeyDictionary()
+_sessions_lock = Lock()
+register_run_cache(_credential_locks.clear)
+
+# Sessions are created once per set of arguments and AWS environment.
+# Threads asking for the same session at the same time share it, so that
+# they also share its credentials and only prompt for an MFA token once.
+# They are kept between runs, so that the Pretf daemon can reuse them for
+# commands with the same AWS environment variables and config files.
+_sessions = SingleFlight(cache_results=True, per_run=False)
+
+# Environment variables that affect sessions and clients.
+SESSION_ENVIRONMENT_VARIABLES = (
+    "AWS_ACCESS_KEY_ID",
+    "AWS_CONFIG_FILE",
+    "AWS_DEFAULT_REGION",
+    "AWS_PROFILE",
+    "AWS_REGION",
+    "AWS_SESSION_TOKEN",
+    "AWS_SHARED_CREDENTIALS_FILE",
+    "PRETF_AWS_BROKER_SOCKET",
+)
+
+# Identical API calls made by multiple threads at the same time
+# are only made once, with the threads sharing the result.
+_account_ids = SingleFlight(cache_results=True)
+_assumed_roles = SingleFlight(cache_results=True)
+_backend_creations = SingleFlight()
+_backend_statuses = SingleFlight()
+
+# Cached credentials are refreshed when they have less than
+# this many seconds remaining, matching the advisory refresh
+# period used by botocore.
+CACHE_REFRESH_SECONDS = 15 * 60
+
+# Backends are verified again after this many seconds,
+# unless the PRETF_AWS_BACKEND_TTL environment variable
+# is set to a different number of seconds.
+BACKEND_TTL_SECONDS = 24 * 60 * 60
+
+_backend_marker_lock = Lock()
+
+# Give up waiting for backend resources to be created after this many
+# seconds, polling for stack events with a delay that starts at the
+# minimum and doubles up to the maximum while nothing is happening.
+BACKEND_CREATE_TIMEOUT_SECONDS = 15 * 60
+BACKEND_POLL_MIN_SECONDS = 1
+BACKEND_POLL_MAX_SECONDS = 10
+
+# Clients are expensive to create, so they are reused for as long
+# as their sessions are. Clients without a region use the region from
+# the environment, so the region environment variables are part of the key.
+_clients: "WeakKeyDictionary[Session, Dict[Tuple[Any, ...], Any]]" = WeakKeyDictionary()
+_clients_lock = Lock()
+
+# The credential broker for this process, if it has been started,
+# or a connection to the credential broker of a parent process.
+_broker: Optional["CredentialBroker"] = None
+_broker_lock = Lock()
+
 
 def locked(func: Callable) -> Callable:
+    """
+    Holds the credential lock for the session argument
+    while calling the decorated function.
+
+    """
+
     @wraps(func)
-    def wrapped(*args: Any, **kwargs: Any) -> Any:
-        with lock:
-            return func(*args, **kwargs)
+    def wrapped(session: "Session", *args: Any, **kwargs: Any) -> Any:
+        with _get_credential_lock(session):
+            return func(session, *args, **kwargs)
 
     return wrapped
 
 
-@locked
-def _assume_role(session: Session, **kwargs: str) -> Session:
+def _assume_role(session: "Session", **kwargs: str) -> "Session":
 
     for key, value in list(kwargs.items()):
         if not value:
             del kwargs[key]
 
-    sts_client = session.client("sts")
+    _resolve_credentials(session)
+
+    role_key = (session, tuple(sorted(kwargs.items())))
+    return _assumed_roles.do(role_key, _load_assumed_role, session, **kwargs)
+
+
+def _load_assumed_role(session: "Session", **kwargs: str) -> "Session":
+
+    cache_path = None
+    if _cache_enabled():
+        source_creds = get_frozen_credentials(session)
+        cache_path = _get_cache_path("assume-role", source_creds.access_key, kwargs)
+        cached = _read_cached_credentials(cache_path)
+        if cached:
+            return _create_session(**cached["session"])
+
+    sts_client = _get_client(session, "sts")
     response = sts_client.assume_role(**kwargs)
     creds = response["Credentials"]
 
-    return Session(
-        aws_access_key_id=creds["AccessKeyId"],
-        aws_secret_access_key=creds["SecretAccessKey"],
-        aws_session_token=creds["SessionToken"],
-    )
+    session_kwargs = {
+        "aws_access_key_id": creds["AccessKeyId"],
+        "aws_secret_access_key": creds["SecretAccessKey"],
+        "aws_session_token": creds["SessionToken"],
+    }
+
+    if cache_path:
+        _write_cached_credentials(
+            cache_path, session_kwargs, creds["Expiration"].timestamp()
+        )
+
+    return _create_session(**session_kwargs)
 
 
-@locked
 def _create_s3_backend(
-    session: Session, bucket: str, table: str, region_name: str
+    session: "Session", bucket: str, table: str, region_name: str
+) -> None:
+    key = (session, bucket, table, region_name)
+    _backend_creations.do(
+        key, _create_s3_backend_uncached, session, bucket, table, region_name
+    )
+
+
+def _create_s3_backend_uncached(
+    session: "Session", bucket: str, table: str, region_name: str
 ) -> None:
 
     # Prompt before creating anything.
     account_id = get_account_id(session)
     bucket_arn = _get_s3_bucket_arn(region_name, account_id, bucket)
     table_arn = _get_dynamodb_table_arn(region_name, account_id, table)
-    log.ok(f"backend: {bucket_arn}")
-    log.ok(f"backend: {table_arn}")
-    if not log.accept("backend: create backend resources"):
-        log.bad("backend: not created")
-        raise SystemExit(1)
+    with lock:
+        log.ok(f"backend: {bucket_arn}")
+        log.ok(f"backend: {table_arn}")
+        if not log.accept("backend: create backend resources"):
+            log.bad("backend: not created")
+            raise SystemExit(1)
 
     # Use the S3 bucket and DynamoDB table name for the CloudFormation stack.
     if bucket == table:
@@ -76,7 +198,7 @@ def _create_s3_backend(
     log.ok(f"backend: creating {stack_arn}")
 
     # Create the stack.
-    cloudformation_client = session.client("cloudformation", region_name=region_name)
+    cloudformation_client = _get_client(session, "cloudformation", region_name)
     cloudformation_client.create_stack(
         StackName=stack_name,
         ResourceTypes=["AWS::DynamoDB::Table", "AWS::S3::Bucket"],
@@ -111,18 +233,155 @@ def _create_s3_backend(
 
     # Wait for it to complete.
     log.ok("backend: please wait...")
+    _wait_for_stack(cloudformation_client, stack_name)
+
+
+def _get_new_stack_events(
+    cloudformation_client: Any, stack_name: str, seen: set
+) -> list:
+    """
+    Returns stack events that have not been seen before, oldest first.
+
+    """
+
+    events: List[dict] = []
+    kwargs = {"StackName": stack_name}
     while True:
-        sleep(10)
-        response = cloudformation_client.describe_stacks(StackName=stack_name)
-        for stack in response["Stacks"]:
-            if stack["StackStatus"] == "CREATE_IN_PROGRESS":
-                pass
-            elif stack["StackStatus"] == "CREATE_COMPLETE":
-                log.ok("backend: create complete")
-                return
+        response = cloudformation_client.describe_stack_events(**kwargs)
+        for event in response["StackEvents"]:
+            if event["EventId"] in seen:
+                return list(reversed(events))
+            seen.add(event["EventId"])
+            events.append(event)
+        if not response.get("NextToken"):
+            return list(reversed(events))
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def _wait_for_stack(cloudformation_client: Any, stack_name: str) -> None:
+    """
+    Waits for a stack to be created, displaying stack events as they happen.
+
+    """
+
+    deadline = monotonic() + BACKEND_CREATE_TIMEOUT_SECONDS
+    delay = BACKEND_POLL_MIN_SECONDS
+    seen: set = set()
+
+    while True:
+
+        events = _get_new_stack_events(cloudformation_client, stack_name, seen)
+
+        for event in events:
+            status = event["ResourceStatus"]
+            message = f"backend: {stack_name}: {event['LogicalResourceId']} {status}"
+            if event.get("ResourceStatusReason"):
+                message += f" ({event['ResourceStatusReason']})"
+            failed = "ROLLBACK" in status or status.endswith("_FAILED")
+            if failed:
+                log.bad(message)
             else:
-                log.bad(f"backend: {stack['StackStatus']}")
-                log.bad(f"backend: {stack['StackStatusReason']}")
+                log.ok(message)
+
+            # Events for the stack itself show the stack status.
+            if event["ResourceType"] == "AWS::CloudFormation::Stack":
+                if status == "CREATE_COMPLETE":
+                    log.ok("backend: create complete")
+                    return
+                elif failed:
+                    log.bad(f"backend: {stack_name}: create failed")
+                    raise SystemExit(1)
+
+        if monotonic() > deadline:
+            log.bad(f"backend: {stack_name}: timed out waiting for create")
+            raise SystemExit(1)
+
+        # Check again soon after something happens,
+        # and back off while nothing is happening.
+        if events:
+            delay = BACKEND_POLL_MIN_SECONDS
+        else:
+            delay = min(delay * 2, BACKEND_POLL_MAX_SECONDS)
+        sleep(delay)
+
+
+def _cache_enabled() -> bool:
+    return os.environ.get("PRETF_AWS_CACHE") == "1"
+
+
+def _create_profile_session(**kwargs: Any) -> "Session":
+    if use_boto_source_profile_mfa:
+        import boto_source_profile_mfa
+
+        session = boto_source_profile_mfa.get_session(mfa_prompter=_prompt, **kwargs)
+    else:
+        session = _create_session(**kwargs)
+
+    # Make boto3 use the prompt lock when prompting for MFA tokens
+    # for profiles that assume roles.
+    credential_resolver = session._session.get_component("credential_provider")
+    assume_role_provider = credential_resolver.get_provider("assume-role")
+    assume_role_provider._prompter = _prompt
+
+    return session
+
+
+def _create_session(**kwargs: Any) -> "Session":
+    from boto3 import Session
+
+    return Session(**kwargs)
+
+
+def _get_client(
+    session: "Session", service_name: str, region_name: Optional[str] = None
+) -> Any:
+    """
+    Returns a client for the session, reusing clients that have already
+    been created. Creating clients is not thread-safe, so they are created
+    one at a time, but the clients themselves can be shared by threads.
+
+    """
+
+    key = (
+        service_name,
+        region_name,
+        os.environ.get("AWS_REGION"),
+        os.environ.get("AWS_DEFAULT_REGION"),
+    )
+    with _clients_lock:
+        clients = _clients.setdefault(session, {})
+        client = clients.get(key)
+        if client is None:
+            client = session.client(service_name, region_name=region_name)
+            clients[key] = client
+    return client
+
+
+def _get_cache_path(kind: str, *key: Any) -> str:
+    cache_dir = os.environ.get("PRETF_AWS_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "pretf", "aws"
+    )
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_dir, f"{kind}-{digest}.json")
+
+
+def _load_account_id(session: "Session") -> str:
+
+    cache_path = None
+    if _cache_enabled():
+        creds = get_frozen_credentials(session)
+        cache_path = _get_cache_path("account-id", creds.access_key)
+        cached = read_json_file(cache_path)
+        if isinstance(cached, dict) and cached.get("account_id"):
+            return cached["account_id"]
+
+    sts_client = _get_client(session, "sts")
+    account_id = sts_client.get_caller_identity()["Account"]
+
+    if cache_path:
+        _write_cache_file(cache_path, {"account_id": account_id})
+
+    return account_id
 
 
 def _get_cloudformation_stack_arn(
@@ -139,12 +398,49 @@ def _get_s3_bucket_arn(region_name: str, account_id: str, bucket: str) -> str:
     return f"arn:aws:s3:{region_name}:{account_id}:{bucket}"
 
 
-@locked
+def _get_s3_backend_block(
+    bucket: str, dynamodb_table: str, region: str, config: dict
+) -> Block:
+
+    # Return the configuration to use the backend.
+
+    config["bucket"] = bucket
+    config.setdefault("encrypt", True)
+    config["dynamodb_table"] = dynamodb_table
+    config["region"] = region
+
+    return block("terraform", {"backend": {"s3": config}})
+
+
 def _get_s3_backend_status(
-    session: Session, region_name: str, bucket: str, table: str
+    session: "Session", region_name: str, bucket: str, table: str
+) -> dict:
+    _resolve_credentials(session)
+    key = (session, region_name, bucket, table)
+    return _backend_statuses.do(
+        key, _get_s3_backend_status_uncached, session, region_name, bucket, table
+    )
+
+
+def _get_s3_backend_status_uncached(
+    session: "Session", region_name: str, bucket: str, table: str
 ) -> dict:
 
-    s3_client = session.client("s3")
+    # Check the bucket and table at the same time.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        bucket_future = executor.submit(_get_s3_bucket_status, session, bucket)
+        table_future = executor.submit(
+            _get_dynamodb_table_status, session, region_name, table
+        )
+        status = bucket_future.result()
+        status.update(table_future.result())
+
+    return status
+
+
+def _get_s3_bucket_status(session: "Session", bucket: str) -> dict:
+
+    s3_client = _get_client(session, "s3")
 
     try:
         response = s3_client.get_bucket_versioning(Bucket=bucket)
@@ -155,7 +451,17 @@ def _get_s3_backend_status(
         bucket_exists = True
         bucket_versioning_enabled = response["Status"] == "Enabled"
 
-    dynamodb_client = session.client("dynamodb", region_name=region_name)
+    return {
+        "bucket_exists": bucket_exists,
+        "bucket_versioning_enabled": bucket_versioning_enabled,
+    }
+
+
+def _get_dynamodb_table_status(
+    session: "Session", region_name: str, table: str
+) -> dict:
+
+    dynamodb_client = _get_client(session, "dynamodb", region_name)
 
     try:
         dynamodb_client.describe_table(TableName=table)
@@ -164,11 +470,475 @@ def _get_s3_backend_status(
     else:
         table_exists = True
 
+    return {"table_exists": table_exists}
+
+
+def _get_backend_marker_path() -> str:
+    return os.path.join(".terraform", "pretf", "s3-backends.json")
+
+
+def _get_backend_ttl() -> float:
+    env_ttl = os.environ.get("PRETF_AWS_BACKEND_TTL")
+    if env_ttl:
+        return float(env_ttl)
+    return BACKEND_TTL_SECONDS
+
+
+def _get_credentials_source(session_kwargs: dict, session: "Session") -> str:
+    """
+    Returns a description of where the credentials for a session come
+    from, using only local configuration. Secret keys are not included.
+    Profiles include a hash of their configuration, so that changing
+    the account or role of a profile is noticed.
+
+    """
+
+    from botocore.exceptions import ProfileNotFound
+
+    access_key = session_kwargs.get("aws_access_key_id")
+    if access_key:
+        return access_key
+    profile_name = session_kwargs.get("profile_name")
+    if not profile_name:
+        access_key = os.environ.get("AWS_ACCESS_KEY_ID")
+        if access_key:
+            return access_key
+        profile_name = session.profile_name
+
+    try:
+        config = session._session.get_scoped_config()
+    except ProfileNotFound:
+        config = {}
+    digest = hashlib.sha256(
+        json.dumps(config, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    return f"{profile_name}:{digest}"
+
+
+def _is_backend_verified(backend_key: str) -> bool:
+    """
+    Returns True if the backend resources were verified by a recent run,
+    unless verification was requested with PRETF_AWS_VERIFY_BACKEND.
+
+    """
+
+    if os.environ.get("PRETF_AWS_VERIFY_BACKEND") == "1":
+        return False
+
+    markers = read_json_file(_get_backend_marker_path())
+    if not isinstance(markers, dict):
+        return False
+
+    verified = markers.get(backend_key)
+    if not isinstance(verified, (int, float)):
+        return False
+
+    return time() - verified < _get_backend_ttl()
+
+
+def _set_backend_verified(backend_key: str) -> None:
+
+    marker_path = _get_backend_marker_path()
+    ttl = _get_backend_ttl()
+    now = time()
+
+    with _backend_marker_lock:
+
+        markers = read_json_file(marker_path)
+        if not isinstance(markers, dict):
+            markers = {}
+
+        # Drop expired markers so the file does not keep growing.
+        markers = {
+            key: verified
+            for key, verified in markers.items()
+            if isinstance(verified, (int, float)) and now - verified < ttl
+        }
+        markers[backend_key] = now
+
+        try:
+            write_json_file(marker_path, markers)
+        except OSError:
+            pass
+
+
+def _get_credential_lock(session: "Session") -> RLock:
+    with _credential_locks_lock:
+        key = _session_lock_keys.get(session)
+        if key is None:
+            # Sessions without a profile have their own lock.
+            lock = _session_credential_locks.get(session)
+            if lock is None:
+                lock = _session_credential_locks[session] = RLock()
+        else:
+            lock = _credential_locks.get(key)
+            if lock is None:
+                lock = _credential_locks[key] = RLock()
+        return lock
+
+
+def _get_profile_lock_key(session: "Session", profile_name: str) -> Any:
+    from botocore.exceptions import ProfileNotFound
+
+    try:
+        config = session._session.get_scoped_config()
+    except ProfileNotFound:
+        config = {}
+    if config.get("mfa_serial") and config.get("source_profile"):
+        return ("profile", config["source_profile"])
+    return ("profile", profile_name)
+
+
+def _get_session(**kwargs: Any) -> "Session":
+
+    # Processes connected to the credential broker of a parent process
+    # get credentials for profiles from that broker, so that all of the
+    # processes share the same sessions and MFA prompts.
+    profile_name = kwargs.get("profile_name")
+    if _broker and _broker.is_remote and profile_name:
+        if not profile_name.startswith(_get_broker_profile_name("")):
+            broker_profile = _get_broker_profile(profile_name)
+            if broker_profile:
+                return _create_session(**dict(kwargs, profile_name=broker_profile))
+
+    session = _create_profile_session(**kwargs)
+    if kwargs.get("profile_name"):
+        _session_lock_keys[session] = _get_profile_lock_key(
+            session, kwargs["profile_name"]
+        )
+
+    # Only profiles with temporary credentials are cached.
+    # Sessions with explicit credentials are used as they are.
+    if not kwargs.get("profile_name"):
+        return session
+    if set(kwargs) - {"profile_name", "region_name"}:
+        return session
+
+    if not _cache_enabled():
+        return session
+
+    # Include the profile configuration in the cache key,
+    # so that changes to the profile are not ignored.
+    botocore_session = session._session
+    cache_path = _get_cache_path(
+        "profile", kwargs["profile_name"], botocore_session.get_scoped_config()
+    )
+
+    # Put the cache at the front of the credential resolver list,
+    # so it will be checked before the profile's usual providers.
+    credential_resolver = botocore_session.get_component("credential_provider")
+    credential_resolver.providers.insert(
+        0, _CachedCredentialProvider(cache_path, **kwargs)
+    )
+
+    return session
+
+
+@locked
+def _get_credentials(session: "Session") -> Any:
+    return session.get_credentials()
+
+
+@locked
+def _resolve_credentials(session: "Session") -> None:
+    """
+    Resolves the credentials for a session, which might prompt for
+    an MFA token, so that API calls using the session afterwards
+    will not need to prompt.
+
+    """
+
+    creds = session.get_credentials()
+    if creds:
+        creds.get_frozen_credentials()
+
+
+class _CachedCredentialProvider:
+    """
+    Provides credentials for a profile from the cache, falling back to
+    the profile's usual credential providers when they are not cached
+    or will expire soon. Static credentials are not cached.
+
+    """
+
+    METHOD = "pretf-cache"
+    CANONICAL_NAME = "pretf-cache"
+
+    def __init__(self, cache_path: str, **session_kwargs: Any) -> None:
+        self._cache_path = cache_path
+        self._session_kwargs = session_kwargs
+
+    def load(self) -> Any:
+        from botocore.credentials import RefreshableCredentials
+
+        metadata: Optional[dict]
+        cached = _read_cached_credentials(self._cache_path)
+        if cached:
+            metadata = _get_credentials_metadata(cached)
+        else:
+            metadata = self._refresh()
+            if not metadata:
+                return None
+
+        return RefreshableCredentials.create_from_metadata(
+            metadata=metadata, refresh_using=self._refresh, method=self.METHOD
+        )
+
+    def _refresh(self) -> Optional[dict]:
+        session = _create_profile_session(**self._session_kwargs)
+        creds = session.get_credentials()
+        if not creds:
+            return None
+        frozen_creds = creds.get_frozen_credentials()
+        expiry_time = getattr(creds, "_expiry_time", None)
+        if not expiry_time:
+            return None
+
+        session_kwargs = {
+            "aws_access_key_id": frozen_creds.access_key,
+            "aws_secret_access_key": frozen_creds.secret_key,
+            "aws_session_token": frozen_creds.token,
+        }
+        expires = expiry_time.timestamp()
+        _write_cached_credentials(self._cache_path, session_kwargs, expires)
+
+        return _get_credentials_metadata(
+            {"session": session_kwargs, "expires": expires}
+        )
+
+
+def _get_credentials_metadata(cached: dict) -> dict:
+    """
+    Converts cached credentials into the format used by botocore.
+
+    """
+
+    session_kwargs = cached["session"]
+    expiry_time = datetime.fromtimestamp(cached["expires"], timezone.utc)
     return {
-        "bucket_exists": bucket_exists,
-        "bucket_versioning_enabled": bucket_versioning_enabled,
-        "table_exists": table_exists,
+        "access_key": session_kwargs["aws_access_key_id"],
+        "secret_key": session_kwargs["aws_secret_access_key"],
+        "token": session_kwargs["aws_session_token"],
+        "expiry_time": expiry_time.isoformat(),
+    }
+
+
+def _read_cached_credentials(path: str) -> Optional[dict]:
+    """
+    Returns cached credentials if they exist and will not expire soon.
+
+    """
+
+    cached = read_json_file(path)
+    if not isinstance(cached, dict):
+        return None
+    expires = cached.get("expires")
+    if not isinstance(expires, (int, float)):
+        return None
+    if expires - time() < CACHE_REFRESH_SECONDS:
+        return None
+    return cached
+
+
+def _write_cache_file(path: str, data: dict) -> None:
+    # The cache contains credentials, so only the
+    # current user can access the directory and files.
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    write_json_file(path, data)
+
+
+def _write_cached_credentials(path: str, session_kwargs: dict, expires: float) -> None:
+    _write_cache_file(path, {"session": session_kwargs, "expires": expires})
+
+
+class CredentialBroker:
+    """
+    Serves credentials to other processes, such as Terraform, using
+    the credential_process option in a generated AWS config file.
+    Credentials are resolved by this process, so multiple processes
+    share the same sessions and MFA prompts, and they get fresh
+    credentials from the broker whenever theirs expire.
+
+    If a socket path is provided, this connects to a broker that was
+    started by another process instead of starting a new one.
+
+    """
+
+    def __init__(self, socket_path: Optional[str] = None) -> None:
+        self.base_config_path = (
+            os.environ.get("PRETF_AWS_BASE_CONFIG_FILE")
+            or os.environ.get("AWS_CONFIG_FILE")
+            or os.path.join(os.path.expanduser("~"), ".aws", "config")
+        )
+
+        self.is_remote = socket_path is not None
+        if socket_path is not None:
+            self.dir_path = os.path.dirname(socket_path)
+            self.config_path = os.path.join(self.dir_path, "config")
+            self.socket_path = socket_path
+            return
+
+        # Only the current user can access the socket in this directory.
+        self.dir_path = tempfile.mkdtemp(prefix="pretf-aws-")
+        atexit.register(shutil.rmtree, self.dir_path, ignore_errors=True)
+        self.config_path = os.path.join(self.dir_path, "config")
+        self.socket_path = os.path.join(self.dir_path, "broker.sock")
+
+        self._lock = Lock()
+        self._profiles: Dict[str, Optional[str]] = {}
+        self._write_config()
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        self._server.listen()
+        Thread(target=self._serve, daemon=True).start()
+
+    def add_profile(self, profile_name: str) -> str:
+        """
+        Adds a profile to the generated AWS config file, using the broker
+        to get its credentials, and returns the name of the new profile.
+
+        """
+
+        if self.is_remote:
+            response = _broker_request(self.socket_path, {"add_profile": profile_name})
+            if "Error" in response:
+                log.bad(f"broker: {response['Error']}")
+                raise SystemExit(1)
+            return response["Profile"]
+
+        region_name = get_session(profile_name=profile_name).region_name
+        with self._lock:
+            if profile_name not in self._profiles:
+                self._profiles[profile_name] = region_name
+                self._write_config()
+        return _get_broker_profile_name(profile_name)
+
+    def _handle(self, conn: socket.socket) -> None:
+        with conn:
+            line = conn.makefile("rb").readline()
+            if not line:
+                # Connections that only check if the broker is running.
+                return
+            request = json.loads(line)
+            try:
+                if "add_profile" in request:
+                    response = {"Profile": self.add_profile(request["add_profile"])}
+                else:
+                    response = _get_credential_process_output(request["profile"])
+            except Exception as error:
+                response = {"Error": str(error)}
+            conn.sendall(json.dumps(response).encode())
+
+    def _serve(self) -> None:
+        while True:
+            conn, _ = self._server.accept()
+            Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _write_config(self) -> None:
+
+        # Start with the original config file, so that everything
+        # using the generated config file can use all profiles.
+        try:
+            with open(self.base_config_path) as open_file:
+                lines = [open_file.read()]
+        except OSError:
+            lines = []
+
+        for profile_name, region_name in sorted(self._profiles.items()):
+            command = [
+                sys.executable,
+                "-m",
+                "pretf.aws",
+                self.socket_path,
+                profile_name,
+            ]
+            lines.append("")
+            lines.append(f"[profile {_get_broker_profile_name(profile_name)}]")
+            lines.append(f"credential_process = {' '.join(map(shlex.quote, command))}")
+            if region_name:
+                lines.append(f"region = {region_name}")
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.dir_path, prefix=".tmp-")
+        with os.fdopen(fd, "w") as open_file:
+            open_file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.config_path)
+
+
+def _broker_request(socket_path: str, request: dict) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        return json.loads(sock.makefile("rb").read())
+
+
+def _credential_process(socket_path: str, profile_name: str) -> int:
+    """
+    Gets credentials from a credential broker and prints them
+    in the format expected by the credential_process option.
+
+    """
+
+    response = _broker_request(socket_path, {"profile": profile_name})
+
+    if "Error" in response:
+        print(response["Error"], file=sys.stderr)
+        return 1
+
+    print(json.dumps(response))
+    return 0
+
+
+def _get_broker_profile(profile_name: str) -> Optional[str]:
+    """
+    Returns a profile that uses the credential broker, or None if the
+    credential broker has not been started. The broker's profiles are
+    only used when AWS_CONFIG_FILE points to its generated config file,
+    because environment variables are restored after each command when
+    running in the Pretf daemon.
+
+    """
+
+    if _broker and os.environ.get("AWS_CONFIG_FILE") == _broker.config_path:
+        return _broker.add_profile(profile_name)
+    return None
+
+
+def _get_broker_profile_name(profile_name: str) -> str:
+    return f"pretf-broker-{profile_name}"
+
+
+def _is_broker_running(socket_path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def _get_credential_process_output(profile_name: str) -> dict:
+    session = get_session(profile_name=profile_name)
+    with _get_credential_lock(session):
+        creds = session.get_credentials()
+        frozen_creds = creds.get_frozen_credentials()
+        expiry_time = getattr(creds, "_expiry_time", None)
+
+    output = {
+        "Version": 1,
+        "AccessKeyId": frozen_creds.access_key,
+        "SecretAccessKey": frozen_creds.secret_key,
     }
+    if frozen_creds.token:
+        output["SessionToken"] = frozen_creds.token
+    if expiry_time:
+        output["Expiration"] = expiry_time.isoformat()
+    return output
+
+
+def _prompt(prompt: str) -> str:
+    with lock:
+        return getpass(prompt)
 
 
 def _profile_creds_definitely_supported_by_terraform(creds: Any) -> bool:
@@ -185,9 +955,8 @@ def _profile_creds_definitely_supported_by_terraform(creds: Any) -> bool:
         return False
 
 
-@locked
 def export_environment_variables(
-    session: Optional[Session] = None,
+    session: Optional["Session"] = None,
     region_name: Optional[str] = None,
     **kwargs: Any,
 ) -> None:
@@ -218,38 +987,58 @@ def export_environment_variables(
         os.environ["AWS_DEFAULT_REGION"] = region_name
 
 
-@lru_cache()
-@locked
 def get_account_id(
-    session: Optional[Session] = None,
+    session: Optional["Session"] = None,
     **kwargs: Any,
 ) -> str:
     if session is None:
         session = get_session(**kwargs)
-    sts_client = session.client("sts")
-    account_id = sts_client.get_caller_identity()["Account"]
-    return account_id
+    _resolve_credentials(session)
+    return _account_ids.do(session, _load_account_id, session)
 
 
-@locked
 def get_frozen_credentials(
-    session: Optional[Session] = None,
+    session: Optional["Session"] = None,
     **kwargs: Any,
 ) -> Any:
     if session is None:
         session = get_session(**kwargs)
-    return session.get_credentials().get_frozen_credentials()
+    with _get_credential_lock(session):
+        return session.get_credentials().get_frozen_credentials()
 
 
-@lru_cache()
-def get_session(**kwargs: Any) -> Session:
-    if use_boto_source_profile_mfa:
-        return boto_source_profile_mfa.get_session(**kwargs)
-    else:
-        return Session(**kwargs)
+def get_session(**kwargs: Any) -> "Session":
+    key = (_get_session_environment(), tuple(sorted(kwargs.items())))
+    return _sessions.do(key, _create_shared_session, **kwargs)
+
+
+def _get_session_environment() -> Tuple[Any, ...]:
+    """
+    Returns the environment variable values and AWS config file versions
+    that sessions depend on, so that sessions are only shared by callers
+    using the same AWS environment.
+
+    """
+
+    values: List[Any] = [os.environ.get(name) for name in SESSION_ENVIRONMENT_VARIABLES]
+    for name, default in (
+        ("AWS_CONFIG_FILE", "~/.aws/config"),
+        ("AWS_SHARED_CREDENTIALS_FILE", "~/.aws/credentials"),
+    ):
+        path = os.path.expanduser(os.environ.get(name) or default)
+        try:
+            values.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            values.append(None)
+    return tuple(values)
+
+
+def _create_shared_session(**kwargs: Any) -> "Session":
+    # Creating sessions is not thread-safe.
+    with _sessions_lock:
+        return _get_session(**kwargs)
 
 
-@locked
 def provider_aws(**body: Any) -> Block:
     """
     Returns an AWS provider block. If provided, the `profile` option
@@ -259,25 +1048,62 @@ def provider_aws(**body: Any) -> Block:
 
     if body.get("profile"):
         session = get_session(profile_name=body["profile"])
-        creds = session.get_credentials()
+        creds = _get_credentials(session)
         if not _profile_creds_definitely_supported_by_terraform(creds):
 
-            # This profile is using credentials that Terraform may not
-            # support, so get static/frozen credentials and inject them
-            # into the configuration.
+            broker_profile = _get_broker_profile(body["profile"])
+            if broker_profile:
+
+                # This profile is using credentials that Terraform may not
+                # support, so use a profile that gets credentials from the
+                # credential broker.
+
+                body["profile"] = broker_profile
+
+            else:
 
-            del body["profile"]
+                # This profile is using credentials that Terraform may not
+                # support, so get static/frozen credentials and inject them
+                # into the configuration.
 
-            frozen_creds = creds.get_frozen_credentials()
-            body["access_key"] = frozen_creds.access_key
-            body["secret_key"] = frozen_creds.secret_key
-            if creds.token:
-                body["token"] = frozen_creds.token
+                del body["profile"]
+
+                frozen_creds = get_frozen_credentials(session)
+                body["access_key"] = frozen_creds.access_key
+                body["secret_key"] = frozen_creds.secret_key
+                if creds.token:
+                    body["token"] = frozen_creds.token
 
     return block("provider", "aws", body)
 
 
-@locked
+def start_credential_broker() -> "CredentialBroker":
+    """
+    Starts a credential broker in this process, if not already started,
+    and uses its generated AWS config file for any child processes.
+    Afterwards, AWS profiles that Terraform may not support will use
+    the broker to get credentials instead of using frozen credentials.
+
+    If a parent process has already started a credential broker,
+    then this process uses that broker instead of starting another.
+
+    """
+
+    global _broker
+
+    with _broker_lock:
+        if not _broker:
+            socket_path = os.environ.get("PRETF_AWS_BROKER_SOCKET")
+            if socket_path and _is_broker_running(socket_path):
+                _broker = CredentialBroker(socket_path=socket_path)
+            else:
+                _broker = CredentialBroker()
+        os.environ["PRETF_AWS_BASE_CONFIG_FILE"] = _broker.base_config_path
+        os.environ["PRETF_AWS_BROKER_SOCKET"] = _broker.socket_path
+        os.environ["AWS_CONFIG_FILE"] = _broker.config_path
+        return _broker
+
+
 def terraform_backend_s3(bucket: str, dynamodb_table: str, **config: Any) -> Block:
     """
     This ensures that the S3 backend exists, prompting to create it if
@@ -307,12 +1133,12 @@ def terraform_backend_s3(bucket: str, dynamodb_table: str, **config: Any) -> Blo
     # Replace the profile argument with environment variables.
 
     if config.get("profile"):
-        creds = session.get_credentials()
+        creds = _get_credentials(session)
         if not _profile_creds_definitely_supported_by_terraform(creds):
 
             # This profile is using credentials that Terraform may not
             # support, so get static/frozen credentials and export them
-            # as environment variables.
+            # as environment variables, or use the credential broker.
 
             # Use environment variables for credentials rather than
             # injecting them into the backend configuration because
@@ -320,9 +1146,17 @@ def terraform_backend_s3(bucket: str, dynamodb_table: str, **config: Any) -> Blo
             # changes, which happens with certain AWS credential types
             # such as assuming roles.
 
+            broker_profile = _get_broker_profile(config["profile"])
+
             del config["profile"]
 
-            export_environment_variables(session=session, region_name=region)
+            if broker_profile:
+                os.environ["AWS_PROFILE"] = broker_profile
+                if region:
+                    os.environ["AWS_REGION"] = region
+                    os.environ["AWS_DEFAULT_REGION"] = region
+            else:
+                export_environment_variables(session=session, region_name=region)
 
     # Assume role before interacting with backend resources. This not the same
     # as profiles that assume roles. This is when Terraform has specifically
@@ -331,6 +1165,24 @@ def terraform_backend_s3(bucket: str, dynamodb_table: str, **config: Any) -> Blo
     # or using environment variables to set credentials, and then assuming
     # different roles using those credentials.
 
+    # Skip checking the backend resources if they were verified recently.
+    # The marker is keyed on the configured credentials rather than the
+    # account ID so that warm runs do not make any AWS API calls.
+
+    backend_key = None
+    if _get_backend_ttl() > 0:
+        backend_key = "/".join(
+            (
+                _get_credentials_source(session_kwargs, session),
+                config.get("role_arn", ""),
+                str(region),
+                bucket,
+                dynamodb_table,
+            )
+        )
+        if _is_backend_verified(backend_key):
+            return _get_s3_backend_block(bucket, dynamodb_table, region, config)
+
     if config.get("role_arn"):
         session = _assume_role(
             session,
@@ -376,17 +1228,12 @@ def terraform_backend_s3(bucket: str, dynamodb_table: str, **config: Any) -> Blo
             session=session, bucket=bucket, table=dynamodb_table, region_name=region
         )
 
-    # Return the configuration to use the backend.
-
-    config["bucket"] = bucket
-    config.setdefault("encrypt", True)
-    config["dynamodb_table"] = dynamodb_table
-    config["region"] = region
+    if backend_key:
+        _set_backend_verified(backend_key)
 
-    return block("terraform", {"backend": {"s3": config}})
+    return _get_s3_backend_block(bucket, dynamodb_table, region, config)
 
 
-@locked
 def terraform_remote_state_s3(name: str, **body: Any) -> Block:
     """
     This returns a Terraform configuration block for a "terraform_remote_state"
@@ -399,19 +1246,36 @@ def terraform_remote_state_s3(name: str, **body: Any) -> Block:
     if config.get("profile"):
 
         session = get_session(profile_name=config["profile"])
-        creds = session.get_credentials()
+        creds = _get_credentials(session)
         if not _profile_creds_definitely_supported_by_terraform(creds):
 
-            # This profile is using credentials that Terraform may not
-            # support, so get static/frozen credentials and inject them
-            # into the configuration.
+            broker_profile = _get_broker_profile(config["profile"])
+            if broker_profile:
 
-            del config["profile"]
+                # This profile is using credentials that Terraform may not
+                # support, so use a profile that gets credentials from the
+                # credential broker.
+
+                config["profile"] = broker_profile
+
+            else:
 
-            frozen_creds = creds.get_frozen_credentials()
-            config["access_key"] = frozen_creds.access_key
-            config["secret_key"] = frozen_creds.secret_key
-            if creds.token:
-                config["token"] = frozen_creds.token
+                # This profile is using credentials that Terraform may not
+                # support, so get static/frozen credentials and inject them
+                # into the configuration.
+
+                del config["profile"]
+
+                frozen_creds = get_frozen_credentials(session)
+                config["access_key"] = frozen_creds.access_key
+                config["secret_key"] = frozen_creds.secret_key
+                if creds.token:
+                    config["token"] = frozen_creds.token
 
     return block("data", "terraform_remote_state", name, body)
+
+
+if __name__ == "__main__":
+    # This is used by the credential_process option in
+    # config files generated by the credential broker.
+    sys.exit(_credential_process(*sys.argv[1:]))
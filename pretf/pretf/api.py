@@ -1,9 +1,16 @@
 import inspect
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from pathlib import Path
-from typing import Any, Optional, Union
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Union
 
-from . import labels, log
+from . import labels, log, util
 from .blocks import Block
+from .exceptions import DuplicateBlockError
+from .render import json_default
+from .state import get_local_state_path, get_state_outputs, get_workspace
 from .util import is_verbose
 
 
@@ -17,16 +24,193 @@ def block(block_type: str, *args: Any) -> Block:
     return Block(block_type, labels, body)
 
 
-def get_outputs(cwd: Union[Path, str], verbose: Optional[bool] = None) -> dict:
+# The labels argument of bulk_block() shadows the labels module.
+_clean_label = labels.clean
+
+
+def bulk_block(
+    block_type: str,
+    *labels: str,
+    items: Union[Dict[str, Any], Iterable[str]],
+    body: Union[dict, Callable[[Any], dict]],
+    clean: bool = True,
+) -> Block:
+    """
+    Creates one block containing many blocks of the same type,
+    with one for each item. This is much faster than creating and
+    yielding a separate block for each item.
+
+    If items is a dict, its keys are used as labels and its values
+    are passed to the body function. Otherwise the items are used as
+    labels and passed to the body function. If body is a dict, it is
+    used for every item. Labels are cleaned with labels.clean() unless
+    clean is False.
+
+    """
+
+    clean_label = _clean_label if clean else None
+    if isinstance(items, dict):
+        pairs: Iterable = items.items()
+    else:
+        pairs = ((item, item) for item in items)
+
+    bodies: Dict[str, Any] = {}
+    for label, item in pairs:
+        if clean_label:
+            label = clean_label(label)
+        if label in bodies:
+            frame = inspect.currentframe()
+            source = frame and frame.f_back and frame.f_back.f_code.co_filename
+            address = ".".join([block_type, *labels, label])
+            raise DuplicateBlockError(address, source)
+        bodies[label] = body(item) if callable(body) else body
+
+    return Block(block_type, list(labels), bodies)
+
+
+def cached(
+    func: Optional[Callable] = None, *, cache_ttl: Optional[float] = None
+) -> Callable:
+    """
+    This is a decorator that shares the result of a function between
+    calls with the same arguments for the duration of the Pretf run.
+    Concurrent calls from different render threads wait for the first
+    call and share its result. Calls with arguments that cannot be
+    represented as JSON are not cached.
+
+    If cache_ttl is set, results are also cached in .terraform/pretf/cached
+    for that number of seconds, if they can be stored as JSON.
+
+    """
+
+    if func is None:
+
+        def decorator(func: Callable) -> Callable:
+            return cached(func, cache_ttl=cache_ttl)
+
+        return decorator
+
+    if inspect.iscoroutinefunction(func):
+        raise TypeError("cached() does not support async functions")
+
+    source = util.get_source_file(func)
+
+    @wraps(func)
+    def wrapped(*args: Any, **kwargs: Any) -> Any:
+        data = [os.getcwd(), source, func.__qualname__, args, kwargs]
+        key = util.hash_json(data, default=json_default)
+        if key is None:
+            return func(*args, **kwargs)
+        return _cached.do(key, _load_cached, key, func, source, args, kwargs, cache_ttl)
+
+    return wrapped
+
+
+def _load_cached(
+    key: str,
+    func: Callable,
+    source: str,
+    args: tuple,
+    kwargs: dict,
+    cache_ttl: Optional[float],
+) -> Any:
+
+    if cache_ttl is None:
+        return func(*args, **kwargs)
+
+    cache_file = util.CacheFile(
+        Path(".terraform", "pretf", "cached", f"{key}.json"), source, cache_ttl
+    )
+    cache = cache_file.load()
+    if cache:
+        return cache["value"]
+
+    value = func(*args, **kwargs)
+
+    # Only cache values that can be stored without changing them.
+    if util.is_json_stable(value):
+        cache_file.save({"value": value})
+
+    return value
+
+
+def get_outputs(
+    cwd: Union[Path, str],
+    verbose: Optional[bool] = None,
+    cache_ttl: Optional[float] = None,
+) -> dict:
     """
     Runs `pretf output` in the specified directory and returns the values.
     If the path is not anchored (i.e. does not start with ./ or ../ or /)
     then it will check the current directory and all parent directories
     until found.
 
+    If the directory is using local state, then the values are read
+    directly from the state file without running Pretf. Otherwise, if
+    cache_ttl (or the PRETF_OUTPUTS_CACHE_TTL environment variable) is
+    set, the values are cached in .terraform/pretf/outputs.json in the
+    specified directory for that number of seconds.
+
+    Concurrent and repeated calls for the same directory during
+    a Pretf run share the same result.
+
     """
 
-    from pretf.command import PretfCommand
+    # Find the calling file of this function, usually a *.tf.py file.
+    frame = inspect.currentframe()
+    if not frame:
+        raise Exception("get_outputs() called from unknown frame")
+    caller_frame = frame.f_back
+    if not caller_frame:
+        raise Exception("get_outputs() called from unknown caller")
+    caller_info = inspect.getframeinfo(caller_frame)
+    caller_file = caller_info.filename
+
+    path = _get_outputs_path(cwd, verbose=verbose, caller_file=caller_file)
+
+    return _outputs.do(str(path.resolve()), _read_outputs, path, cache_ttl)
+
+
+def get_outputs_many(
+    paths: Sequence[Union[Path, str]],
+    verbose: Optional[bool] = None,
+    cache_ttl: Optional[float] = None,
+    max_workers: int = 8,
+) -> Dict[Union[Path, str], dict]:
+    """
+    Runs `pretf output` in multiple directories concurrently and returns
+    a dictionary of paths to values. Paths are handled the same way as
+    get_outputs(), and share results with it.
+
+    """
+
+    # Find the calling file of this function, usually a *.tf.py file.
+    frame = inspect.currentframe()
+    if not frame:
+        raise Exception("get_outputs_many() called from unknown frame")
+    caller_frame = frame.f_back
+    if not caller_frame:
+        raise Exception("get_outputs_many() called from unknown caller")
+    caller_info = inspect.getframeinfo(caller_frame)
+    caller_file = caller_info.filename
+
+    resolved = {}
+    for cwd in paths:
+        resolved[cwd] = _get_outputs_path(cwd, verbose=verbose, caller_file=caller_file)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for cwd, path in resolved.items():
+            futures[cwd] = executor.submit(
+                _outputs.do, str(path.resolve()), _read_outputs, path, cache_ttl
+            )
+
+    return {cwd: future.result() for cwd, future in futures.items()}
+
+
+def _get_outputs_path(
+    cwd: Union[Path, str], verbose: Optional[bool], caller_file: str
+) -> Path:
 
     if isinstance(cwd, Path):
         # Use path as-is.
@@ -56,18 +240,6 @@ def get_outputs(cwd: Union[Path, str], verbose: Optional[bool] = None) -> dict:
         raise TypeError(cwd)
 
     if is_verbose(verbose) or not path.is_dir():
-
-        # Find the calling directory of this function, usually the directory
-        # containing the pretf.workflow.py file that has called this function.
-        frame = inspect.currentframe()
-        if not frame:
-            raise Exception("get_outputs() called from unknown frame")
-        caller_frame = frame.f_back
-        if not caller_frame:
-            raise Exception("get_outputs() called from unknown caller")
-        caller_info = inspect.getframeinfo(caller_frame)
-        caller_file = caller_info.filename
-
         if path.is_dir():
             log.ok(f"outputs: {cwd} -> {caller_file}")
         else:
@@ -80,13 +252,63 @@ def get_outputs(cwd: Union[Path, str], verbose: Optional[bool] = None) -> dict:
                     f"get_outputs({cwd!r}) in {caller_file}: {path} does not exist"
                 )
 
+    return path
+
+
+def _read_outputs(path: Path, cache_ttl: Optional[float]) -> dict:
+
+    from pretf.command import PretfCommand
+
+    # Read outputs directly from local state files.
+    state_path = get_local_state_path(path)
+    if state_path:
+        outputs = get_state_outputs(state_path)
+        if outputs is not None:
+            return {name: data["value"] for name, data in outputs.items()}
+
+    if cache_ttl is None:
+        env_cache_ttl = os.environ.get("PRETF_OUTPUTS_CACHE_TTL")
+        if env_cache_ttl:
+            cache_ttl = float(env_cache_ttl)
+
+    # Check for cached values that are still valid.
+    cache_path = path / ".terraform" / "pretf" / "outputs.json"
+    workspace = get_workspace(path)
+    if cache_ttl is not None:
+        cache = util.read_json_file(cache_path)
+        if isinstance(cache, dict) and cache.get("workspace") == workspace:
+            if time.time() - cache.get("time", 0) < cache_ttl:
+                return cache["values"]
+
     outputs = PretfCommand(cwd=path, verbose=False).output()
 
     values = {}
     for name, data in outputs.items():
         values[name] = data["value"]
 
+    if cache_ttl is not None:
+        cache = {"workspace": workspace, "time": time.time(), "values": values}
+        try:
+            util.write_json_file(cache_path, cache)
+        except OSError:
+            pass
+
     return values
 
 
-__all__ = ["block", "get_outputs", "labels", "log"]
+# Share cached function results between threads for the duration of the Pretf run.
+_cached = util.SingleFlight(cache_results=True)
+
+# Share output values between threads for the duration of the Pretf run.
+_outputs = util.SingleFlight(cache_results=True)
+
+
+__all__ = [
+    "block",
+    "bulk_block",
+    "cached",
+    "get_outputs",
+    "get_outputs_many",
+    "labels",
+    "log",
+]
@@ -1,9 +1,15 @@
 from collections.abc import Iterable
+from threading import Lock
 from types import ModuleType
 from typing import Any, Dict, Generator, List, Optional, Union
 
 
 class BlockModule(ModuleType):
+
+    # The number of children to remember for each module,
+    # so that repeated references return the same objects.
+    cache_size = 1024
+
     def __init__(
         self, block_type: str, labels: Optional[List[str]] = None, needs: int = 0
     ):
@@ -19,12 +25,44 @@ class BlockModule(ModuleType):
         self.__path__ = name
         super().__init__(name)
 
+        self._children: Dict[str, Union["BlockModule", "Block"]] = {}
+        self._children_lock = Lock()
+
     def __call__(self, *bodies: Dict[str, Any], **kwargs: Dict[str, Any]) -> "Block":
         return Block(self.block_type, self.labels, {})(*bodies, **kwargs)
 
     def __getattr__(self, name: str) -> Union["BlockModule", "Block"]:
+        return self[name]
+
+    def __getitem__(self, name: str) -> Union["BlockModule", "Block"]:
         if name.startswith("__"):
             raise AttributeError(name)
+
+        try:
+            return self._children[name]
+        except KeyError:
+            pass
+
+        child = self._create_child(name)
+
+        with self._children_lock:
+
+            if len(self._children) >= self.cache_size:
+                oldest_name = next(iter(self._children))
+                oldest_child = self._children.pop(oldest_name)
+                if self.__dict__.get(oldest_name) is oldest_child:
+                    del self.__dict__[oldest_name]
+
+            self._children[name] = child
+
+            # Also store it as a module attribute, so that repeated
+            # attribute references will not call __getattr__ at all.
+            if name not in self.__dict__:
+                self.__dict__[name] = child
+
+        return child
+
+    def _create_child(self, name: str) -> Union["BlockModule", "Block"]:
         if self.needs == 0:
             return getattr(Block(self.block_type, self.labels, {}), name)
         elif self.needs == 1:
@@ -32,14 +70,17 @@ class BlockModule(ModuleType):
         else:
             return self.__class__(self.block_type, self.labels + [name], self.needs - 1)
 
-    __getitem__ = __getattr__
-
 
 class Block(Iterable):
+    __slots__ = ("_block_type", "_labels", "_body", "_dict", "_prefix", "_attrs")
+
     def __init__(self, block_type: str, labels: List[str], body: Dict[str, Any]):
         self._block_type = block_type
         self._labels = labels
         self._body = body
+        self._dict: Optional[dict] = None
+        self._prefix: Optional[str] = None
+        self._attrs: Optional[Dict[str, Union["Interpolated", str]]] = None
 
     def __call__(self, *bodies: Dict[str, Any], **kwargs: Dict[str, Any]) -> "Block":
         """
@@ -51,28 +92,53 @@ class Block(Iterable):
         for each in bodies:
             body.update(each)
         body.update(kwargs)
-        return self.__class__(self._block_type, self._labels, body)
+        block = self.__class__(self._block_type, self._labels, body)
+        block._prefix = self._prefix
+        return block
 
     def __iter__(self) -> Generator[tuple, None, None]:
-        if self._labels:
-            result: dict = {}
-            here = result
-            for label in self._labels[:-1]:
-                here[label] = {}
-                here = here[label]
-            here[self._labels[-1]] = self._body
-        else:
+        yield from self._to_dict().items()
+
+    def _to_dict(self) -> dict:
+        """
+        Returns the block in the format used by Terraform JSON files.
+        This is only created once, so it must not be modified.
+
+        """
+
+        if self._dict is None:
             result = self._body
-        yield (self._block_type, result)
+            for label in reversed(self._labels):
+                result = {label: result}
+            self._dict = {self._block_type: result}
+        return self._dict
 
     def _get_expression(self, name: Optional[str] = None) -> Union["Interpolated", str]:
+        if self._prefix is None:
+            self._prefix = self._get_prefix()
+
+        if self._block_type == "locals":
+            if len(self._labels) < 1 and not name:
+                raise ValueError("locals blocks require 1 label")
+        elif self._block_type == "provider":
+            if name == "alias" or not name:
+                if self._body:
+                    alias = self._body.get("alias") or "default"
+                    if alias != "default":
+                        return f"{self._prefix}.{alias}"
+                return self._prefix
+
+        if name:
+            return Interpolated(f"{self._prefix}.{name}")
+
+        return Interpolated(self._prefix)
+
+    def _get_prefix(self) -> str:
         if self._block_type == "data":
             if len(self._labels) < 2:
                 raise ValueError("data blocks require 2 labels")
             parts = [self._block_type] + list(self._labels)
         elif self._block_type == "locals":
-            if len(self._labels) < 1 and not name:
-                raise ValueError("locals blocks require 1 label")
             parts = ["local"] + list(self._labels)
         elif self._block_type == "module":
             if len(self._labels) < 1:
@@ -86,12 +152,6 @@ class Block(Iterable):
             if len(self._labels) < 1:
                 raise ValueError("provider blocks require 1 label")
             parts = list(self._labels)
-            if name == "alias" or not name:
-                if self._body:
-                    alias = self._body.get("alias") or "default"
-                    if alias != "default":
-                        parts.append(alias)
-                return ".".join(parts)
         elif self._block_type == "resource":
             if len(self._labels) < 2:
                 raise ValueError("resource blocks require 2 labels")
@@ -103,15 +163,18 @@ class Block(Iterable):
         else:
             parts = [self._block_type] + list(self._labels)
 
-        if name:
-            parts.append(name)
-
-        return Interpolated(".".join(parts))
+        return ".".join(parts)
 
     def __getattr__(self, name: str) -> Union["Interpolated", str]:
         if name.startswith("__"):
             raise AttributeError(name)
-        return self._get_expression(name)
+        if self._attrs is None:
+            self._attrs = {}
+        try:
+            return self._attrs[name]
+        except KeyError:
+            value = self._attrs[name] = self._get_expression(name)
+            return value
 
     __getitem__ = __getattr__
 
@@ -127,6 +190,8 @@ class Block(Iterable):
 
 
 class Interpolated:
+    __slots__ = ("__value",)
+
     def __init__(self, value: str):
         self.__value = value
 
@@ -134,6 +199,8 @@ class Interpolated:
         return str(self) == other
 
     def __getattr__(self, attr: str) -> "Interpolated":
+        if attr.startswith("__"):
+            raise AttributeError(attr)
         return type(self)(self.__value + "." + attr)
 
     def __getitem__(self, index: int) -> "Interpolated":
@@ -1,13 +1,30 @@
+import os
 import sys
 from subprocess import CalledProcessError, CompletedProcess
 from typing import Union
 
-from . import log, util, workflow
-from .exceptions import FunctionNotFoundError, RequiredFilesNotFoundError, VariableError
+from . import log, util
+from .exceptions import (
+    DuplicateBlockError,
+    FunctionNotFoundError,
+    OutputNotProducedError,
+    RequiredFilesNotFoundError,
+    VariableError,
+)
 from .version import __version__
 
 
 def main() -> None:
+
+    # Run the command in the daemon if there is one.
+    socket_path = os.environ.get("PRETF_DAEMON_SOCKET")
+    if socket_path:
+        from .daemon import request
+
+        returncode = request(socket_path)
+        if returncode is not None:
+            sys.exit(returncode)
+
     try:
         result = run()
     except CalledProcessError as error:
@@ -25,6 +42,9 @@ def run() -> Union[CompletedProcess, int]:
 
     """
 
+    # This is imported here so the daemon client does not need to import it.
+    from . import workflow
+
     subcommand, options = util.parse_args()
 
     if subcommand == "version":
@@ -56,7 +76,11 @@ def run() -> Union[CompletedProcess, int]:
     except (log.bad, log.ok):
         pass
 
-    except FunctionNotFoundError as error:
+    except (
+        DuplicateBlockError,
+        FunctionNotFoundError,
+        OutputNotProducedError,
+    ) as error:
 
         log.bad(error)
 
@@ -1,8 +1,24 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from typing import Any, Callable, Generator, Iterable, Sequence, Union
-
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from . import util
+from .exceptions import OutputNotProducedError
 from .parser import get_outputs_from_block
-from .render import call_pretf_function, unwrap_yielded
+from .render import call_pretf_function, json_default, unwrap_yielded
 from .variables import VariableStore, VariableValue, get_variable_definitions_from_block
 
 
@@ -26,7 +42,44 @@ class Collection(Iterable):
                 yield block
 
 
-def collect(func: Callable) -> Callable:
+class StreamingCollection(Iterable):
+    """
+    A collection that passes blocks through as they are yielded by the
+    collection function, rather than storing them all first. Outputs are
+    available after the blocks that define them have been iterated over.
+    It can only be iterated over once.
+
+    """
+
+    def __init__(self, name: str, blocks: Iterator[dict], outputs: dict) -> None:
+        self.__name = name
+        self.__blocks = blocks
+        self.__outputs = outputs
+        self.__started = False
+        self.__done = False
+
+    def __getattr__(self, name: str) -> Any:
+        if name in self.__outputs:
+            return self.__outputs[name]
+        if self.__done:
+            raise AttributeError(f"output not defined: {name}")
+        raise OutputNotProducedError(collection=self.__name, name=name)
+
+    def __iter__(self) -> Generator[dict, Any, None]:
+        if self.__started:
+            raise RuntimeError(f"collection {self.__name} was already iterated over")
+        self.__started = True
+        yield from self.__blocks
+        self.__done = True
+
+
+def collect(
+    func: Optional[Callable] = None,
+    *,
+    cache: bool = False,
+    cache_ttl: Optional[float] = None,
+    stream: bool = False,
+) -> Callable:
     """
     This is a decorator used to create a collection. Collections are similar
     to Terraform modules except the resources are included in the root
@@ -43,53 +96,160 @@ def collect(func: Callable) -> Callable:
     must be passed in as keyword arguments. Any outputs defined by output
     blocks can be accessed as attributes of the collection.
 
+    If cache is True, calls with the same keyword arguments share
+    the same result for the duration of the Pretf run. If cache_ttl
+    is set, results are also cached in .terraform/pretf/collections
+    for that number of seconds, if the outputs can be stored as JSON.
+
+    If stream is True, the collection function runs as the collection
+    is iterated over, and blocks are passed through without being stored.
+    Outputs can only be accessed after the collection has been yielded.
+    Streaming collections cannot be cached.
+
     """
 
+    if stream and (cache or cache_ttl is not None):
+        raise ValueError("streaming collections cannot be cached")
+
+    if func is None:
+
+        def decorator(func: Callable) -> Callable:
+            return collect(func, cache=cache, cache_ttl=cache_ttl, stream=stream)
+
+        return decorator
+
+    source = util.get_source_file(func)
+
     @wraps(func)
-    def wrapped(**kwargs: dict) -> Collection:
+    def wrapped(**kwargs: dict) -> Union[Collection, StreamingCollection]:
 
-        # Create a store to track variables.
-        var_store = VariableStore()
+        if stream:
+            outputs: dict = {}
+            blocks = _iter_collection(func, kwargs, outputs)
+            return StreamingCollection(func.__name__, blocks, outputs)
 
-        # Load variable values from kwargs passed into the collection function.
-        for key, value in kwargs.items():
-            var_value = VariableValue(name=key, value=value, source="kwargs")
-            var_store.add(var_value)
+        if cache or cache_ttl is not None:
+            key = _get_cache_key(func, source, kwargs)
+            if key:
+                return _collections.do(
+                    key, _load_collection, key, func, source, kwargs, cache_ttl
+                )
 
-        # Call the collection function, passing in "path", "terraform" and "var" if required.
-        gen = call_pretf_function(func=func, var=var_store.proxy(func.__name__))
+        return Collection(*_render_collection(func, kwargs))
 
-        blocks = []
-        outputs = {}
+    return wrapped
 
-        yielded = None
-        while True:
 
-            try:
-                yielded = gen.send(yielded)
-            except StopIteration:
-                break
+def parallel(
+    func: Callable, kwargs_list: Iterable[dict], max_workers: int = 8
+) -> List[Collection]:
+    """
+    Calls a collection function with each set of keyword arguments
+    concurrently, and returns the resulting collections in the same
+    order. The list can be yielded to include all of their blocks.
+    Streaming collections only run when they are yielded, so they do
+    not run concurrently.
+
+    """
 
-            for block in unwrap_yielded(yielded):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, **kwargs) for kwargs in kwargs_list]
 
-                # Use variable blocks to update the variable store.
-                var_def = None
-                for var_def in get_variable_definitions_from_block(
-                    block, func.__name__
-                ):
-                    var_store.add(var_def)
+    return [future.result() for future in futures]
 
-                # Use output blocks to update the output values.
-                output = None
-                for output in get_outputs_from_block(block):
-                    name = output["name"]
-                    value = output["value"]
-                    outputs[name] = value
 
-                # Use any other blocks in the resulting JSON.
-                if not var_def and not output:
-                    blocks.append(block)
+def _get_cache_key(func: Callable, source: str, kwargs: dict) -> Optional[str]:
+    """
+    Returns a stable hash of a collection function and its keyword
+    arguments, or None if the arguments cannot be hashed. Blocks are
+    hashed by their Terraform references.
 
-        return Collection(blocks, outputs)
+    """
 
-    return wrapped
+    data = [os.getcwd(), source, func.__qualname__, kwargs]
+    return util.hash_json(data, default=json_default)
+
+
+def _load_collection(
+    key: str, func: Callable, source: str, kwargs: dict, cache_ttl: Optional[float]
+) -> Collection:
+
+    if cache_ttl is None:
+        return Collection(*_render_collection(func, kwargs))
+
+    cache_file = util.CacheFile(
+        Path(".terraform", "pretf", "collections", f"{key}.json"), source, cache_ttl
+    )
+    cache_data = cache_file.load()
+    if cache_data:
+        return Collection(cache_data["blocks"], cache_data["outputs"])
+
+    blocks, outputs = _render_collection(func, kwargs)
+    collection = Collection(blocks, outputs)
+
+    # Only cache outputs that can be stored without changing them,
+    # so that the collection works the same when loaded from the cache.
+    # Blocks are only written to JSON files so they can be converted.
+    if util.is_json_stable(outputs):
+        cache_file.save(
+            {"blocks": list(collection), "outputs": outputs}, default=json_default
+        )
+
+    return collection
+
+
+def _render_collection(func: Callable, kwargs: dict) -> Tuple[list, dict]:
+    outputs: dict = {}
+    blocks = list(_iter_collection(func, kwargs, outputs))
+    return blocks, outputs
+
+
+def _iter_collection(
+    func: Callable, kwargs: dict, outputs: dict
+) -> Generator[dict, None, None]:
+    """
+    Runs a collection function, yielding its blocks and adding its
+    outputs to the given dictionary as they are yielded.
+
+    """
+
+    # Create a store to track variables.
+    var_store = VariableStore()
+
+    # Load variable values from kwargs passed into the collection function.
+    for key, value in kwargs.items():
+        var_value = VariableValue(name=key, value=value, source="kwargs")
+        var_store.add(var_value)
+
+    # Call the collection function, passing in "path", "terraform" and "var" if required.
+    gen = call_pretf_function(func=func, var=var_store.proxy(func.__name__))
+
+    yielded = None
+    while True:
+
+        try:
+            yielded = gen.send(yielded)
+        except StopIteration:
+            break
+
+        for block in unwrap_yielded(yielded):
+
+            # Use variable blocks to update the variable store.
+            var_def = None
+            for var_def in get_variable_definitions_from_block(block, func.__name__):
+                var_store.add(var_def)
+
+            # Use output blocks to update the output values.
+            output = None
+            for output in get_outputs_from_block(block):
+                name = output["name"]
+                value = output["value"]
+                outputs[name] = value
+
+            # Use any other blocks in the resulting JSON.
+            if not var_def and not output:
+                yield block
+
+
+# Share collection results between threads for the duration of the Pretf run.
+_collections = util.SingleFlight(cache_results=True)
@@ -0,0 +1,448 @@
+"""
+Runs Pretf as a long running process on a Unix socket. When the
+PRETF_DAEMON_SOCKET environment variable is set, the pretf command sends
+its arguments, current directory, environment variables and standard
+streams to the daemon, which runs the command and returns the exit code.
+This avoids starting Python and importing modules for every command.
+
+Usage: python -m pretf.daemon [socket_path]
+
+"""
+
+import array
+import json
+import os
+import socket
+import struct
+import sys
+import traceback
+from importlib.abc import Loader, MetaPathFinder
+from importlib.machinery import ModuleSpec, PathFinder
+from threading import Event, Thread
+from types import ModuleType
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from . import log, util
+
+HEADER = struct.Struct("!I")
+STDIO = (0, 1, 2)
+
+
+def request(socket_path: str) -> Optional[int]:
+    """
+    Runs the current command in the daemon and returns its exit code,
+    or None if the daemon is not running.
+
+    """
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+
+    with client:
+        message = {"argv": sys.argv, "cwd": os.getcwd(), "env": dict(os.environ)}
+        try:
+            _send(client, message, fds=STDIO)
+            while True:
+                try:
+                    response, _ = _receive(client)
+                except KeyboardInterrupt:
+                    # The command is not running in this terminal, so the
+                    # daemon passes the interrupt on to it. Like Terraform
+                    # commands run without the daemon, it is left to stop
+                    # by itself, so keep waiting for it to finish.
+                    _send(client, {"interrupt": True})
+                else:
+                    break
+        except (EOFError, OSError) as error:
+            log.bad(f"daemon: {error or 'connection closed'}")
+            return 1
+
+    return response["returncode"]
+
+
+def serve(socket_path: str) -> None:
+    """
+    Listens for commands on a Unix socket and runs them one at a time,
+    because each command changes the current directory, environment
+    variables and standard streams of this process.
+
+    """
+
+    if _is_running(socket_path):
+        raise log.bad(f"daemon: already running on {socket_path}")
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # Only allow the current user to connect.
+    umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+
+    server.listen(8)
+    log.ok(f"daemon: listening on {socket_path}")
+
+    sys.meta_path.insert(0, _ProjectModuleFinder())
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                _handle(conn)
+    finally:
+        server.close()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+
+
+def _handle(conn: socket.socket) -> None:
+
+    try:
+        message, fds = _receive(conn)
+    except (EOFError, OSError, ValueError):
+        return
+
+    # Watch for interrupts from the client while the command runs.
+    interrupted = Event()
+    done = Event()
+    watcher = Thread(target=_watch, args=(conn, interrupted, done), daemon=True)
+    watcher.start()
+
+    try:
+        if len(fds) == len(STDIO):
+            try:
+                returncode = _run(message, fds, interrupted)
+            except KeyboardInterrupt:
+                if not interrupted.is_set():
+                    raise
+                returncode = 130
+        else:
+            returncode = 1
+    finally:
+        done.set()
+        try:
+            conn.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        watcher.join()
+        for fd in fds:
+            os.close(fd)
+
+    try:
+        _send(conn, {"returncode": returncode})
+    except OSError:
+        pass
+
+
+def _watch(conn: socket.socket, interrupted: Event, done: Event) -> None:
+    """
+    Receives messages from the client while its command runs, and passes
+    on interrupts from Ctrl-C to the command. The client going away also
+    interrupts the command.
+
+    """
+
+    while True:
+        try:
+            message, fds = _receive(conn)
+        except (EOFError, OSError, ValueError):
+            if not done.is_set():
+                interrupted.set()
+                util.interrupt()
+            return
+        for fd in fds:
+            os.close(fd)
+        if message.get("interrupt") and not done.is_set():
+            interrupted.set()
+            util.interrupt()
+
+
+def _run(message: dict, fds: List[int], interrupted: Event) -> int:
+    """
+    Runs a command using the client's current directory, environment
+    variables, arguments and standard streams, then restores them.
+
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    saved_fds = [os.dup(fd) for fd in STDIO]
+    saved_cwd = os.getcwd()
+    saved_env = dict(os.environ)
+    saved_argv = sys.argv
+    saved_modules = set(sys.modules)
+
+    try:
+        for fd, target in zip(fds, STDIO):
+            os.dup2(fd, target)
+
+        # Commands started by this one, such as "pretf output" in another
+        # directory, must not send requests to this daemon, because it
+        # runs one command at a time.
+        env = dict(message["env"])
+        env.pop("PRETF_DAEMON_SOCKET", None)
+        os.environ.clear()
+        os.environ.update(env)
+        sys.argv = message["argv"]
+        os.chdir(message["cwd"])
+
+        _invalidate_modules()
+        util.clear_run_caches()
+
+        # The client may have been interrupted before the command started.
+        if interrupted.is_set():
+            util.interrupt()
+
+        return _main()
+
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in zip(STDIO, saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        sys.argv = saved_argv
+        _stash_project_modules(saved_modules)
+
+
+def _is_running(socket_path: str) -> bool:
+    """
+    Returns True if a daemon is accepting connections on the socket.
+
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def _main() -> int:
+
+    from .cli import main
+
+    try:
+        main()
+    except SystemExit as error:
+        if error.code is None:
+            return 0
+        if isinstance(error.code, int):
+            return error.code
+        print(error.code, file=sys.stderr)
+        return 1
+    return 0
+
+
+def _is_project_file(path: str) -> bool:
+    """
+    Returns True if a file is outside of the Python installation,
+    such as a helper module next to *.tf.py files.
+
+    """
+
+    prefixes = tuple(
+        os.path.join(os.path.realpath(prefix), "")
+        for prefix in {sys.prefix, sys.base_prefix, sys.exec_prefix}
+    )
+    return not os.path.realpath(path).startswith(prefixes)
+
+
+def _stash_project_modules(saved_modules: Set[str]) -> None:
+    """
+    Removes modules that were imported by a command from outside of the
+    Python installation, because different directories can have different
+    modules with the same name. They are kept by file path, so that later
+    commands importing the same files can reuse them if none of them have
+    changed. Modules used by the same command are kept together, because
+    they can refer to each other. Installed packages such as boto3 and
+    jinja2 are kept imported.
+
+    """
+
+    group: Dict[str, Tuple[int, ModuleType]] = {}
+    for reused_group in _reused_groups:
+        group.update(reused_group)
+    _reused_groups.clear()
+
+    for name in set(sys.modules) - saved_modules:
+        if name == "pretf" or name.startswith("pretf."):
+            continue
+        module = sys.modules[name]
+        path = getattr(module, "__file__", None)
+        if path and _is_project_file(path):
+            del sys.modules[name]
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            group[os.path.abspath(path)] = (mtime, module)
+
+    for path in group:
+        _project_modules[path] = group
+
+
+def _is_group_current(group: Dict[str, Tuple[int, ModuleType]]) -> bool:
+    for path, (mtime, _) in group.items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+class _ProjectModuleFinder(MetaPathFinder):
+    """
+    Finds modules outside of the Python installation as usual, but reuses
+    modules that were imported from the same file by a previous command
+    if none of the modules imported by that command have changed since.
+
+    """
+
+    def find_spec(
+        self,
+        fullname: str,
+        path: Optional[Sequence[str]],
+        target: Optional[ModuleType] = None,
+    ) -> Optional[ModuleSpec]:
+        spec = PathFinder.find_spec(fullname, path)
+        if spec is None or not spec.has_location or not spec.origin:
+            return None
+        origin = os.path.abspath(spec.origin)
+        group = _project_modules.get(origin)
+        if group is None:
+            return None
+        if not _is_group_current(group):
+            # Modules can refer to each other, so they are all dropped.
+            for group_path in group:
+                if _project_modules.get(group_path) is group:
+                    del _project_modules[group_path]
+            return None
+        if not any(reused is group for reused in _reused_groups):
+            _reused_groups.append(group)
+        spec.loader = _ReuseModuleLoader(group[origin][1])
+        return spec
+
+
+class _ReuseModuleLoader(Loader):
+    def __init__(self, module: ModuleType) -> None:
+        self.module = module
+
+    def create_module(self, spec: ModuleSpec) -> ModuleType:
+        return self.module
+
+    def exec_module(self, module: Any) -> None:
+        pass
+
+
+def _invalidate_modules() -> None:
+    """
+    Removes modules that have changed since they were imported,
+    so that they are imported again.
+
+    """
+
+    for name, module in list(sys.modules.items()):
+        if name == "pretf" or name.startswith("pretf."):
+            continue
+        path = getattr(module, "__file__", None)
+        if not path:
+            continue
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        if _module_mtimes.setdefault(name, (path, mtime)) != (path, mtime):
+            del sys.modules[name]
+            del _module_mtimes[name]
+
+
+def _receive(sock: socket.socket) -> Tuple[dict, List[int]]:
+    """
+    Receives a message and any file descriptors sent with it.
+
+    """
+
+    fds = array.array("i")
+    data, ancdata, _, _ = sock.recvmsg(
+        65536, socket.CMSG_SPACE(len(STDIO) * fds.itemsize)
+    )
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            end = len(cmsg_data) - (len(cmsg_data) % fds.itemsize)
+            fds.frombytes(cmsg_data[:end])
+
+    buffer = data
+    while True:
+        if len(buffer) >= HEADER.size:
+            (length,) = HEADER.unpack_from(buffer)
+            if len(buffer) >= HEADER.size + length:
+                break
+        chunk = sock.recv(65536)
+        if not chunk:
+            for fd in fds:
+                os.close(fd)
+            raise EOFError()
+        buffer += chunk
+
+    start = HEADER.size
+    end = start + length
+    message = json.loads(buffer[start:end].decode())
+    return message, list(fds)
+
+
+def _send(sock: socket.socket, data: dict, fds: Tuple[int, ...] = ()) -> None:
+    """
+    Sends a message with optional file descriptors.
+
+    """
+
+    payload = json.dumps(data).encode()
+    message = HEADER.pack(len(payload)) + payload
+    ancdata = []
+    if fds:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+    sent = sock.sendmsg([message], ancdata)
+    if sent < len(message):
+        sock.sendall(message[sent:])
+
+
+# The files and modification times of imported modules.
+_module_mtimes: Dict[str, Tuple[str, int]] = {}
+
+# Modules imported from outside of the Python installation by previous
+# commands, by file path. Each file path maps to the modules imported by
+# the same command, with the modification times of their files.
+_project_modules: Dict[str, Dict[str, Tuple[int, ModuleType]]] = {}
+
+# Groups of modules that have been reused by the current command.
+_reused_groups: List[Dict[str, Tuple[int, ModuleType]]] = []
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else os.environ["PRETF_DAEMON_SOCKET"]
+    try:
+        serve(path)
+    except (log.bad, log.ok):
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
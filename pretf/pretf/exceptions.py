@@ -1,32 +1,86 @@
-from collections import defaultdict
+import json
+import os
+from fnmatch import fnmatch
 from os.path import relpath
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Dict, List, Sequence
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
 
 if TYPE_CHECKING:
     from pretf.variables import VariableDefinition, VariableValue  # noqa: F401
 
 
+class DuplicateBlockError(Exception):
+    def __init__(self, address: str, source: Any):
+        self.address = address
+        self.source = source
+
+    def __str__(self) -> str:
+        return f"create: {self.source} cannot define {self.address} more than once"
+
+
 class FunctionNotFoundError(Exception):
     pass
 
 
-class RequiredFilesNotFoundError(Exception):
-    def __init__(self, name_patterns: Sequence[str], root: Path):
-        self.name_patterns = name_patterns
-        self.root = root
+class OutputNotProducedError(AttributeError):
+    def __init__(self, collection: str, name: str):
+        self.collection = collection
+        self.name = name
 
-    def get_candidates(self) -> List[str]:
+    def __str__(self) -> str:
+        return f"collection {self.collection} has not produced output {self.name} yet, it must be yielded before accessing its outputs"
 
-        dirs: Dict[Path, List[str]] = defaultdict(list)
-        for pattern in self.name_patterns:
-            for path in self.root.rglob(pattern):
-                dirs[path.parent].append(pattern)
 
-        matching_dirs = []
-        for path, patterns in dirs.items():
-            if len(patterns) == len(self.name_patterns):
-                matching_dirs.append(path)
+class RequiredFilesNotFoundError(Exception):
+    def __init__(
+        self,
+        name_patterns: Sequence[str],
+        root: Path,
+        cache_path: Optional[Path] = None,
+    ):
+        self.name_patterns = name_patterns
+        self.root = root
+        self.cache_path = cache_path
+
+    def get_candidates(self, max_depth: int = 10) -> List[str]:
+        """
+        Returns directories under the root directory that contain files
+        matching all of the name patterns. Directories named .terraform,
+        hidden directories and directories starting with an underscore
+        are skipped. If a cache path was provided, then previous results
+        are read from and written to that file, and reused until any of
+        the searched directories has been modified.
+
+        """
+
+        cache_key = f"{max_depth} {' '.join(self.name_patterns)}"
+
+        matching_dirs = None
+        if self.cache_path:
+            # Create the cache directory first, so that creating it
+            # does not make the results look out of date.
+            try:
+                self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            except OSError:
+                pass
+            cached = self._read_cache().get(cache_key)
+            if isinstance(cached, dict) and self._is_current(cached.get("mtimes")):
+                matching_dirs = [self.root / name for name in cached["dirs"]]
+
+        if matching_dirs is None:
+            matching_dirs, mtimes = self._find_dirs(max_depth)
+            if self.cache_path:
+                cache = self._read_cache()
+                cache[cache_key] = {
+                    "dirs": [
+                        os.path.relpath(path, self.root) for path in matching_dirs
+                    ],
+                    "mtimes": mtimes,
+                }
+                try:
+                    self.cache_path.write_text(json.dumps(cache, indent=2))
+                except OSError:
+                    pass
 
         relative_paths = []
         for path in sorted(matching_dirs):
@@ -34,6 +88,68 @@ class RequiredFilesNotFoundError(Exception):
 
         return relative_paths
 
+    def _find_dirs(self, max_depth: int) -> Tuple[List[Path], Dict[str, int]]:
+
+        matching_dirs = []
+        mtimes = {}
+
+        # Walk the directory tree once, checking every pattern against
+        # the file names in each directory. The modification time of
+        # each directory is recorded before listing it, so that later
+        # changes can be detected without walking the tree again.
+        stack = [(str(self.root), 0)]
+        while stack:
+            dir_path, depth = stack.pop()
+            names = []
+            try:
+                mtimes[os.path.relpath(dir_path, self.root)] = os.stat(
+                    dir_path
+                ).st_mtime_ns
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        names.append(entry.name)
+                        if depth >= max_depth:
+                            continue
+                        if entry.name.startswith((".", "_")):
+                            continue
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                        except OSError:
+                            is_dir = False
+                        if is_dir:
+                            stack.append((entry.path, depth + 1))
+            except OSError:
+                continue
+            if self._match_names(names):
+                matching_dirs.append(Path(dir_path))
+
+        return matching_dirs, mtimes
+
+    def _is_current(self, mtimes: Optional[Dict[str, int]]) -> bool:
+        if not mtimes:
+            return False
+        for name, mtime in mtimes.items():
+            try:
+                if os.stat(self.root / name).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def _match_names(self, names: List[str]) -> bool:
+        for pattern in self.name_patterns:
+            if not any(fnmatch(name, pattern) for name in names):
+                return False
+        return True
+
+    def _read_cache(self) -> Dict[str, Any]:
+        if self.cache_path:
+            try:
+                return json.loads(self.cache_path.read_text())
+            except (OSError, ValueError):
+                pass
+        return {}
+
 
 class VariableError(Exception):
     def __init__(self) -> None:
@@ -2,9 +2,12 @@ import re
 
 from .blocks import Block
 
+# Runs of invalid characters (and underscores) become a single underscore.
+_invalid = re.compile(r"[^a-zA-Z0-9]+")
+
 
 def clean(label: str) -> str:
-    return re.sub(r"__+", "_", re.sub(r"[^a-zA-Z0-9]", "_", label))
+    return _invalid.sub("_", label)
 
 
 def get(block: Block) -> str:
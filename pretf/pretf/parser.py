@@ -1,7 +1,9 @@
 import json
 import sys
+from copy import deepcopy
 from pathlib import Path
-from typing import Generator, List
+from threading import Lock
+from typing import Dict, Generator, List, Tuple
 
 import hcl2
 
@@ -41,6 +43,31 @@ def parse_hcl2(contents: str) -> dict:
         raise
 
 
+def parse_hcl2_file(path: Path) -> dict:
+    """
+    Parses an HCL2 file. The result is reused until the file changes,
+    which helps long running processes that parse the same files
+    many times.
+
+    """
+
+    stat = path.stat()
+    key = (stat.st_mtime_ns, stat.st_size)
+    name = str(path.resolve())
+    with _parsed_files_lock:
+        cached = _parsed_files.get(name)
+    if cached and cached[0] == key:
+        return deepcopy(cached[1])
+    result = parse_hcl2(path.read_text())
+    with _parsed_files_lock:
+        _parsed_files[name] = (key, result)
+    return deepcopy(result)
+
+
+_parsed_files: Dict[str, Tuple[Tuple[int, int], dict]] = {}
+_parsed_files_lock = Lock()
+
+
 def parse_json_file_for_blocks(path: Path) -> List[dict]:
 
     with open(path) as open_file:
@@ -1,19 +1,33 @@
+import asyncio
 import inspect
 import os
 from collections.abc import Iterable
 from functools import lru_cache
 from pathlib import Path, PurePath
-from threading import Thread
-from typing import Any, Callable, Dict, Generator, List, Optional, Union
+from threading import Lock, Thread
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import jinja2
 
 from . import log
 from .blocks import Block, Interpolated
-from .exceptions import FunctionNotFoundError
+from .exceptions import DuplicateBlockError, FunctionNotFoundError
 from .parser import parse_hcl2
 from .util import find_workflow_path, import_file
 from .variables import (
+    AsyncVariableProxy,
     TerraformVariableStore,
     VariableProxy,
     VariableValue,
@@ -43,8 +57,69 @@ class PathProxy:
             return self.cwd
 
 
+# The number of labels to merge for each block type when coalescing blocks.
+# Terraform's JSON syntax allows these to be nested in a single object.
+# Other block types (e.g. provider, terraform) are left as they are.
+COALESCE_DEPTHS = {
+    "data": 2,
+    "locals": 1,
+    "module": 1,
+    "output": 1,
+    "resource": 2,
+    "variable": 1,
+}
+
+
+def coalesce_blocks(blocks: List[dict], source: Any = None) -> List[dict]:
+    """
+    Merges blocks of the same type into a single object, so that 1000
+    resources are written as one "resource" object rather than 1000
+    separate objects that each repeat the wrappers. Duplicate names
+    raise a DuplicateBlockError. The order of blocks and names is
+    preserved, so the output is deterministic.
+
+    """
+
+    merged: Dict[str, dict] = {}
+    result: List[dict] = []
+
+    for block in blocks:
+        other = {}
+        for block_type, body in block.items():
+            depth = COALESCE_DEPTHS.get(block_type)
+            if depth is None or not isinstance(body, dict):
+                other[block_type] = body
+                continue
+            if not merged:
+                result.append(merged)
+            target = merged.setdefault(block_type, {})
+            _merge_labels(target, body, depth, [block_type], source)
+        if other:
+            result.append(other)
+
+    return result
+
+
+def _merge_labels(
+    target: dict, body: dict, depth: int, address: List[str], source: Any
+) -> None:
+    for label, value in body.items():
+        if depth > 1 and isinstance(value, dict):
+            _merge_labels(
+                target.setdefault(label, {}),
+                value,
+                depth - 1,
+                address + [label],
+                source,
+            )
+        elif label in target:
+            raise DuplicateBlockError(".".join(address + [label]), source)
+        else:
+            target[label] = value
+
+
 def render_files(
-    files_to_create: Dict[Path, Path],
+    files_to_create: Dict[Path, Path], coalesce: bool = False
 ) -> Dict[Path, Union[dict, List[dict]]]:
 
     variables = TerraformVariableStore(files_to_create=files_to_create)
@@ -58,12 +133,14 @@ def render_files(
                 source_path=source_path,
                 target_path=target_path,
                 variables=variables,
+                coalesce=coalesce,
             )
         elif source_path.name.endswith(".py"):
             thread = RenderPythonThread(
                 source_path=source_path,
                 target_path=target_path,
                 variables=variables,
+                coalesce=coalesce,
             )
         else:
             raise ValueError(source_path)
@@ -91,9 +168,11 @@ class RenderThread(Thread):
         source_path: Path,
         target_path: Path,
         variables: TerraformVariableStore,
+        coalesce: bool = False,
     ):
         super().__init__()
 
+        self.coalesce = coalesce
         self.source_path = source_path
         self.target_path = target_path
         self.target_name = target_path.name
@@ -110,6 +189,8 @@ class RenderThread(Thread):
                 for name, value in block.items():
                     merged[name] = value
             return merged
+        elif self.coalesce:
+            return coalesce_blocks(self.blocks, source=self.source_path)
         else:
             return self.blocks
 
@@ -148,8 +229,7 @@ class RenderThread(Thread):
 class RenderJinjaThread(RenderThread):
     def render(self) -> Generator[dict, None, None]:
 
-        template_string = self.source_path.read_text()
-        template = jinja2.Template(template_string)
+        template = _get_template(self.source_path)
         rendered = template.render(
             path=PathProxy(),
             terraform=TerraformProxy(),
@@ -165,6 +245,31 @@ class RenderJinjaThread(RenderThread):
         yield block
 
 
+def _get_template(path: Path) -> jinja2.Template:
+    """
+    Returns a compiled Jinja2 template. It is reused until the file
+    changes, which helps long running processes that render the same
+    files many times.
+
+    """
+
+    stat = path.stat()
+    key = (stat.st_mtime_ns, stat.st_size)
+    name = str(path.resolve())
+    with _templates_lock:
+        cached = _templates.get(name)
+    if cached and cached[0] == key:
+        return cached[1]
+    template = jinja2.Template(path.read_text())
+    with _templates_lock:
+        _templates[name] = (key, template)
+    return template
+
+
+_templates: Dict[str, Tuple[Tuple[int, int], jinja2.Template]] = {}
+_templates_lock = Lock()
+
+
 class RenderPythonThread(RenderThread):
     def render(self) -> Generator[dict, None, None]:
 
@@ -189,27 +294,98 @@ class RenderPythonThread(RenderThread):
                 func=getattr(module, func_name), var=var_proxy
             )
 
-        # Process each yielded block.
-        while True:
+        # Async functions run on the shared event loop.
+        if inspect.iscoroutine(self.gen):
+            self.gen = _coroutine_blocks(self.gen)
+        if inspect.isasyncgen(self.gen):
+            self.gen = _async_generator_blocks(self.gen)
 
-            try:
-                yielded = self.gen.send(return_value)
-            except StopIteration:
+        # Process each yielded block. The generator is closed afterwards,
+        # so that async generators are closed while the event loop is
+        # running rather than whenever they are garbage collected.
+        try:
+            while True:
+
+                try:
+                    yielded = self.gen.send(return_value)
+                except StopIteration:
+                    break
+
+                return_value = yielded
+
+                if self.is_tfvars:
+                    if not isinstance(yielded, dict):
+                        raise TypeError(
+                            f"expected dict to be yielded but got {repr(yielded)}"
+                        )
+                    self.process_tfvars_dict(yielded)
+                    yield yielded
+                else:
+                    for block in unwrap_yielded(yielded):
+                        self.process_tf_block(block)
+                        yield block
+        finally:
+            self.gen.close()
+
+
+async def _coroutine_blocks(coro: Awaitable) -> AsyncGenerator:
+    """
+    Yields the return value of an async function that returns blocks
+    rather than yielding them.
+
+    """
+
+    result = await coro
+    if result is not None:
+        yield result
+
+
+def _async_generator_blocks(agen: AsyncGenerator[Any, Any]) -> Generator:
+    """
+    Drives an async generator on the shared event loop,
+    so it can be used like a regular generator.
+
+    """
+
+    value = None
+    try:
+        while True:
+            done, yielded = _run_async(_async_send(agen, value))
+            if done:
                 break
+            value = yield yielded
+    finally:
+        _run_async(agen.aclose())
 
-            return_value = yielded
 
-            if self.is_tfvars:
-                if not isinstance(yielded, dict):
-                    raise TypeError(
-                        f"expected dict to be yielded but got {repr(yielded)}"
-                    )
-                self.process_tfvars_dict(yielded)
-                yield yielded
-            else:
-                for block in unwrap_yielded(yielded):
-                    self.process_tf_block(block)
-                    yield block
+async def _async_send(agen: AsyncGenerator[Any, Any], value: Any) -> Tuple[bool, Any]:
+    try:
+        return False, await agen.asend(value)
+    except StopAsyncIteration:
+        return True, None
+
+
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns an event loop running in a background thread. It is shared
+    by all render threads so that I/O in async functions can overlap.
+
+    """
+
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            Thread(target=_event_loop.run_forever, daemon=True).start()
+    return _event_loop
+
+
+def _run_async(coro: Coroutine) -> Any:
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop()).result()
+
+
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+_event_loop_lock = Lock()
 
 
 class TerraformProxy:
@@ -236,7 +412,10 @@ def call_pretf_function(
     if "terraform" in sig.parameters:
         kwargs["terraform"] = TerraformProxy()
     if "var" in sig.parameters and var is not None:
-        kwargs["var"] = var
+        if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
+            kwargs["var"] = AsyncVariableProxy(var)
+        else:
+            kwargs["var"] = var
     return func(**kwargs)
 
 
@@ -250,7 +429,7 @@ def unwrap_yielded(
     yielded: Union[Block, dict, Iterable], **kwargs: Any
 ) -> Generator[dict, None, None]:
     if isinstance(yielded, Block):
-        yield dict(iter(yielded))
+        yield yielded._to_dict()
     elif isinstance(yielded, dict):
         yield yielded
     else:
@@ -0,0 +1,150 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence
+
+
+def get_local_state_path(path: Path) -> Optional[Path]:
+    """
+    Returns the path to the state file for a directory if it is using
+    local state, or None if it is using a remote backend.
+
+    """
+
+    workspace = get_workspace(path)
+
+    # Terraform saves the backend configuration after "terraform init".
+    backend_path = path / ".terraform" / "terraform.tfstate"
+    try:
+        backend_config = json.loads(backend_path.read_text())
+    except FileNotFoundError:
+        backend = None
+    except (OSError, ValueError):
+        # The backend is unknown, so the state cannot be read directly.
+        return None
+    else:
+        backend = backend_config.get("backend")
+
+    if backend and backend.get("type") != "local":
+        return None
+
+    config = (backend or {}).get("config") or {}
+
+    if workspace == "default":
+        state_path = config.get("path") or "terraform.tfstate"
+        return path / state_path
+    else:
+        workspace_dir = config.get("workspace_dir") or "terraform.tfstate.d"
+        return path / workspace_dir / workspace / "terraform.tfstate"
+
+
+def get_state_outputs(state_path: Path) -> Optional[dict]:
+    """
+    Returns the outputs from a state file, in the same format as
+    "terraform output -json", or None if it does not exist or cannot
+    be read. Terraform can leave empty state files behind, for example
+    after migrating state to a remote backend.
+
+    """
+
+    try:
+        values = read_json_keys(state_path, ["outputs"])
+    except (OSError, ValueError):
+        return None
+    return values.get("outputs") or {}
+
+
+def get_workspace(path: Path) -> str:
+    """
+    Returns the selected Terraform workspace for a directory.
+
+    """
+
+    workspace = os.getenv("TF_WORKSPACE")
+    if not workspace:
+        try:
+            workspace = (path / ".terraform" / "environment").read_text().strip()
+        except FileNotFoundError:
+            workspace = "default"
+    return workspace
+
+
+def read_json_keys(
+    path: Path, keys: Sequence[str], chunk_size: int = 65536
+) -> Dict[str, Any]:
+    """
+    Reads the specified top-level keys from a file containing a JSON
+    object. The file is read in chunks and it stops reading as soon as
+    all keys have been found, so large values after them (such as the
+    resources in a state file) are never read or parsed.
+
+    """
+
+    decoder = json.JSONDecoder()
+    remaining = set(keys)
+    result: Dict[str, Any] = {}
+
+    with open(path) as open_file:
+
+        buffer = ""
+        pos = 0
+        eof = False
+
+        def read_more() -> None:
+            nonlocal buffer, pos, eof, chunk_size
+            chunk = open_file.read(chunk_size)
+            if chunk:
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                # Read bigger chunks when values span many chunks.
+                chunk_size *= 2
+            else:
+                eof = True
+
+        def next_char() -> str:
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer):
+                    return buffer[pos]
+                if eof:
+                    raise ValueError(f"unexpected end of file: {path}")
+                read_more()
+
+        def decode() -> Any:
+            nonlocal pos
+            while True:
+                next_char()
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                else:
+                    # A value at the end of the buffer might be incomplete,
+                    # such as a number that continues in the next chunk.
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return value
+                read_more()
+
+        if next_char() != "{":
+            raise ValueError(f"expected JSON object: {path}")
+        pos += 1
+
+        while remaining:
+            if next_char() == "}":
+                break
+            key = decode()
+            if next_char() != ":":
+                raise ValueError(f"expected ':' after {key!r}: {path}")
+            pos += 1
+            value = decode()
+            if key in remaining:
+                result[key] = value
+                remaining.discard(key)
+            if next_char() == ",":
+                pos += 1
+
+    return result
@@ -1,29 +1,459 @@
+import hashlib
+import inspect
+import json
 import os
+import re
 import shlex
+import signal
 import sys
+import tempfile
+import time
 from contextlib import contextmanager
-from fnmatch import fnmatch
+from fnmatch import translate
 from importlib.abc import Loader
 from importlib.machinery import ModuleSpec
 from importlib.util import module_from_spec, spec_from_file_location
 from io import StringIO
 from pathlib import Path, PurePath
 from subprocess import PIPE, CalledProcessError, CompletedProcess, Popen
-from threading import Thread
+from threading import Event, Lock, Thread
 from types import ModuleType
 from typing import (
     IO,
+    Any,
     BinaryIO,
+    Callable,
+    Dict,
     Generator,
     List,
+    NamedTuple,
     Optional,
+    Pattern,
     Sequence,
+    Set,
     TextIO,
     Tuple,
     Union,
 )
+from weakref import WeakSet
 
 from . import log
+from .state import get_workspace
+
+
+class CacheFile:
+    """
+    A JSON file for caching the result of a function between Pretf runs.
+    Cached data is only used if it was saved in the same Terraform
+    workspace, less than ttl seconds ago, and the file containing
+    the function has not been modified since.
+
+    """
+
+    def __init__(self, path: Union[PurePath, str], source: str, ttl: float) -> None:
+        self.path = path
+        self.ttl = ttl
+        try:
+            self.source_mtime: Optional[float] = os.path.getmtime(source)
+        except OSError:
+            self.source_mtime = None
+        self.workspace = get_workspace(Path.cwd())
+
+    def load(self) -> Optional[dict]:
+        """
+        Returns the cached data, or None if it is missing or not valid.
+
+        """
+
+        data = read_json_file(self.path)
+        if (
+            isinstance(data, dict)
+            and data.get("workspace") == self.workspace
+            and data.get("source_mtime") == self.source_mtime
+            and time.time() - data.get("time", 0) < self.ttl
+        ):
+            return data
+        return None
+
+    def save(self, data: dict, default: Optional[Callable] = None) -> None:
+        """
+        Saves data to the cache file, ignoring errors.
+
+        """
+
+        data = dict(
+            data,
+            workspace=self.workspace,
+            source_mtime=self.source_mtime,
+            time=time.time(),
+        )
+        try:
+            write_json_file(self.path, data, default=default)
+        except (OSError, TypeError, ValueError):
+            pass
+
+
+class DirectoryEntry(NamedTuple):
+    name: str
+    is_dir: bool
+    is_symlink: bool
+
+
+class DirectoryIndex:
+    """
+    Caches directory listings for the duration of a Pretf run, so that
+    the same directory is only listed once no matter how many workflow
+    steps need it. Workflow steps update the index when they create or
+    delete files. Listings are checked against the modification time of
+    the directory, so changes made elsewhere are seen too.
+
+    """
+
+    def __init__(self) -> None:
+        self._dirs: Dict[str, Tuple[int, Dict[str, DirectoryEntry]]] = {}
+        self._lock = Lock()
+
+    def _entries(self, path: Union[PurePath, str]) -> Dict[str, DirectoryEntry]:
+        key = os.path.abspath(path)
+        mtime = os.stat(key).st_mtime_ns
+        with self._lock:
+            cached = self._dirs.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        entries = {}
+        with os.scandir(key) as it:
+            for dir_entry in it:
+                entries[dir_entry.name] = DirectoryEntry(
+                    name=dir_entry.name,
+                    is_dir=dir_entry.is_dir(),
+                    is_symlink=dir_entry.is_symlink(),
+                )
+        with self._lock:
+            self._dirs[key] = (mtime, entries)
+        return entries
+
+    def _update(self, path: Union[PurePath, str], exists: bool) -> None:
+        key = os.path.abspath(path)
+        parent, name = os.path.split(key)
+        with self._lock:
+            cached = self._dirs.pop(parent, None)
+        if cached is None:
+            return
+        try:
+            mtime = os.stat(parent).st_mtime_ns
+        except OSError:
+            return
+        entries = cached[1]
+        if exists:
+            entries[name] = DirectoryEntry(
+                name=name,
+                is_dir=os.path.isdir(key),
+                is_symlink=os.path.islink(key),
+            )
+        else:
+            entries.pop(name, None)
+        with self._lock:
+            self._dirs[parent] = (mtime, entries)
+
+    def add(self, path: Union[PurePath, str]) -> None:
+        """
+        Updates the index after creating a file, directory or symlink.
+
+        """
+
+        self._update(path, exists=True)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._dirs.clear()
+
+    def iterdir(self, path: Union[Path, str]) -> List[Path]:
+        """
+        Returns the paths in a directory, like Path.iterdir().
+
+        """
+
+        if isinstance(path, str):
+            path = Path(path)
+        return [path / name for name in self._entries(path)]
+
+    def lookup(self, path: Union[PurePath, str]) -> Optional[DirectoryEntry]:
+        """
+        Returns the entry for a path, or None if it does not exist.
+        Symlinks are not followed, so broken symlinks are returned too.
+
+        """
+
+        parent, name = os.path.split(os.path.abspath(path))
+        try:
+            entries = self._entries(parent)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return entries.get(name)
+
+    def remove(self, path: Union[PurePath, str]) -> None:
+        """
+        Updates the index after deleting a file, directory or symlink.
+
+        """
+
+        self._update(path, exists=False)
+
+    def scandir(self, path: Union[PurePath, str]) -> List[DirectoryEntry]:
+        """
+        Returns the entries in a directory, like os.scandir().
+
+        """
+
+        return list(self._entries(path).values())
+
+
+directory_index = DirectoryIndex()
+
+
+class PathMatcher:
+    """
+    Matches paths against multiple glob patterns in a single pass.
+
+    Patterns are split into a literal base directory and the remaining
+    path components. Patterns with the same base directory are matched
+    together while walking it once with the directory index, and only
+    descending into directories that some pattern can still match.
+    Directories with names matching an exclude pattern are not searched
+    by wildcards.
+
+    """
+
+    def __init__(
+        self, path_patterns: Sequence[str], exclude_name_patterns: Sequence[str] = []
+    ) -> None:
+
+        flags = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+
+        if exclude_name_patterns:
+            self._exclude: Optional[Pattern] = re.compile(
+                "|".join(f"(?:{translate(p)})" for p in exclude_name_patterns), flags
+            )
+        else:
+            self._exclude = None
+
+        # Group the patterns by base directory.
+        self._patterns: List[_CompiledPattern] = []
+        self._bases: Dict[Tuple[str, ...], List[int]] = {}
+        for pattern in path_patterns:
+            parts = pattern.split("/")
+            base: List[str] = []
+            if pattern.startswith("/"):
+                base.append("/")
+            parts = [part for part in parts if part]
+            while parts and not _is_wildcard(parts[0]):
+                base.append(parts.pop(0))
+            components: List[Optional[Pattern]] = []
+            for part in parts:
+                if part == "**":
+                    components.append(None)
+                else:
+                    components.append(re.compile(translate(part), flags))
+            index = len(self._patterns)
+            self._patterns.append(
+                _CompiledPattern(
+                    components=components,
+                    dir_only=pattern.endswith("/"),
+                    wildcards=[_is_wildcard(part) for part in parts],
+                )
+            )
+            self._bases.setdefault(tuple(base), []).append(index)
+
+    def _is_excluded(self, name: str) -> bool:
+        return bool(self._exclude and self._exclude.match(name))
+
+    def find(self, cwd: Path) -> List[Path]:
+
+        matches: List[List[Path]] = [[] for _ in self._patterns]
+
+        for base_parts, indexes in self._bases.items():
+            base_path = cwd.joinpath(*base_parts)
+            literal = [i for i in indexes if not self._patterns[i].components]
+            if literal:
+                # Patterns without wildcards only need to exist.
+                if os.path.exists(base_path) and not self._is_excluded(base_path.name):
+                    for i in literal:
+                        if not self._patterns[i].dir_only or base_path.is_dir():
+                            matches[i].append(base_path)
+            states = [(i, 0) for i in indexes if self._patterns[i].components]
+            if states:
+                self._walk(base_path, states, matches)
+
+        results = []
+        seen = set()
+        for paths in matches:
+            for path in paths:
+                if path not in seen:
+                    seen.add(path)
+                    results.append(path)
+        return results
+
+    def _walk(
+        self,
+        base_path: Path,
+        states: List[Tuple[int, int]],
+        matches: List[List[Path]],
+    ) -> None:
+
+        stack = [(base_path, states)]
+        while stack:
+            dir_path, dir_states = stack.pop()
+
+            # Expand "**" components to also match zero directories.
+            expanded: Dict[Tuple[int, int], None] = {}
+            pending = list(dir_states)
+            while pending:
+                state = pending.pop(0)
+                if state in expanded:
+                    continue
+                expanded[state] = None
+                i, pos = state
+                components = self._patterns[i].components
+                if components[pos] is None:
+                    if pos + 1 == len(components):
+                        matches[i].append(dir_path)
+                    else:
+                        pending.append((i, pos + 1))
+
+            try:
+                entries = directory_index.scandir(dir_path)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+
+            children = []
+            for entry in entries:
+                child_states: Dict[Tuple[int, int], None] = {}
+                for i, pos in expanded:
+                    pattern = self._patterns[i]
+                    component = pattern.components[pos]
+                    if component is None:
+                        # Directories matching "**" are walked into,
+                        # and a trailing "**" matches them there.
+                        if (
+                            entry.is_dir
+                            and not entry.is_symlink
+                            and not self._is_excluded(entry.name)
+                        ):
+                            child_states[(i, pos)] = None
+                    elif component.match(entry.name):
+                        if pos + 1 == len(pattern.components):
+                            if pattern.dir_only and not entry.is_dir:
+                                continue
+                            if not self._is_excluded(entry.name):
+                                matches[i].append(dir_path / entry.name)
+                        elif entry.is_dir:
+                            if pattern.wildcards[pos] and self._is_excluded(entry.name):
+                                continue
+                            child_states[(i, pos + 1)] = None
+                if child_states:
+                    children.append((dir_path / entry.name, list(child_states)))
+
+            # Walk subdirectories in order.
+            stack.extend(reversed(children))
+
+
+class SingleFlight:
+    """
+    Calls functions once per key at a time. Threads calling with a key
+    that is already in progress wait for it and share its result. If
+    cache_results is enabled then results are kept and shared with later
+    calls too, until the cache is cleared. Cached results are cleared by
+    clear_run_caches() unless per_run is disabled.
+
+    """
+
+    def __init__(self, cache_results: bool = False, per_run: bool = True) -> None:
+        self._cache_results = cache_results
+        self._calls: Dict[Any, _Call] = {}
+        self._results: Dict[Any, Any] = {}
+        self._lock = Lock()
+        if cache_results and per_run:
+            _run_caches.add(self)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._results.clear()
+
+    def do(self, key: Any, func: Callable, *args: Any, **kwargs: Any) -> Any:
+
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+            call = self._calls.get(key)
+            if call:
+                owner = False
+            else:
+                call = self._calls[key] = _Call()
+                owner = True
+
+        if not owner:
+            call.event.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if self._cache_results and not call.error:
+                    self._results[key] = call.result
+            call.event.set()
+
+        return call.result
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.event = Event()
+        self.error: Optional[BaseException] = None
+        self.result: Any = None
+
+
+class _CompiledPattern(NamedTuple):
+    components: List[Optional[Pattern]]
+    dir_only: bool
+    wildcards: List[bool]
+
+
+def clear_run_caches() -> None:
+    """
+    Clears values that are shared for the duration of a Pretf run,
+    so that a long running process can perform multiple runs.
+
+    """
+
+    directory_index.clear()
+    _interrupted.clear()
+    for cache in list(_run_caches):
+        cache.clear()
+    for clear in _run_cache_clear_functions:
+        clear()
+
+
+def register_run_cache(clear: Callable[[], None]) -> None:
+    """
+    Registers a function that clears a cache when clear_run_caches()
+    is called, for caches that are not SingleFlight instances.
+
+    """
+
+    _run_cache_clear_functions.append(clear)
+
+
+# SingleFlight instances with results shared for the duration of a Pretf run,
+# and functions that clear other caches.
+_run_caches: "WeakSet[SingleFlight]" = WeakSet()
+_run_cache_clear_functions: List[Callable[[], None]] = []
 
 
 def execute(
@@ -55,25 +485,28 @@ def execute(
     if is_verbose(verbose):
         log.ok(f"run: {' '.join(shlex.quote(arg) for arg in args)}")
 
-    if capture:
-        return _execute_and_capture(file, args, cwd, env, verbose)
-    else:
-        return _execute(file, args, cwd, env)
+    try:
+        if capture:
+            return _execute_and_capture(file, args, cwd, env, verbose)
+        else:
+            return _execute(file, args, cwd, env)
+    finally:
+        # The command may have changed any files.
+        directory_index.clear()
 
 
 def _execute(
     file: str, args: Sequence[str], cwd: Optional[Union[Path, str]], env: dict
 ) -> CompletedProcess:
 
-    proc = Popen(args, executable=file, cwd=cwd, env=env)
-
-    while True:
-        try:
-            returncode = proc.wait()
-        except KeyboardInterrupt:
-            pass
-        else:
-            break
+    with _start_process(args, executable=file, cwd=cwd, env=env) as proc:
+        while True:
+            try:
+                returncode = proc.wait()
+            except KeyboardInterrupt:
+                pass
+            else:
+                break
 
     if returncode != 0:
         raise CalledProcessError(
@@ -95,25 +528,27 @@ def _execute_and_capture(
     stdout_buffer = StringIO()
     stderr_buffer = StringIO()
 
-    proc = Popen(args, executable=file, stdout=PIPE, stderr=PIPE, cwd=cwd, env=env)
-
-    stdout_args: List[Optional[IO]] = [proc.stdout, stdout_buffer]
-    if is_verbose(verbose):
-        stdout_args.append(sys.stdout)
-    stdout_thread = Thread(target=_fan_out, args=stdout_args)
-    stdout_thread.start()
-
-    stderr_args = [proc.stderr, stderr_buffer, sys.stderr]
-    stderr_thread = Thread(target=_fan_out, args=stderr_args)
-    stderr_thread.start()
-
-    while True:
-        try:
-            returncode = proc.wait()
-        except KeyboardInterrupt:
-            pass
-        else:
-            break
+    with _start_process(
+        args, executable=file, stdout=PIPE, stderr=PIPE, cwd=cwd, env=env
+    ) as proc:
+
+        stdout_args: List[Optional[IO]] = [proc.stdout, stdout_buffer]
+        if is_verbose(verbose):
+            stdout_args.append(sys.stdout)
+        stdout_thread = Thread(target=_fan_out, args=stdout_args)
+        stdout_thread.start()
+
+        stderr_args = [proc.stderr, stderr_buffer, sys.stderr]
+        stderr_thread = Thread(target=_fan_out, args=stderr_args)
+        stderr_thread.start()
+
+        while True:
+            try:
+                returncode = proc.wait()
+            except KeyboardInterrupt:
+                pass
+            else:
+                break
 
     stdout_thread.join()
     stderr_thread.join()
@@ -137,6 +572,33 @@ def _execute_and_capture(
     )
 
 
+@contextmanager
+def _start_process(args: Sequence[str], **kwargs: Any) -> Generator[Popen, None, None]:
+    """
+    Starts a process and keeps track of it until it has finished,
+    so that interrupt() can send it a signal.
+
+    """
+
+    with _processes_lock:
+        if _interrupted.is_set():
+            raise KeyboardInterrupt()
+        proc = Popen(args, **kwargs)
+        _processes.add(proc)
+    try:
+        yield proc
+    finally:
+        with _processes_lock:
+            _processes.discard(proc)
+
+
+# Processes started by execute() that have not finished yet,
+# and whether interrupt() has been called during this run.
+_processes: Set[Popen] = set()
+_processes_lock = Lock()
+_interrupted = Event()
+
+
 def _fan_out(input_steam: BinaryIO, *output_streams: TextIO) -> None:
     while True:
         char = input_steam.read(1).decode()
@@ -152,19 +614,27 @@ def find_paths(
     exclude_name_patterns: Sequence[str] = [],
     cwd: Optional[Union[Path, str]] = None,
 ) -> Generator[Path, None, None]:
+    """
+    Finds paths matching the glob patterns, excluding paths with names
+    matching the exclude patterns. All patterns are compiled into one
+    PathMatcher which walks each directory once. Matches are returned
+    in the order of the patterns, without duplicates.
+
+    """
 
     if cwd is None:
         cwd = Path.cwd()
     elif isinstance(cwd, str):
         cwd = Path(cwd)
 
-    for pattern in path_patterns:
-        for path in cwd.glob(pattern):
-            for exclude_name_pattern in exclude_name_patterns:
-                if fnmatch(path.name, exclude_name_pattern):
-                    break
-            else:
-                yield path
+    matcher = PathMatcher(
+        path_patterns=path_patterns, exclude_name_patterns=exclude_name_patterns
+    )
+    yield from matcher.find(cwd)
+
+
+def _is_wildcard(pattern: str) -> bool:
+    return "*" in pattern or "?" in pattern or "[" in pattern
 
 
 def find_workflow_path(cwd: Optional[Union[Path, str]] = None) -> Optional[Path]:
@@ -188,6 +658,33 @@ def find_workflow_path(cwd: Optional[Union[Path, str]] = None) -> Optional[Path]
     return None
 
 
+def get_source_file(func: Callable) -> str:
+    """
+    Returns the path to the file containing a function. Functions without
+    a source file, such as builtins, return their module name instead.
+
+    """
+
+    try:
+        return inspect.getfile(func)
+    except TypeError:
+        return func.__module__
+
+
+def hash_json(data: Any, default: Optional[Callable] = None) -> Optional[str]:
+    """
+    Returns a stable hash of data that can be represented as JSON,
+    or None if it cannot. Used for cache keys.
+
+    """
+
+    try:
+        dumped = json.dumps(data, sort_keys=True, default=default)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha256(dumped.encode()).hexdigest()
+
+
 @contextmanager
 def import_file(path: Union[PurePath, str]) -> Generator[ModuleType, None, None]:
     """
@@ -221,6 +718,33 @@ def import_file(path: Union[PurePath, str]) -> Generator[ModuleType, None, None]
             sys.path.remove(pathdir)
 
 
+def interrupt() -> None:
+    """
+    Sends SIGINT to processes started by execute(), as if Ctrl-C had been
+    pressed in their terminal, and stops execute() from starting any more
+    processes for the rest of this run.
+
+    """
+
+    with _processes_lock:
+        _interrupted.set()
+        for proc in _processes:
+            proc.send_signal(signal.SIGINT)
+
+
+def is_json_stable(value: Any) -> bool:
+    """
+    Returns True if a value can be saved as JSON and loaded again
+    without changing it. Used for deciding which values to cache.
+
+    """
+
+    try:
+        return json.loads(json.dumps(value)) == value
+    except (TypeError, ValueError):
+        return False
+
+
 def is_verbose(verbose: Optional[bool], default: bool = True) -> bool:
     if verbose is not None:
         return verbose
@@ -258,3 +782,39 @@ def parse_args() -> Tuple[str, List[str]]:
             options.append(token)
 
     return (subcommand, options)
+
+
+def read_json_file(path: Union[PurePath, str]) -> Optional[Any]:
+    """
+    Returns the contents of a JSON file, or None if it does not exist
+    or cannot be parsed. Used for reading cache files.
+
+    """
+
+    try:
+        with open(path) as open_file:
+            return json.load(open_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json_file(
+    path: Union[PurePath, str], data: Any, default: Optional[Callable] = None
+) -> None:
+    """
+    Writes a JSON file atomically, readable only by the current user.
+    Creates the parent directory if required. Used for writing cache files.
+
+    """
+
+    dir_path = os.path.dirname(path)
+    os.makedirs(dir_path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as open_file:
+            json.dump(data, open_file, default=default)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -1,9 +1,10 @@
+import asyncio
 import os
 import shlex
 from collections import defaultdict
 from pathlib import Path
 from threading import Event, Lock
-from typing import Any, Dict, Generator, List, Set, Union
+from typing import Any, Awaitable, Dict, Generator, List, Set, Union
 
 from . import log, util
 from .exceptions import (
@@ -14,7 +15,7 @@ from .exceptions import (
 )
 from .parser import (
     parse_environment_variable_for_variables,
-    parse_hcl2,
+    parse_hcl2_file,
     parse_json_file_for_blocks,
 )
 
@@ -33,6 +34,30 @@ class VariableProxy:
     __getitem__ = __getattr__
 
 
+# Python 3.6 does not have asyncio.get_running_loop().
+_get_running_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+
+
+class AsyncVariableProxy:
+    """
+    Used by async functions. Variables are returned as awaitables,
+    so waiting for them does not block the event loop.
+
+    """
+
+    def __init__(self, proxy: VariableProxy):
+        self._proxy = proxy
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._proxy
+
+    def __getattr__(self, name: str) -> Awaitable:
+        loop = _get_running_loop()
+        return loop.run_in_executor(None, getattr, self._proxy, name)
+
+    __getitem__ = __getattr__
+
+
 class VariableStore:
     def __init__(self) -> None:
         self._allow_changes = True
@@ -226,7 +251,7 @@ class TerraformVariableStore(VariableStore):
         target_dir = next(iter(self._files_to_create.keys())).parent
 
         future_files: Set[Path] = set()
-        future_files.update(target_dir.iterdir())
+        future_files.update(util.directory_index.iterdir(target_dir))
         future_files.update(self._files_to_create.keys())
         for path in future_files:
             name = path.name
@@ -384,10 +409,10 @@ def get_variables_from_file(
 ) -> Generator[Union[VariableDefinition, VariableValue], None, None]:
     try:
         if path.name.endswith(".tf"):
-            block = parse_hcl2(path.read_text())
+            block = parse_hcl2_file(path)
             yield from get_variable_definitions_from_block(block, path.name)
         elif path.name.endswith(".tfvars"):
-            block = parse_hcl2(path.read_text())
+            block = parse_hcl2_file(path)
             yield from get_variable_values_from_block(block, path.name)
         elif path.name.endswith(".tf.json"):
             blocks = parse_json_file_for_blocks(path)
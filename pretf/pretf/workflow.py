@@ -3,9 +3,10 @@ import json
 import os
 import shlex
 import sys
+from fnmatch import fnmatch
 from pathlib import Path, PurePath
 from subprocess import CalledProcessError, CompletedProcess
-from typing import Any, Dict, List, Optional, Sequence, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Union
 
 from . import log, util
 from .exceptions import RequiredFilesNotFoundError
@@ -13,6 +14,137 @@ from .render import call_pretf_function, json_default, render_files
 from .util import import_file, is_verbose
 
 
+class LinkChanges(NamedTuple):
+    created: List[Path]
+    deleted: List[Path]
+    unchanged: List[Path]
+
+
+def _get_remote_modules(
+    modules: Dict[str, dict], cache_dir: Path, update: bool
+) -> Dict[str, Path]:
+    """
+    Downloads remote modules into a cache directory with a single
+    "terraform get" command and returns the directory of each module.
+
+    """
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    # Create a Terraform root module in the cache directory
+    # that just references the specified modules.
+    module_config_path = cache_dir / "main.tf.json"
+    module_json = json.dumps([{"module": modules}], indent=2)
+    module_config_path.write_text(module_json)
+
+    # Run "terraform get" to download the modules using Terraform.
+    from .command import TerraformCommand
+
+    terraform_get_args = ["-update"] if update else []
+    TerraformCommand(cwd=cache_dir).get(*terraform_get_args)
+
+    # Get the paths to the modules.
+    module_dirs = {}
+    modules_manifest_path = cache_dir / ".terraform" / "modules" / "modules.json"
+    modules_manifest = json.loads(modules_manifest_path.read_text())
+    for module in modules_manifest["Modules"]:
+        if module["Key"] in modules:
+            module_dirs[module["Key"]] = cache_dir / module["Dir"]
+
+    for module_name in modules:
+        if module_name not in module_dirs:
+            raise log.bad(f"module: {module_name} not found in {modules_manifest_path}")
+
+    return module_dirs
+
+
+def _get_links(
+    path_patterns: Sequence[Union[Path, str]],
+    exclude_name_patterns: Sequence[str],
+    cwd: Path,
+    caller_directory: Path,
+) -> Dict[Path, str]:
+    """
+    Returns a map of symlink paths to relative paths of the files and
+    directories matching the source patterns. File name patterns (no
+    slashes) are matched in the parent directories of the working
+    directory up to the caller directory, listing each directory once.
+
+    """
+
+    # Start a list of source paths to symlink into the working directory.
+    paths: List[Path] = []
+
+    # Separate the path patterns into file name patterns (no slashes)
+    # and ones that represent relative paths (can be absolute too).
+    name_patterns: List[str] = []
+    relative_patterns: List[str] = []
+    for value in path_patterns:
+        if isinstance(value, Path):
+            # Use Path objects directly.
+            paths.append(value)
+        elif isinstance(value, str):
+            if "/" in value:
+                relative_patterns.append(value)
+            else:
+                name_patterns.append(value)
+        else:
+            raise TypeError(value)
+
+    # Find paths relative to the working directory (can be absolute too).
+    if relative_patterns:
+        paths.extend(
+            util.find_paths(
+                path_patterns=relative_patterns,
+                exclude_name_patterns=exclude_name_patterns,
+                cwd=cwd,
+            )
+        )
+
+    # Find files in parent directories of the working directory up to
+    # the directory with the pretf.workflow.py file that called this.
+    # Each directory is listed once and checked against all patterns.
+    if name_patterns:
+        here = cwd.parent
+        while True:
+            try:
+                here.relative_to(caller_directory)
+            except ValueError:
+                break
+            else:
+                for path in sorted(util.directory_index.iterdir(here)):
+                    name = path.name
+                    if not any(fnmatch(name, pattern) for pattern in name_patterns):
+                        continue
+                    if any(fnmatch(name, pattern) for pattern in exclude_name_patterns):
+                        continue
+                    paths.append(path)
+                here = here.parent
+
+    # Create a map of symlink paths to original paths.
+    links: Dict[Path, str] = {}
+    for real_path in paths:
+
+        try:
+            cwd.relative_to(os.path.normpath(real_path))
+        except ValueError:
+            is_parent_directory = False
+        else:
+            is_parent_directory = True
+
+        if is_parent_directory:
+            continue
+
+        link_path = cwd / real_path.name
+
+        if link_path in links:
+            continue
+
+        links[link_path] = os.path.relpath(real_path, cwd)
+
+    return links
+
+
 def clean_files(
     paths: Sequence[Path],
     verbose: Optional[bool] = None,
@@ -32,12 +164,14 @@ def clean_files(
             path.unlink()
         except FileNotFoundError:
             pass
+        util.directory_index.remove(path)
 
 
 def create_files(
     target_dir: Union[Path, str] = "",
     source_dirs: Sequence[Union[Path, str]] = [],
     verbose: Optional[bool] = None,
+    coalesce: bool = False,
 ) -> List[Path]:
     """
     Creates rendered files in target_dir from source files in source_dirs.
@@ -64,6 +198,11 @@ def create_files(
     Pretf a different set of files to parse each time it is called,
     resulting in different variables each time.
 
+    If coalesce is True, blocks of the same type in each *.tf.json file
+    are merged into a single object rather than being written separately.
+    This makes files with many blocks smaller and faster for Terraform
+    to read.
+
     """
 
     if isinstance(target_dir, str):
@@ -77,7 +216,7 @@ def create_files(
     for source_dir in source_dirs or ["."]:
         if isinstance(source_dir, str):
             source_dir = Path(source_dir)
-        for source_path in source_dir.iterdir():
+        for source_path in util.directory_index.iterdir(source_dir):
             file_name = source_path.name
             if (
                 file_name.endswith(".tf.j2")
@@ -90,7 +229,7 @@ def create_files(
 
     # Render the JSON data from *.tf.py and *.tfvars.py files.
     if files_to_create:
-        file_contents = render_files(files_to_create)
+        file_contents = render_files(files_to_create, coalesce=coalesce)
     else:
         file_contents = {}
 
@@ -103,6 +242,7 @@ def create_files(
     for output_path, contents in sorted(file_contents.items()):
         with output_path.open("w") as open_file:
             json.dump(contents, open_file, indent=2, default=json_default)
+        util.directory_index.add(output_path)
         created.append(output_path)
 
     return created
@@ -140,6 +280,7 @@ def default(
     clean: bool = True,
     created: list = [],
     verbose: Optional[bool] = None,
+    coalesce: bool = False,
 ) -> CompletedProcess:
     """
     This is the default Pretf workflow. This is automatically used when there
@@ -154,7 +295,7 @@ def default(
 
     # Create *.tf.json and *.tfvars.json files
     # from *.tf.py and *.tfvars.py files.
-    created = created + create_files(verbose=verbose)
+    created = created + create_files(verbose=verbose, coalesce=coalesce)
 
     # Execute Terraform, raising an exception if it fails.
     proc = execute_terraform(verbose=verbose)
@@ -195,7 +336,8 @@ def delete_files(
         cwd=cwd,
     )
     for path in paths:
-        if not path.is_dir():
+        entry = util.directory_index.lookup(path)
+        if entry and not entry.is_dir:
             delete.append(path)
 
     if delete and is_verbose(verbose):
@@ -206,6 +348,7 @@ def delete_files(
     deleted = []
     for path in delete:
         path.unlink()
+        util.directory_index.remove(path)
         deleted.append(path)
 
     return deleted
@@ -227,9 +370,9 @@ def delete_links(
 
     # Find links to delete.
     delete = []
-    for path in cwd.iterdir():
-        if path.is_symlink():
-            delete.append(path)
+    for entry in util.directory_index.scandir(cwd):
+        if entry.is_symlink:
+            delete.append(cwd / entry.name)
 
     if delete and is_verbose(verbose):
         names = [path.name for path in delete]
@@ -239,6 +382,7 @@ def delete_links(
     deleted = []
     for path in delete:
         path.unlink()
+        util.directory_index.remove(path)
         deleted.append(path)
 
     return deleted
@@ -362,79 +506,18 @@ def link_files(
     caller_file = caller_info.filename
     caller_directory = Path(caller_file).parent
 
-    # Start a list of source paths to symlink into the working directory.
-    paths: List[Path] = []
-
-    # Separate the path patterns into file name patterns (no slashes)
-    # and ones that represent relative paths (can be absolute too).
-    name_patterns: List[str] = []
-    relative_patterns: List[str] = []
-    for value in path_patterns:
-        if isinstance(value, Path):
-            # Use Path objects directly.
-            paths.append(value)
-        elif isinstance(value, str):
-            if "/" in value:
-                relative_patterns.append(value)
-            else:
-                name_patterns.append(value)
-        else:
-            raise TypeError(value)
-
-    # Find paths relative to the working directory (can be absolute too).
-    if relative_patterns:
-        paths.extend(
-            util.find_paths(
-                path_patterns=relative_patterns,
-                exclude_name_patterns=exclude_name_patterns,
-                cwd=cwd,
-            )
-        )
-
-    # Find files in parent directories of the working directory up to
-    # the directory with the pretf.workflow.py file that called this.
-    if name_patterns:
-        here = cwd.parent
-        while True:
-            try:
-                here.relative_to(caller_directory)
-            except ValueError:
-                break
-            else:
-                paths.extend(
-                    util.find_paths(
-                        path_patterns=name_patterns,
-                        exclude_name_patterns=exclude_name_patterns,
-                        cwd=here,
-                    )
-                )
-                here = here.parent
-
-    # Create a map of symlink paths to original paths.
+    # Create a map of symlink paths to original paths,
+    # skipping any that already exist.
     create: Dict[Path, str] = {}
-    for real_path in paths:
-
-        try:
-            cwd.relative_to(os.path.normpath(real_path))
-        except ValueError:
-            is_parent_directory = False
-        else:
-            is_parent_directory = True
-
-        if is_parent_directory:
-            continue
-
-        link_path = cwd / real_path.name
-
-        if link_path in create:
-            continue
-
-        if link_path.exists():
-            continue
-
-        relative_path = os.path.relpath(real_path, cwd)
-
-        create[link_path] = relative_path
+    links = _get_links(
+        path_patterns=path_patterns,
+        exclude_name_patterns=exclude_name_patterns,
+        cwd=cwd,
+        caller_directory=caller_directory,
+    )
+    for link_path, relative_path in links.items():
+        if not util.directory_index.lookup(link_path):
+            create[link_path] = relative_path
 
     if create and is_verbose(verbose):
         names = [path.name for path in create.keys()]
@@ -444,6 +527,7 @@ def link_files(
     created = []
     for link_path, relative_path in create.items():
         link_path.symlink_to(relative_path)
+        util.directory_index.add(link_path)
         created.append(link_path)
 
     return created
@@ -498,31 +582,90 @@ def link_module(
             cache_dir = cwd / ".terraform" / "pretf" / module_name
         elif isinstance(cache_dir, str):
             cache_dir = Path(cache_dir)
-        cache_dir.mkdir(parents=True, exist_ok=True)
 
-        # Create a Terraform root module in the cache directory
-        # that just references the specified module.
-        module_config_path = cache_dir / "main.tf.json"
         module_body = {"source": source}
         if version:
             module_body["version"] = version
-        module_json = json.dumps([{"module": {module_name: module_body}}], indent=2)
-        module_config_path.write_text(module_json)
 
-        # Run "terraform get" to download the module using Terraform.
-        from .command import TerraformCommand
+        module_dirs = _get_remote_modules(
+            modules={module_name: module_body},
+            cache_dir=cache_dir,
+            update=update,
+        )
+
+        # Use files from the downloaded module directory.
+        paths.extend(util.find_paths(path_patterns=["*"], cwd=module_dirs[module_name]))
+
+    return link_files(*paths, cwd=cwd, verbose=verbose)
+
 
-        terraform_get_args = ["-update"] if update else []
-        TerraformCommand(cwd=cache_dir).get(*terraform_get_args)
+def link_modules(
+    modules: Sequence[Union[str, dict]],
+    update: bool = False,
+    cache_dir: Optional[Union[Path, str]] = None,
+    cwd: Optional[Union[Path, str]] = None,
+    verbose: Optional[bool] = None,
+) -> List[Path]:
+    """
+    Creates symlinks from all files and directories in multiple modules
+    into the current directory. Modules can be specified as a source
+    string, or a dictionary with "source" and optional "version" keys.
+    Remote modules are downloaded together with a single "terraform get"
+    command in one cache directory.
+
+    """
+
+    if cwd is None:
+        cwd = Path.cwd()
+    elif isinstance(cwd, str):
+        cwd = Path(cwd)
+
+    paths: List[Path] = []
+
+    # Local modules are used directly, remote modules are given
+    # distinct keys in a single Terraform root module.
+    remote_modules: Dict[str, dict] = {}
+    for index, value in enumerate(modules):
 
-        # Get the path to the module.
-        modules_manifest_path = cache_dir / ".terraform" / "modules" / "modules.json"
-        modules_manifest = json.loads(modules_manifest_path.read_text())
-        for module in modules_manifest["Modules"]:
-            if module["Key"] == module_name:
-                module_dir = cache_dir / module["Dir"]
-                # Use files from the downloaded module directory.
-                paths.extend(util.find_paths(path_patterns=["*"], cwd=module_dir))
+        if isinstance(value, str):
+            module_body = {"source": value}
+        elif isinstance(value, dict):
+            module_body = dict(value)
+        else:
+            raise TypeError(value)
+
+        source = module_body["source"]
+        version = module_body.get("version")
+
+        if is_verbose(verbose):
+            if version:
+                log.ok(f"module: {source} {version}")
+            else:
+                log.ok(f"module: {source}")
+
+        if source.startswith(".") or source.startswith("/"):
+            paths.extend(util.find_paths(path_patterns=["*"], cwd=source))
+        else:
+            remote_modules[f"mirror-module-{index}"] = module_body
+
+    if remote_modules:
+
+        # Ensure the module cache directory exists.
+        if cache_dir is None:
+            cache_dir = cwd / ".terraform" / "pretf" / "mirror-modules"
+        elif isinstance(cache_dir, str):
+            cache_dir = Path(cache_dir)
+
+        module_dirs = _get_remote_modules(
+            modules=remote_modules, cache_dir=cache_dir, update=update
+        )
+
+        # Use files from the downloaded module directories,
+        # in the same order that the modules were specified.
+        for module_name in remote_modules:
+            paths.extend(
+                util.find_paths(path_patterns=["*"], cwd=module_dirs[module_name])
+            )
 
     return link_files(*paths, cwd=cwd, verbose=verbose)
 
@@ -548,11 +691,12 @@ def mirror_files(
         cwd = Path(cwd)
 
     # Delete old symlinks.
-    for path in cwd.iterdir():
+    for path in util.directory_index.iterdir(cwd):
         if path.is_symlink():
             if not include_directories and path.is_dir():
                 continue
             path.unlink()
+            util.directory_index.remove(path)
 
     # Find files to mirror.
     create = {}
@@ -593,12 +737,13 @@ def mirror_files(
     created = []
     for link_path, relative_path in create.items():
         link_path.symlink_to(relative_path)
+        util.directory_index.add(link_path)
         created.append(link_path)
 
     return created
 
 
-def require_files(*name_patterns: str) -> None:
+def require_files(*name_patterns: str, cache: bool = False) -> None:
     """
     Raises an exception if the specified files are not found in the current
     directory. Pretf will catch this exception, display an error message,
@@ -610,13 +755,18 @@ def require_files(*name_patterns: str) -> None:
     If multiple patterns are provided, the directory must contain
     files that match all patterns (performing an AND search).
 
+    If cache is enabled, the directories that do contain the files are
+    saved in .terraform/pretf/candidates.json in the directory of the
+    calling pretf.workflow.py file, and reused for later error messages
+    until any of the searched directories are modified.
+
     """
 
     cwd = Path.cwd()
 
     matches = 0
     for pattern in name_patterns:
-        if list(cwd.glob(pattern)):
+        if any(util.find_paths(path_patterns=[pattern], cwd=cwd)):
             matches += 1
 
     if matches == len(name_patterns):
@@ -634,7 +784,98 @@ def require_files(*name_patterns: str) -> None:
     caller_file = caller_info.filename
     caller_directory = Path(caller_file).parent
 
-    raise RequiredFilesNotFoundError(name_patterns=name_patterns, root=caller_directory)
+    if cache:
+        cache_path: Optional[Path] = (
+            caller_directory / ".terraform" / "pretf" / "candidates.json"
+        )
+    else:
+        cache_path = None
+
+    raise RequiredFilesNotFoundError(
+        name_patterns=name_patterns, root=caller_directory, cache_path=cache_path
+    )
+
+
+def sync_links(
+    *path_patterns: Union[Path, str],
+    exclude_name_patterns: Sequence[str] = [".*", "_*", "pretf.workflow.py"],
+    cwd: Optional[Union[Path, str]] = None,
+    verbose: Optional[bool] = None,
+) -> LinkChanges:
+    """
+    Reconciles symlinks in the current directory with the files and
+    directories matching the source patterns. Missing symlinks are
+    created, stale symlinks are deleted, and correct symlinks are left
+    untouched. This is an alternative to calling delete_links() and
+    link_files() which recreates every symlink on every run.
+
+    """
+
+    if cwd is None:
+        cwd = Path.cwd()
+    elif isinstance(cwd, str):
+        cwd = Path(cwd)
+
+    # Find the calling directory of this function, usually the directory
+    # containing the pretf.workflow.py file that has called this function.
+    frame = inspect.currentframe()
+    if not frame:
+        raise Exception("workflow: sync_links() called from unknown frame")
+    caller_frame = frame.f_back
+    if not caller_frame:
+        raise Exception("workflow: sync_links() called from unknown caller")
+    caller_info = inspect.getframeinfo(caller_frame)
+    caller_file = caller_info.filename
+    caller_directory = Path(caller_file).parent
+
+    links = _get_links(
+        path_patterns=path_patterns,
+        exclude_name_patterns=exclude_name_patterns,
+        cwd=cwd,
+        caller_directory=caller_directory,
+    )
+
+    # Compare existing symlinks with the desired symlinks.
+    delete = []
+    unchanged = []
+    for entry in sorted(util.directory_index.scandir(cwd)):
+        if entry.is_symlink:
+            path = cwd / entry.name
+            if links.get(path) == os.readlink(path):
+                unchanged.append(path)
+            else:
+                delete.append(path)
+
+    # Create symlinks that are missing or pointing somewhere else,
+    # skipping any paths that are regular files or directories.
+    create: Dict[Path, str] = {}
+    for link_path, relative_path in links.items():
+        if link_path in delete or not util.directory_index.lookup(link_path):
+            create[link_path] = relative_path
+
+    if delete and is_verbose(verbose):
+        names = [path.name for path in delete]
+        log.ok(f"unlink: {' '.join(sorted(names))}")
+
+    if create and is_verbose(verbose):
+        names = [path.name for path in create.keys()]
+        log.ok(f"link: {' '.join(sorted(names))}")
+
+    # Delete stale symlinks.
+    deleted = []
+    for path in delete:
+        path.unlink()
+        util.directory_index.remove(path)
+        deleted.append(path)
+
+    # Create new symlinks.
+    created = []
+    for link_path, relative_path in create.items():
+        link_path.symlink_to(relative_path)
+        util.directory_index.add(link_path)
+        created.append(link_path)
+
+    return LinkChanges(created=created, deleted=deleted, unchanged=unchanged)
 
 
 __all__ = [
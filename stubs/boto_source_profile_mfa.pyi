@@ -1,5 +1,9 @@
-from typing import Any
+from typing import Any, Callable, Optional
 
 import boto3
 
-def get_session(**kwargs: Any) -> boto3.Session: ...
+def get_session(
+    profile_name: Optional[str] = ...,
+    mfa_prompter: Callable[[str], str] = ...,
+    **kwargs: Any
+) -> boto3.Session: ...
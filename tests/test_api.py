@@ -1,6 +1,25 @@
+import json
+import threading
+
 import pytest
 
-from pretf.api import block
+from pretf import api
+from pretf.api import (
+    block,
+    bulk_block,
+    cached,
+    get_outputs,
+    get_outputs_many,
+    labels,
+)
+from pretf.command import PretfCommand
+from pretf.exceptions import DuplicateBlockError
+
+
+@pytest.fixture(autouse=True)
+def clear_outputs():
+    api._cached.clear()
+    api._outputs.clear()
 
 
 @pytest.mark.parametrize(
@@ -26,3 +45,201 @@ from pretf.api import block
 )
 def test_block(obj, expected):
     assert str(obj) == expected
+
+
+def test_bulk_block():
+    objects = bulk_block(
+        "resource",
+        "aws_s3_bucket_object",
+        items=["files/a.txt", "files/b.txt"],
+        body=lambda path: {"key": path},
+    )
+    assert dict(list(objects)) == {
+        "resource": {
+            "aws_s3_bucket_object": {
+                "files_a_txt": {"key": "files/a.txt"},
+                "files_b_txt": {"key": "files/b.txt"},
+            }
+        }
+    }
+
+    outputs = bulk_block(
+        "output", items={"one": 1, "two": 2}, body=lambda value: {"value": value}
+    )
+    assert dict(list(outputs)) == {"output": {"one": {"value": 1}, "two": {"value": 2}}}
+
+    variables = bulk_block("variable", items=["a-b"], body={}, clean=False)
+    assert dict(list(variables)) == {"variable": {"a-b": {}}}
+
+    with pytest.raises(DuplicateBlockError) as error:
+        bulk_block("variable", items=["a.b", "a-b"], body={})
+    assert error.value.address == "variable.a_b"
+
+
+lookups = []
+lookup_barrier = threading.Barrier(4, timeout=5)
+
+
+@cached
+def find_ami(name, owner="self"):
+    lookups.append(name)
+    return f"ami-{name}"
+
+
+@cached(cache_ttl=60)
+def find_vpc(name):
+    lookups.append(name)
+    return {"id": f"vpc-{name}"}
+
+
+def test_cached(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    lookups.clear()
+
+    # Calls from different threads share the result.
+    def lookup():
+        lookup_barrier.wait()
+        return find_ami("web")
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert find_ami("web") == "ami-web"
+    assert lookups == ["web"]
+
+    # Different arguments are looked up separately.
+    assert find_ami("web", owner="amazon") == "ami-web"
+    assert lookups == ["web", "web"]
+
+    # Values are cached on disk with cache_ttl.
+    assert find_vpc("main") == {"id": "vpc-main"}
+    api._cached.clear()
+    assert find_vpc("main") == {"id": "vpc-main"}
+    assert lookups == ["web", "web", "main"]
+    assert len(list((tmp_path / ".terraform" / "pretf" / "cached").iterdir())) == 1
+
+    # Functions without a source file can be cached too.
+    assert cached(sorted)([2, 1]) == [1, 2]
+    assert cached(sorted, cache_ttl=60)([4, 3]) == [3, 4]
+
+    with pytest.raises(TypeError):
+
+        @cached
+        async def lookup_async():
+            pass
+
+
+def test_labels_clean():
+    assert labels.clean("files/a.txt") == "files_a_txt"
+    assert labels.clean("a__b--c") == "a_b_c"
+    assert labels.clean("abc") == "abc"
+
+
+def write_state(path, serial, outputs):
+    state = {
+        "version": 4,
+        "terraform_version": "1.1.0",
+        "serial": serial,
+        "lineage": "abc",
+        "outputs": {
+            name: {"value": value, "type": "string"} for name, value in outputs.items()
+        },
+        "resources": [],
+    }
+    (path / "terraform.tfstate").write_text(json.dumps(state))
+
+
+def test_get_outputs_local_state(tmp_path, monkeypatch):
+
+    calls = []
+
+    def output(self):
+        calls.append(self.cwd)
+        return {}
+
+    monkeypatch.setattr(PretfCommand, "output", output)
+    monkeypatch.delenv("TF_WORKSPACE", raising=False)
+
+    # Local state is read directly without running Pretf.
+    write_state(tmp_path, 1, {"vpc_id": "vpc-1"})
+    assert get_outputs(tmp_path, verbose=False) == {"vpc_id": "vpc-1"}
+
+    write_state(tmp_path, 2, {"vpc_id": "vpc-2"})
+    api._outputs.clear()
+    assert get_outputs(tmp_path, verbose=False) == {"vpc_id": "vpc-2"}
+
+    # Pretf runs if there is no local state yet.
+    (tmp_path / "terraform.tfstate").unlink()
+    api._outputs.clear()
+    assert get_outputs(tmp_path, verbose=False) == {}
+
+    # Or if the state file is empty or partly written.
+    for contents in ("", '{"version": 4, "outputs": {'):
+        (tmp_path / "terraform.tfstate").write_text(contents)
+        api._outputs.clear()
+        assert get_outputs(tmp_path, verbose=False) == {}
+
+    assert len(calls) == 3
+
+
+def test_get_outputs_cache_ttl(tmp_path, monkeypatch):
+
+    calls = []
+
+    def output(self):
+        calls.append(self.cwd)
+        return {"vpc_id": {"value": "vpc-1"}}
+
+    monkeypatch.setattr(PretfCommand, "output", output)
+
+    # Remote state is only cached when there is a TTL.
+    (tmp_path / ".terraform").mkdir()
+    (tmp_path / ".terraform" / "terraform.tfstate").write_text(
+        json.dumps({"backend": {"type": "s3", "config": {}}})
+    )
+
+    get_outputs(tmp_path, verbose=False)
+    api._outputs.clear()
+    get_outputs(tmp_path, verbose=False)
+    api._outputs.clear()
+    assert len(calls) == 2
+
+    get_outputs(tmp_path, verbose=False, cache_ttl=60)
+    api._outputs.clear()
+    get_outputs(tmp_path, verbose=False, cache_ttl=60)
+    assert len(calls) == 3
+
+
+def test_get_outputs_many(tmp_path, monkeypatch):
+
+    calls = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(3, timeout=5)
+
+    def output(self):
+        with lock:
+            calls.append(self.cwd.name)
+        # All directories are requested at the same time.
+        barrier.wait()
+        return {"name": {"value": self.cwd.name}}
+
+    monkeypatch.setattr(PretfCommand, "output", output)
+
+    for name in ("a", "b", "c"):
+        (tmp_path / name).mkdir()
+
+    paths = [str(tmp_path / name) for name in ("a", "b", "c", "a")]
+    result = get_outputs_many(paths, verbose=False)
+    assert result == {
+        str(tmp_path / "a"): {"name": "a"},
+        str(tmp_path / "b"): {"name": "b"},
+        str(tmp_path / "c"): {"name": "c"},
+    }
+    assert sorted(calls) == ["a", "b", "c"]
+
+    # Results are shared with get_outputs() for the rest of the run.
+    assert get_outputs(tmp_path / "b", verbose=False) == {"name": "b"}
+    assert len(calls) == 3
@@ -0,0 +1,717 @@
+import gc
+import json
+import os
+import stat
+import subprocess
+import sys
+import threading
+import time
+import types
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from pretf import aws, util
+
+
+class FakeCredentials:
+    def __init__(self, on_resolve=None):
+        self.access_key = "AKIASOURCE"
+        self.secret_key = "secret"
+        self.token = "token"
+        self.method = "assume-role"
+        self.on_resolve = on_resolve
+        self._expiry_time = datetime(2030, 1, 1, tzinfo=timezone.utc)
+
+    def get_frozen_credentials(self):
+        if self.on_resolve:
+            self.on_resolve()
+        return self
+
+
+class FakeSTSClient:
+    def __init__(self, session):
+        self.session = session
+
+    def get_caller_identity(self):
+        self.session.calls.append("get_caller_identity")
+        self.session.barrier.wait()
+        return {"Account": "123456789012"}
+
+    def assume_role(self, **kwargs):
+        self.session.calls.append("assume_role")
+        expiration = datetime.now(timezone.utc) + self.session.duration
+        return {
+            "Credentials": {
+                "AccessKeyId": f"AKIAROLE{len(self.session.calls)}",
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": expiration,
+            }
+        }
+
+
+class FakeS3Client:
+    def __init__(self, session):
+        self.session = session
+
+    def get_bucket_versioning(self, Bucket):
+        self.session.calls.append("get_bucket_versioning")
+        self.session.barrier.wait()
+        return {"Status": "Enabled"}
+
+
+class FakeDynamoDBClient:
+    class exceptions:
+        class ResourceNotFoundException(Exception):
+            pass
+
+    def __init__(self, session):
+        self.session = session
+
+    def describe_table(self, TableName):
+        self.session.calls.append("describe_table")
+        self.session.barrier.wait()
+        if not self.session.table_exists:
+            raise self.exceptions.ResourceNotFoundException()
+        return {}
+
+
+class FakeCloudFormationClient:
+    def __init__(self, session):
+        self.session = session
+        self.events = []
+        self.steps = list(session.stack_steps)
+
+    def create_stack(self, StackName, **kwargs):
+        self.session.calls.append("create_stack")
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        if NextToken is None:
+            self.session.calls.append("describe_stack_events")
+            if self.steps:
+                for status in self.steps.pop(0):
+                    self.events.insert(0, self.create_event(StackName, status))
+        # Return 2 events per page, newest first.
+        start = int(NextToken or 0)
+        end = start + 2
+        response = {"StackEvents": self.events[start:end]}
+        if end < len(self.events):
+            response["NextToken"] = str(end)
+        return response
+
+    def create_event(self, stack_name, status):
+        logical_id, status = status.split(" ")
+        return {
+            "EventId": str(len(self.events)),
+            "LogicalResourceId": logical_id,
+            "ResourceStatus": status,
+            "ResourceType": (
+                "AWS::CloudFormation::Stack"
+                if logical_id == stack_name
+                else "AWS::S3::Bucket"
+            ),
+        }
+
+
+class FakeBotocoreSession:
+    def __init__(self):
+        self.scoped_config = {}
+
+    def get_scoped_config(self):
+        return self.scoped_config
+
+
+class FakeSession:
+    def __init__(self, barrier=None, on_resolve=None):
+        self._session = FakeBotocoreSession()
+        self.barrier = barrier or threading.Barrier(1)
+        self.calls = []
+        self.clients = []
+        self.duration = timedelta(hours=1)
+        self.credentials = FakeCredentials(on_resolve)
+        self.profile_name = "default"
+        self.region_name = "eu-west-1"
+        self.table_exists = True
+        self.stack_steps = []
+
+    def client(self, service_name, **kwargs):
+        self.clients.append(service_name)
+        clients = {
+            "cloudformation": FakeCloudFormationClient,
+            "dynamodb": FakeDynamoDBClient,
+            "s3": FakeS3Client,
+            "sts": FakeSTSClient,
+        }
+        return clients[service_name](self)
+
+    def get_credentials(self):
+        return self.credentials
+
+
+@pytest.fixture(autouse=True)
+def clear_caches(tmp_path, monkeypatch):
+    monkeypatch.delenv("PRETF_AWS_CACHE", raising=False)
+    monkeypatch.setenv("PRETF_AWS_CACHE_DIR", str(tmp_path / "cache"))
+    aws._account_ids.clear()
+    aws._assumed_roles.clear()
+
+
+def test_get_account_id_concurrent():
+
+    # Resolving credentials holds the lock, but the API call does not,
+    # so threads using different sessions can make calls concurrently.
+    # The barrier would time out if the calls were made one at a time.
+    barrier = threading.Barrier(2, timeout=5)
+    sessions = [FakeSession(barrier=barrier) for _ in range(2)]
+    results = []
+
+    def target(session):
+        results.append(aws.get_account_id(session))
+
+    threads = [threading.Thread(target=target, args=(s,)) for s in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["123456789012", "123456789012"]
+    assert sessions[0].calls == ["get_caller_identity"]
+    assert sessions[1].calls == ["get_caller_identity"]
+
+    # The result is shared for the rest of the run.
+    assert aws.get_account_id(sessions[0]) == "123456789012"
+    assert sessions[0].calls == ["get_caller_identity"]
+
+
+def test_resolve_credentials_locked():
+
+    held = []
+
+    def on_resolve():
+        held.append(aws._get_credential_lock(session)._is_owned())
+        held.append(aws.lock._is_owned())
+
+    session = FakeSession(on_resolve=on_resolve)
+
+    aws.get_account_id(session)
+
+    # The session's credential lock is held, but not the prompt lock.
+    assert held == [True, False]
+
+
+def test_resolve_credentials_concurrent():
+
+    # Credentials for different sessions are resolved concurrently.
+    # The barrier would time out if they were resolved one at a time.
+    barrier = threading.Barrier(2, timeout=5)
+    sessions = [FakeSession(on_resolve=barrier.wait) for _ in range(2)]
+
+    threads = [
+        threading.Thread(target=aws._resolve_credentials, args=(s,)) for s in sessions
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not barrier.broken
+
+
+def test_profile_lock_keys(tmp_path, monkeypatch):
+
+    config_path = tmp_path / "config"
+    config_path.write_text(
+        "[profile source]\n"
+        "[profile nonprod]\n"
+        "role_arn = arn:aws:iam::111111111111:role/example\n"
+        "source_profile = source\n"
+        "mfa_serial = arn:aws:iam::000000000000:mfa/example\n"
+        "[profile prod]\n"
+        "role_arn = arn:aws:iam::222222222222:role/example\n"
+        "source_profile = source\n"
+        "mfa_serial = arn:aws:iam::000000000000:mfa/example\n"
+        "[profile other]\n"
+    )
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(config_path))
+    monkeypatch.setattr(aws, "use_boto_source_profile_mfa", False)
+    aws._sessions.clear()
+
+    # Profiles using MFA with the same source profile share a lock,
+    # so that only one of them will prompt for an MFA token.
+    nonprod = aws.get_session(profile_name="nonprod")
+    prod = aws.get_session(profile_name="prod")
+    other = aws.get_session(profile_name="other")
+    assert aws._get_credential_lock(nonprod) is aws._get_credential_lock(prod)
+    assert aws._get_credential_lock(nonprod) is not aws._get_credential_lock(other)
+
+    aws._sessions.clear()
+
+
+def test_prompt(monkeypatch):
+
+    held = []
+
+    def getpass(prompt):
+        held.append(aws.lock._is_owned())
+        return "123456"
+
+    monkeypatch.setattr(aws, "getpass", getpass)
+
+    assert aws._prompt("Enter MFA code: ") == "123456"
+    assert held == [True]
+
+
+def test_create_profile_session_mfa_prompter(tmp_path, monkeypatch):
+
+    config_path = tmp_path / "config"
+    config_path.write_text("[profile example]\n")
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(config_path))
+
+    # MFA prompts from boto-source-profile-mfa use the prompt lock.
+    calls = []
+
+    def get_session(profile_name=None, mfa_prompter=None, **kwargs):
+        from boto3 import Session
+
+        calls.append((profile_name, mfa_prompter))
+        return Session(profile_name=profile_name, **kwargs)
+
+    module = types.ModuleType("boto_source_profile_mfa")
+    module.get_session = get_session
+    monkeypatch.setitem(sys.modules, "boto_source_profile_mfa", module)
+    monkeypatch.setattr(aws, "use_boto_source_profile_mfa", True)
+
+    session = aws._create_profile_session(profile_name="example")
+    assert calls == [("example", aws._prompt)]
+
+    # So do MFA prompts from boto3 for profiles that assume roles.
+    credential_resolver = session._session.get_component("credential_provider")
+    assume_role_provider = credential_resolver.get_provider("assume-role")
+    assert assume_role_provider._prompter is aws._prompt
+
+
+def test_assume_role_cache(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("PRETF_AWS_CACHE", "1")
+
+    session = FakeSession()
+    role = aws._assume_role(session, RoleArn="arn:aws:iam::123456789012:role/test")
+    assert role.get_credentials().access_key == "AKIAROLE1"
+    assert session.calls == ["assume_role"]
+
+    # The credentials are cached in files that only the user can read.
+    for path in (tmp_path / "cache").iterdir():
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    # Another run uses the cached credentials.
+    aws._assumed_roles.clear()
+    role = aws._assume_role(session, RoleArn="arn:aws:iam::123456789012:role/test")
+    assert role.get_credentials().access_key == "AKIAROLE1"
+    assert session.calls == ["assume_role"]
+
+    # A different role is not affected.
+    role = aws._assume_role(session, RoleArn="arn:aws:iam::123456789012:role/other")
+    assert role.get_credentials().access_key == "AKIAROLE2"
+    assert session.calls == ["assume_role", "assume_role"]
+
+
+def test_assume_role_cache_refresh(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("PRETF_AWS_CACHE", "1")
+
+    # Credentials that will expire soon are refreshed.
+    session = FakeSession()
+    session.duration = timedelta(minutes=5)
+    aws._assume_role(session, RoleArn="arn:aws:iam::123456789012:role/test")
+    aws._assumed_roles.clear()
+    role = aws._assume_role(session, RoleArn="arn:aws:iam::123456789012:role/test")
+    assert role.get_credentials().access_key == "AKIAROLE2"
+    assert session.calls == ["assume_role", "assume_role"]
+
+
+def test_assume_role_cache_disabled(tmp_path):
+
+    session = FakeSession()
+    aws._assume_role(session, RoleArn="arn:aws:iam::123456789012:role/test")
+    aws._assumed_roles.clear()
+    aws._assume_role(session, RoleArn="arn:aws:iam::123456789012:role/test")
+    assert session.calls == ["assume_role", "assume_role"]
+    assert not (tmp_path / "cache").exists()
+
+
+def test_get_account_id_cache(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("PRETF_AWS_CACHE", "1")
+
+    session = FakeSession()
+    assert aws.get_account_id(session) == "123456789012"
+    aws._account_ids.clear()
+    assert aws.get_account_id(FakeSession()) == "123456789012"
+    assert session.calls == ["get_caller_identity"]
+
+
+def test_terraform_backend_s3_verified(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+
+    session = FakeSession()
+    monkeypatch.setattr(aws, "get_session", lambda **kwargs: session)
+    monkeypatch.delenv("AWS_ACCESS_KEY_ID", raising=False)
+
+    # The bucket and table are checked at the same time.
+    # The barrier would time out if they were checked one at a time.
+    session.barrier = threading.Barrier(2, timeout=5)
+    backend = aws.terraform_backend_s3(bucket="bucket", dynamodb_table="table")
+    assert dict(list(backend))["terraform"]["backend"]["s3"]["bucket"] == "bucket"
+    assert sorted(session.calls) == ["describe_table", "get_bucket_versioning"]
+
+    # Warm runs skip checking the backend resources,
+    # without looking up the account ID.
+    session.barrier = threading.Barrier(1)
+    session.calls.clear()
+    aws._account_ids.clear()
+    aws.terraform_backend_s3(bucket="bucket", dynamodb_table="table")
+    assert session.calls == []
+
+    # Changes to the profile configuration are checked again.
+    session._session.scoped_config = {"role_arn": "arn:aws:iam::1:role/other"}
+    aws.terraform_backend_s3(bucket="bucket", dynamodb_table="table")
+    assert sorted(session.calls) == ["describe_table", "get_bucket_versioning"]
+    session.calls.clear()
+
+    # Different credentials are checked separately.
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "AKIAEXAMPLE")
+    aws.terraform_backend_s3(bucket="bucket", dynamodb_table="table")
+    assert sorted(session.calls) == ["describe_table", "get_bucket_versioning"]
+    session.calls.clear()
+
+    # Verification can be forced.
+    monkeypatch.setenv("PRETF_AWS_VERIFY_BACKEND", "1")
+    aws.terraform_backend_s3(bucket="bucket", dynamodb_table="table")
+    assert sorted(session.calls) == ["describe_table", "get_bucket_versioning"]
+
+
+def test_terraform_backend_s3_incomplete(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+
+    # Failed checks are not recorded, so they are checked again next time.
+    session = FakeSession()
+    session.table_exists = False
+    monkeypatch.setattr(aws, "get_session", lambda **kwargs: session)
+    for _ in range(2):
+        with pytest.raises(SystemExit):
+            aws.terraform_backend_s3(bucket="bucket", dynamodb_table="table")
+    assert session.calls.count("describe_table") == 2
+    assert not (tmp_path / ".terraform" / "pretf" / "s3-backends.json").exists()
+
+
+def test_get_client():
+
+    session = FakeSession()
+    s3_client = aws._get_client(session, "s3")
+    assert aws._get_client(session, "s3") is s3_client
+    assert aws._get_client(session, "s3", "eu-west-1") is not s3_client
+    assert aws._get_client(FakeSession(), "s3") is not s3_client
+    assert session.clients == ["s3", "s3"]
+
+    # API calls reuse clients.
+    aws.get_account_id(session)
+    aws._account_ids.clear()
+    aws.get_account_id(session)
+    assert session.calls == ["get_caller_identity", "get_caller_identity"]
+    assert session.clients == ["s3", "s3", "sts"]
+
+
+def test_credential_locks_released():
+
+    # Locks do not keep sessions alive, and are cleared between runs.
+    gc.collect()
+    counts = (len(aws._session_credential_locks), len(aws._session_lock_keys))
+
+    session = FakeSession()
+    aws._get_credential_lock(session)
+    aws._session_lock_keys[session] = ("profile", "example")
+    aws._get_credential_lock(session)
+    assert session in aws._session_credential_locks
+    assert ("profile", "example") in aws._credential_locks
+
+    del session
+    gc.collect()
+    assert (len(aws._session_credential_locks), len(aws._session_lock_keys)) == counts
+
+    util.clear_run_caches()
+    assert ("profile", "example") not in aws._credential_locks
+
+
+def test_get_session_concurrent(monkeypatch):
+
+    # Threads asking for the same session at the same time share it.
+    created = []
+    barrier = threading.Barrier(4, timeout=5)
+
+    def create_session(**kwargs):
+        created.append(kwargs)
+        return FakeSession()
+
+    monkeypatch.setattr(aws, "_create_profile_session", create_session)
+    aws._sessions.clear()
+
+    sessions = []
+
+    def target():
+        barrier.wait()
+        sessions.append(aws.get_session(region_name="eu-west-1"))
+
+    threads = [threading.Thread(target=target) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(created) == 1
+    assert len(sessions) == 4
+    assert all(session is sessions[0] for session in sessions)
+
+    aws._sessions.clear()
+
+
+def test_clear_run_caches(tmp_path, monkeypatch):
+
+    config_path = tmp_path / "config"
+    config_path.write_text("[profile example]\nregion = eu-west-1\n")
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(config_path))
+    monkeypatch.setattr(aws, "use_boto_source_profile_mfa", False)
+    monkeypatch.delenv("AWS_PROFILE", raising=False)
+    monkeypatch.delenv("AWS_REGION", raising=False)
+    aws._sessions.clear()
+
+    # Account IDs are cleared between runs.
+    session = aws.get_session(profile_name="example")
+    assert aws.get_session(profile_name="example") is session
+    fake_session = FakeSession()
+    client = aws._get_client(fake_session, "sts")
+    aws.get_account_id(fake_session)
+    util.clear_run_caches()
+    assert not aws._account_ids._results
+
+    # Sessions and clients are kept between runs using the same
+    # AWS environment variables and config files.
+    assert aws.get_session(profile_name="example") is session
+    assert aws._get_client(fake_session, "sts") is client
+
+    # But not when the AWS environment changes.
+    monkeypatch.setenv("AWS_PROFILE", "other")
+    other_session = aws.get_session(profile_name="example")
+    assert other_session is not session
+    monkeypatch.setenv("AWS_REGION", "eu-west-2")
+    assert aws._get_client(fake_session, "sts") is not client
+    monkeypatch.delenv("AWS_PROFILE")
+    monkeypatch.delenv("AWS_REGION")
+    assert aws.get_session(profile_name="example") is session
+
+    other_config_path = tmp_path / "other"
+    other_config_path.write_text("[profile example]\nregion = eu-west-2\n")
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(other_config_path))
+    other_session = aws.get_session(profile_name="example")
+    assert other_session is not session
+    assert other_session.region_name == "eu-west-2"
+
+    # Including changes to the AWS config files.
+    time.sleep(0.01)
+    other_config_path.write_text("[profile example]\nregion = eu-west-3\n")
+    assert aws.get_session(profile_name="example").region_name == "eu-west-3"
+
+    aws._sessions.clear()
+
+
+def test_lazy_import():
+
+    # Importing pretf.aws should not import boto3, which is slow.
+    code = "import sys, pretf.aws; print('boto3' in sys.modules)"
+    output = subprocess.check_output([sys.executable, "-c", code])
+    assert output.strip() == b"False"
+
+
+def test_credential_broker(tmp_path, monkeypatch, capsys):
+
+    base_config_path = tmp_path / "config"
+    base_config_path.write_text("[profile example]\nrole_arn = example\n")
+    monkeypatch.delenv("PRETF_AWS_BASE_CONFIG_FILE", raising=False)
+    monkeypatch.delenv("PRETF_AWS_BROKER_SOCKET", raising=False)
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(base_config_path))
+
+    session = FakeSession()
+    monkeypatch.setattr(aws, "get_session", lambda **kwargs: session)
+
+    monkeypatch.setattr(aws, "_broker", None)
+    broker = aws.start_credential_broker()
+    assert os.environ["AWS_CONFIG_FILE"] == broker.config_path
+
+    # Profiles that Terraform may not support use the broker.
+    provider = aws.provider_aws(profile="example")
+    assert dict(list(provider))["provider"]["aws"] == {
+        "profile": "pretf-broker-example"
+    }
+
+    # The broker is only used when the environment points to it,
+    # and starting it again updates the environment.
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(base_config_path))
+    provider = aws.provider_aws(profile="example")
+    assert "profile" not in dict(list(provider))["provider"]["aws"]
+    assert aws.start_credential_broker() is broker
+    assert os.environ["AWS_CONFIG_FILE"] == broker.config_path
+
+    # The generated config file includes the original profiles,
+    # and profiles that get credentials from the broker.
+    with open(broker.config_path) as open_file:
+        config = open_file.read()
+    assert config.startswith("[profile example]\nrole_arn = example\n")
+    assert "[profile pretf-broker-example]\n" in config
+    assert f"-m pretf.aws {broker.socket_path} example\n" in config
+    assert "region = eu-west-1\n" in config
+
+    # The broker serves credentials in the credential_process format.
+    assert aws._credential_process(broker.socket_path, "example") == 0
+    assert json.loads(capsys.readouterr().out) == {
+        "Version": 1,
+        "AccessKeyId": "AKIASOURCE",
+        "SecretAccessKey": "secret",
+        "SessionToken": "token",
+        "Expiration": "2030-01-01T00:00:00+00:00",
+    }
+
+    # Errors are returned to the credential process.
+    monkeypatch.setattr(aws, "get_session", lambda **kwargs: None)
+    assert aws._credential_process(broker.socket_path, "example") == 1
+
+
+def test_credential_broker_shared(tmp_path, monkeypatch):
+
+    base_config_path = tmp_path / "config"
+    base_config_path.write_text("[profile example]\nrole_arn = example\n")
+    monkeypatch.delenv("PRETF_AWS_BASE_CONFIG_FILE", raising=False)
+    monkeypatch.delenv("PRETF_AWS_BROKER_SOCKET", raising=False)
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(base_config_path))
+
+    session = FakeSession()
+    monkeypatch.setattr(aws, "get_session", lambda **kwargs: session)
+
+    monkeypatch.setattr(aws, "_broker", None)
+    broker = aws.start_credential_broker()
+    assert os.environ["PRETF_AWS_BROKER_SOCKET"] == broker.socket_path
+
+    # Child processes use the broker of this process,
+    # and add profiles to its config file.
+    code = (
+        "from pretf import aws\n"
+        "broker = aws.start_credential_broker()\n"
+        "print(broker.is_remote, broker.socket_path)\n"
+        "print(broker.add_profile('example'))\n"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code]).decode()
+    assert output.splitlines() == [
+        f"True {broker.socket_path}",
+        "pretf-broker-example",
+    ]
+    with open(broker.config_path) as open_file:
+        assert "[profile pretf-broker-example]\n" in open_file.read()
+
+    # Sessions for profiles in child processes get credentials from
+    # the broker, so they share its sessions and MFA prompts.
+    created = []
+    monkeypatch.setattr(aws, "_create_session", lambda **kwargs: created.append(kwargs))
+    monkeypatch.setattr(aws, "_broker", aws.CredentialBroker(broker.socket_path))
+    aws._get_session(profile_name="example")
+    assert created == [{"profile_name": "pretf-broker-example"}]
+
+
+def test_get_session_cache(tmp_path, monkeypatch):
+
+    expiration = (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat()
+    output = {
+        "Version": 1,
+        "AccessKeyId": "AKIAPROCESS",
+        "SecretAccessKey": "secret",
+        "SessionToken": "token",
+        "Expiration": expiration,
+    }
+    script_path = tmp_path / "credential_process.py"
+    script_path.write_text(f"print({json.dumps(output)!r})\n")
+    config_path = tmp_path / "config"
+    config_path.write_text(
+        "[profile temporary]\n"
+        f"credential_process = {sys.executable} {script_path}\n"
+        "region = eu-west-1\n"
+    )
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(config_path))
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(tmp_path / "credentials"))
+    monkeypatch.setenv("PRETF_AWS_CACHE", "1")
+    monkeypatch.setattr(aws, "use_boto_source_profile_mfa", False)
+
+    aws._sessions.clear()
+    creds = aws.get_frozen_credentials(profile_name="temporary")
+    assert creds.access_key == "AKIAPROCESS"
+
+    # Another run uses the cached credentials without running the process.
+    script_path.write_text("raise SystemExit(1)\n")
+    aws._sessions.clear()
+    session = aws.get_session(profile_name="temporary")
+    assert session.region_name == "eu-west-1"
+    assert aws.get_frozen_credentials(session).access_key == "AKIAPROCESS"
+    aws._sessions.clear()
+
+
+def test_create_s3_backend(monkeypatch):
+
+    delays = []
+    messages = []
+    monkeypatch.setattr(aws, "sleep", delays.append)
+    monkeypatch.setattr(aws.log, "ok", messages.append)
+    monkeypatch.setattr(aws.log, "accept", lambda message: True)
+
+    session = FakeSession()
+    session.stack_steps = [
+        ["test CREATE_IN_PROGRESS"],
+        [],
+        [],
+        ["Bucket CREATE_IN_PROGRESS", "Table CREATE_IN_PROGRESS"],
+        ["Bucket CREATE_COMPLETE", "Table CREATE_COMPLETE", "test CREATE_COMPLETE"],
+    ]
+    aws._create_s3_backend(session, "test", "test", "eu-west-1")
+
+    # Stack events are displayed as they happen.
+    events = [m.split(": ")[-1] for m in messages if m.startswith("backend: test: ")]
+    assert events == [step for steps in session.stack_steps for step in steps]
+
+    # It checks again soon after something happens,
+    # and backs off while nothing is happening.
+    assert delays == [1, 2, 4, 1]
+
+
+def test_create_s3_backend_failed(monkeypatch):
+
+    monkeypatch.setattr(aws, "sleep", lambda delay: None)
+    monkeypatch.setattr(aws.log, "accept", lambda message: True)
+
+    session = FakeSession()
+    session.stack_steps = [
+        ["test CREATE_IN_PROGRESS", "Bucket CREATE_FAILED"],
+        ["test ROLLBACK_IN_PROGRESS"],
+    ]
+    with pytest.raises(SystemExit):
+        aws._create_s3_backend(session, "test", "test", "eu-west-1")
+    assert session.calls.count("describe_stack_events") == 2
+
+
+def test_create_s3_backend_timeout(monkeypatch):
+
+    monkeypatch.setattr(aws, "BACKEND_CREATE_TIMEOUT_SECONDS", 0)
+    monkeypatch.setattr(aws, "sleep", lambda delay: None)
+    monkeypatch.setattr(aws.log, "accept", lambda message: True)
+
+    session = FakeSession()
+    session.stack_steps = [["test CREATE_IN_PROGRESS"]]
+    with pytest.raises(SystemExit):
+        aws._create_s3_backend(session, "test", "test", "eu-west-1")
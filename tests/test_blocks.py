@@ -1,4 +1,17 @@
-from pretf.blocks import data, locals, module, output, provider, resource, variable
+import copy
+
+import pytest
+
+from pretf.blocks import (
+    BlockModule,
+    data,
+    locals,
+    module,
+    output,
+    provider,
+    resource,
+    variable,
+)
 from pretf.render import unwrap_yielded
 
 
@@ -64,6 +77,43 @@ def test_resource():
     assert str(resource.null_resource.test) == "${null_resource.test}"
 
 
+def test_repeated_references(monkeypatch):
+
+    # Repeated references return the same objects.
+    assert resource.aws_s3_bucket is resource.aws_s3_bucket
+    assert resource.aws_s3_bucket.test is resource["aws_s3_bucket"]["test"]
+    assert resource.aws_s3_bucket.test.arn is resource.aws_s3_bucket.test.arn
+    assert locals.test is locals.test
+
+    # Only a limited number of children are remembered.
+    monkeypatch.setattr(BlockModule, "cache_size", 2)
+    block_module = BlockModule("resource", needs=2)
+    one = block_module.one
+    two = block_module.two
+    assert block_module.one is one
+    block_module.three
+    assert block_module.two is two
+    assert block_module.one is not one
+    assert len(block_module._children) == 2
+
+
+def test_serialize():
+    bucket = resource.aws_s3_bucket.test(bucket="test")
+
+    # Blocks do not have instance dicts.
+    with pytest.raises(AttributeError):
+        bucket.__dict__
+
+    # The serialized form is only created once.
+    (serialized,) = unwrap_yielded(bucket)
+    assert serialized == {"resource": {"aws_s3_bucket": {"test": {"bucket": "test"}}}}
+    assert list(unwrap_yielded(bucket))[0] is serialized
+    assert dict(iter(bucket)) == serialized
+
+    # Interpolated values can be copied.
+    assert str(copy.copy(bucket.arn)) == "${aws_s3_bucket.test.arn}"
+
+
 def test_variable():
     assert str(variable) == "<module 'pretf.blocks.variable'>"
     assert str(variable.test) == "${var.test}"
@@ -1,9 +1,14 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
+from pretf import collections
 from pretf.api import block, labels
 from pretf.blocks import Block
 from pretf.collections import collect
-from pretf.exceptions import VariableNotPopulatedError
+from pretf.exceptions import OutputNotProducedError, VariableNotPopulatedError
 
 
 @collect
@@ -145,3 +150,185 @@ def test_nested_collections():
         },
     ]
     assert list(result) == expected
+
+
+calls = []
+
+
+@collect(cache=True)
+def cached_bucket(var):
+    yield block("variable", "name", {})
+    calls.append(var.name)
+    bucket = yield block("resource", "aws_s3_bucket", var.name, {"bucket": var.name})
+    yield block("output", "resource", {"value": bucket})
+
+
+@collect(cache_ttl=60)
+def cached_files(var):
+    yield block("variable", "names", {})
+    calls.append(var.names)
+    for name in var.names:
+        yield block("resource", "aws_s3_bucket_object", name, {"key": name})
+    yield block("output", "total", {"value": len(var.names)})
+
+
+@collect(cache_ttl=60)
+def cached_group(var):
+    yield block("variable", "name", {})
+    calls.append(var.name)
+    group = yield block("resource", "aws_iam_group", var.name, {"name": var.name})
+    yield block("output", "resource", {"value": group})
+
+
+@pytest.fixture
+def clear_collections(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls.clear()
+    collections._collections.clear()
+    yield
+    collections._collections.clear()
+
+
+def test_collect_cache(clear_collections):
+
+    # Calls with the same inputs share the result, including between threads.
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: cached_bucket(name="one"), range(8)))
+    assert calls == ["one"]
+    assert all(result is results[0] for result in results)
+    assert results[0].resource.arn == "${aws_s3_bucket.one.arn}"
+
+    cached_bucket(name="two")
+    assert calls == ["one", "two"]
+
+    # Blocks are hashed by their references.
+    key = collections._get_cache_key(
+        cached_bucket, __file__, {"name": block("resource", "aws_s3_bucket", "x", {})}
+    )
+    assert key == collections._get_cache_key(
+        cached_bucket,
+        __file__,
+        {"name": block("resource", "aws_s3_bucket", "x", {"y": 1})},
+    )
+
+    # Inputs that cannot be hashed are not cached.
+    calls.clear()
+    cached_bucket(name=frozenset("a"))
+    cached_bucket(name=frozenset("a"))
+    assert calls == [frozenset("a"), frozenset("a")]
+
+
+def test_collect_cache_ttl(clear_collections):
+
+    expected = [
+        {"resource": {"aws_s3_bucket_object": {"a": {"key": "a"}}}},
+        {"resource": {"aws_s3_bucket_object": {"b": {"key": "b"}}}},
+    ]
+
+    result = cached_files(names=["a", "b"])
+    assert list(result) == expected
+    assert result.total == 2
+    assert calls == [["a", "b"]]
+
+    # The result is loaded from disk in the next run.
+    collections._collections.clear()
+    result = cached_files(names=["a", "b"])
+    assert list(result) == expected
+    assert result.total == 2
+    assert calls == [["a", "b"]]
+
+    # It is not used after the file containing the function changes.
+    collections._collections.clear()
+    source_mtime = os.path.getmtime(__file__)
+    os.utime(__file__, (source_mtime + 1, source_mtime + 1))
+    try:
+        cached_files(names=["a", "b"])
+    finally:
+        os.utime(__file__, (source_mtime, source_mtime))
+    assert calls == [["a", "b"], ["a", "b"]]
+
+    # Results with outputs that cannot be stored as JSON are not cached on disk.
+    cached_group(name="dogs")
+    collections._collections.clear()
+    assert cached_group(name="dogs").resource.name == "${aws_iam_group.dogs.name}"
+    assert calls[-2:] == ["dogs", "dogs"]
+
+
+@collect(stream=True)
+def streamed_users(var):
+    yield block("variable", "names", {})
+    for name in var.names:
+        calls.append(name)
+        yield block("resource", "aws_iam_user", name, {"name": name})
+    yield block("output", "total", {"value": len(var.names)})
+
+
+@collect
+def streamed_users_total(var):
+    users = yield streamed_users(names=["a", "b"])
+    yield block("output", "total", {"value": users.total})
+
+
+def test_collect_stream(clear_collections):
+
+    users = streamed_users(names=["a", "b"])
+
+    # Outputs cannot be accessed before they are produced.
+    with pytest.raises(OutputNotProducedError):
+        users.total
+
+    # Blocks are produced as the collection is iterated over.
+    blocks = iter(users)
+    assert next(blocks) == {"resource": {"aws_iam_user": {"a": {"name": "a"}}}}
+    assert calls == ["a"]
+    assert next(blocks) == {"resource": {"aws_iam_user": {"b": {"name": "b"}}}}
+    assert list(blocks) == []
+
+    assert users.total == 2
+    with pytest.raises(AttributeError):
+        users.nope
+
+    # It can only be iterated over once.
+    with pytest.raises(RuntimeError):
+        list(users)
+
+    # Outputs are available after the collection has been yielded.
+    assert streamed_users_total().total == 2
+
+    with pytest.raises(ValueError):
+        collect(cache=True, stream=True)
+
+
+barrier = threading.Barrier(3, timeout=5)
+
+
+@collect
+def waiting_user(var):
+    yield block("variable", "name", {})
+    barrier.wait()
+    user = yield block("resource", "aws_iam_user", var.name, {"name": var.name})
+    yield block("output", "resource", {"value": user})
+
+
+@collect
+def waiting_users(var):
+    yield block("variable", "names", {})
+    users = yield collections.parallel(
+        waiting_user, [{"name": name} for name in var.names]
+    )
+    yield block("output", "arns", {"value": [user.resource.arn for user in users]})
+
+
+def test_parallel():
+
+    # The collections run at the same time (or the barrier times out)
+    # and their blocks and outputs are kept in order.
+    users = waiting_users(names=["c", "a", "b"])
+    assert list(users) == [
+        {"resource": {"aws_iam_user": {name: {"name": name}}}} for name in "cab"
+    ]
+    assert users.arns == [f"${{aws_iam_user.{name}.arn}}" for name in "cab"]
+
+    # Errors are raised to the caller.
+    with pytest.raises(VariableNotPopulatedError):
+        collections.parallel(iam_user, [{"name": "a"}, {}])
@@ -0,0 +1,164 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+HELPER = """
+with open("imports.txt", "a") as open_file:
+    open_file.write("{value}\\n")
+
+VALUE = {value}
+"""
+
+WORKFLOW = """
+import os
+import signal
+import sys
+
+import helper
+
+
+def pretf_workflow():
+    print(os.getpid(), os.getcwd(), os.environ["GREETING"], sys.argv[1:], helper.VALUE)
+    return 3
+"""
+
+
+def run_pretf(cwd, socket_path):
+    env = dict(os.environ, GREETING="hello", PRETF_DAEMON_SOCKET=str(socket_path))
+    return subprocess.run(
+        [sys.executable, "-c", "from pretf.cli import main; main()", "plan"],
+        cwd=str(cwd),
+        env=env,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        timeout=30,
+    )
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    socket_path = tmp_path / "pretf.sock"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "pretf.daemon", str(socket_path)],
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while not socket_path.exists():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    yield proc, socket_path
+    proc.terminate()
+    proc.wait(timeout=30)
+
+
+def test_daemon(tmp_path, daemon):
+    proc, socket_path = daemon
+
+    project = tmp_path / "project"
+    project.mkdir()
+    (project / "pretf.workflow.py").write_text(WORKFLOW)
+    (project / "helper.py").write_text(HELPER.format(value=1))
+
+    # The command runs in the daemon, with the client's current directory,
+    # environment variables, arguments and standard streams.
+    result = run_pretf(project, socket_path)
+    assert result.returncode == 3
+    assert result.stdout == f"{proc.pid} {project} hello ['plan'] 1\n"
+
+    # Unchanged modules are reused by the next command.
+    result = run_pretf(project, socket_path)
+    assert result.stdout == f"{proc.pid} {project} hello ['plan'] 1\n"
+    assert (project / "imports.txt").read_text() == "1\n"
+
+    # Modules with the same name in other directories are imported
+    # separately, and then reused too.
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "pretf.workflow.py").write_text(WORKFLOW)
+    (other / "helper.py").write_text(HELPER.format(value=10))
+    for cwd, value in ((other, 10), (project, 1), (other, 10)):
+        result = run_pretf(cwd, socket_path)
+        assert result.stdout == f"{proc.pid} {cwd} hello ['plan'] {value}\n"
+    assert (project / "imports.txt").read_text() == "1\n"
+    assert (other / "imports.txt").read_text() == "10\n"
+
+    # Changes to imported modules are used by the next command.
+    time.sleep(0.01)
+    (project / "helper.py").write_text(HELPER.format(value=2))
+    result = run_pretf(project, socket_path)
+    assert result.returncode == 3
+    assert result.stdout == f"{proc.pid} {project} hello ['plan'] 2\n"
+
+    # Commands run normally when the daemon is not running.
+    result = run_pretf(project, tmp_path / "missing.sock")
+    assert result.returncode == 3
+    assert f"{project} hello ['plan'] 2" in result.stdout
+    assert not result.stdout.startswith(str(proc.pid))
+
+    # Changes to modules imported by other modules are used too.
+    (project / "helper.py").write_text("from helper2 import VALUE\n")
+    (project / "helper2.py").write_text("VALUE = 3\n")
+    result = run_pretf(project, socket_path)
+    assert result.stdout == f"{proc.pid} {project} hello ['plan'] 3\n"
+    for value in (4, 5):
+        time.sleep(0.01)
+        (project / "helper2.py").write_text(f"VALUE = {value}\n")
+        result = run_pretf(project, socket_path)
+        assert result.stdout == f"{proc.pid} {project} hello ['plan'] {value}\n"
+
+
+INTERRUPT_WORKFLOW = """
+import sys
+
+from pretf import util
+
+
+def pretf_workflow():
+    return util.execute(sys.executable, [sys.executable, "child.py"])
+"""
+
+INTERRUPT_CHILD = """
+import signal
+import sys
+import time
+
+signal.signal(signal.SIGINT, lambda *args: sys.exit(5))
+open("started", "w").close()
+time.sleep(30)
+"""
+
+
+def test_daemon_interrupt(tmp_path, daemon):
+    proc, socket_path = daemon
+
+    project = tmp_path / "project"
+    project.mkdir()
+    (project / "pretf.workflow.py").write_text(INTERRUPT_WORKFLOW)
+    (project / "child.py").write_text(INTERRUPT_CHILD)
+
+    # Ctrl-C in the client is passed on to processes started
+    # by the command in the daemon, which then exits normally.
+    env = dict(os.environ, PRETF_DAEMON_SOCKET=str(socket_path))
+    client = subprocess.Popen(
+        [sys.executable, "-c", "from pretf.cli import main; main()", "plan"],
+        cwd=str(project),
+        env=env,
+    )
+    deadline = time.monotonic() + 30
+    while not (project / "started").exists():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    client.send_signal(signal.SIGINT)
+    assert client.wait(timeout=30) == 5
+
+    # The daemon keeps running commands afterwards.
+    (project / "started").unlink()
+    (project / "child.py").write_text("open('started', 'w').close()\n")
+    result = run_pretf(project, socket_path)
+    assert result.returncode == 0
+    assert (project / "started").exists()
+    assert proc.poll() is None
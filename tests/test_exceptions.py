@@ -0,0 +1,62 @@
+import json
+import os
+
+from pretf.exceptions import RequiredFilesNotFoundError
+
+
+def test_required_files_candidates(tmp_path, monkeypatch):
+    for path in (
+        "stacks/iam/dev/dev.auto.tfvars",
+        "stacks/iam/dev/main.tf",
+        "stacks/vpc/prod/prod.auto.tfvars",
+        "stacks/vpc/prod/main.tf",
+        "stacks/vpc/main.tf",
+        "stacks/.terraform/modules/x/x.auto.tfvars",
+        "stacks/.terraform/modules/x/main.tf",
+        "_vendor/y/y.auto.tfvars",
+        "_vendor/y/main.tf",
+    ):
+        path = tmp_path / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+
+    monkeypatch.chdir(tmp_path)
+
+    cache_path = tmp_path / ".terraform" / "pretf" / "candidates.json"
+    error = RequiredFilesNotFoundError(
+        name_patterns=["*.auto.tfvars", "*.tf"],
+        root=tmp_path,
+        cache_path=cache_path,
+    )
+    expected = [
+        os.path.join("stacks", "iam", "dev"),
+        os.path.join("stacks", "vpc", "prod"),
+    ]
+    assert error.get_candidates() == expected
+    assert cache_path.exists()
+
+    # Cached results are used until the directory tree changes.
+    cache = json.loads(cache_path.read_text())
+    for value in cache.values():
+        value["dirs"] = ["cached"]
+    cache_path.write_text(json.dumps(cache))
+    assert error.get_candidates() == ["cached"]
+
+    (tmp_path / "stacks/vpc/prod/prod.auto.tfvars").unlink()
+    assert error.get_candidates() == expected[:1]
+
+    # New directories are found too.
+    for path in ("stacks/s3/dev/dev.auto.tfvars", "stacks/s3/dev/main.tf"):
+        path = tmp_path / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+    assert error.get_candidates() == [
+        os.path.join("stacks", "iam", "dev"),
+        os.path.join("stacks", "s3", "dev"),
+    ]
+
+    # Directories below the maximum depth are not searched.
+    error = RequiredFilesNotFoundError(
+        name_patterns=["*.auto.tfvars", "*.tf"], root=tmp_path
+    )
+    assert error.get_candidates(max_depth=2) == []
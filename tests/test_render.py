@@ -0,0 +1,156 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from pretf import util, workflow
+from pretf.blocks import data, locals, provider, resource
+from pretf.exceptions import DuplicateBlockError
+from pretf.render import coalesce_blocks, unwrap_yielded
+
+
+def render(*blocks):
+    return [serialized for block in blocks for serialized in unwrap_yielded(block)]
+
+
+def test_coalesce_blocks():
+    blocks = render(
+        provider.aws(region="eu-west-1"),
+        resource.aws_s3_bucket.one(bucket="one"),
+        data.aws_caller_identity.current(),
+        resource.aws_s3_bucket.two(bucket="two"),
+        resource.aws_sqs_queue.one(name="one"),
+        locals(a=1),
+        provider.aws(alias="us", region="us-east-1"),
+        locals(b=2),
+    )
+    assert coalesce_blocks(blocks) == [
+        {"provider": {"aws": {"region": "eu-west-1"}}},
+        {
+            "resource": {
+                "aws_s3_bucket": {"one": {"bucket": "one"}, "two": {"bucket": "two"}},
+                "aws_sqs_queue": {"one": {"name": "one"}},
+            },
+            "data": {"aws_caller_identity": {"current": {}}},
+            "locals": {"a": 1, "b": 2},
+        },
+        {"provider": {"aws": {"alias": "us", "region": "us-east-1"}}},
+    ]
+
+    # The original blocks are not modified.
+    assert blocks[1] == {"resource": {"aws_s3_bucket": {"one": {"bucket": "one"}}}}
+
+
+def test_coalesce_blocks_duplicate():
+    blocks = render(
+        resource.aws_s3_bucket.one(bucket="one"),
+        resource.aws_s3_bucket.one(bucket="two"),
+    )
+    with pytest.raises(DuplicateBlockError) as error:
+        coalesce_blocks(blocks, source="main.tf.py")
+    assert error.value.address == "resource.aws_s3_bucket.one"
+    assert str(error.value) == (
+        "create: main.tf.py cannot define resource.aws_s3_bucket.one more than once"
+    )
+
+    blocks = render(locals(a=1), locals(a=2))
+    with pytest.raises(DuplicateBlockError):
+        coalesce_blocks(blocks)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def inventory_url():
+    """
+    Runs a local HTTP server standing in for an inventory service. It only
+    responds after receiving 2 requests at the same time, so requests
+    that do not overlap time out.
+
+    """
+
+    barrier = threading.Barrier(2, timeout=5)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            barrier.wait()
+            body = json.dumps({"name": self.path.strip("/")}).encode()
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+ASYNC_BLOCKS = """
+import asyncio
+import json
+from urllib.request import urlopen
+
+from pretf.api import block
+
+
+async def fetch(url):
+    loop = asyncio.get_event_loop()
+    response = await loop.run_in_executor(None, urlopen, url)
+    return json.loads(response.read())
+
+
+async def pretf_blocks(var):
+    yield block("variable", "url", {})
+    url = await var.url
+    one, two = await asyncio.gather(fetch(url + "/one"), fetch(url + "/two"))
+    bucket = yield block("resource", "aws_s3_bucket", one["name"], {})
+    yield block("resource", "aws_s3_bucket", two["name"], {"policy": bucket.arn})
+"""
+
+ASYNC_VARIABLES = """
+async def pretf_variables():
+    yield {"url": "%s"}
+"""
+
+ASYNC_RETURN = """
+from pretf.api import block
+
+
+async def pretf_blocks():
+    return [block("output", "one", {"value": 1})]
+"""
+
+
+def test_render_async(tmp_path, monkeypatch, inventory_url):
+
+    monkeypatch.chdir(tmp_path)
+
+    (tmp_path / "main.tf.py").write_text(ASYNC_BLOCKS)
+    (tmp_path / "outputs.tf.py").write_text(ASYNC_RETURN)
+    (tmp_path / "terraform.tfvars.py").write_text(ASYNC_VARIABLES % inventory_url)
+
+    util.directory_index.clear()
+    created = workflow.create_files(verbose=False)
+    contents = {path.name: json.loads(path.read_text()) for path in created}
+    assert contents == {
+        "main.tf.json": [
+            {"variable": {"url": {}}},
+            {"resource": {"aws_s3_bucket": {"one": {}}}},
+            {
+                "resource": {
+                    "aws_s3_bucket": {"two": {"policy": "${aws_s3_bucket.one.arn}"}}
+                }
+            },
+        ],
+        "outputs.tf.json": [{"output": {"one": {"value": 1}}}],
+        "terraform.tfvars.json": {"url": inventory_url},
+    }
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from pretf.state import get_local_state_path, read_json_keys
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 65536])
+def test_read_json_keys(tmp_path, chunk_size):
+    path = tmp_path / "terraform.tfstate"
+    data = {
+        "version": 4,
+        "serial": 12345,
+        "lineage": "a-b-c",
+        "outputs": {"list": {"value": [1, 2.5, "x", None, True]}},
+        "resources": [{"name": "r"}],
+    }
+    path.write_text(json.dumps(data, indent=2))
+
+    result = read_json_keys(path, ["serial", "outputs"], chunk_size=chunk_size)
+    assert result == {"serial": 12345, "outputs": data["outputs"]}
+
+    result = read_json_keys(path, ["missing"], chunk_size=chunk_size)
+    assert result == {}
+
+
+def test_read_json_keys_stops_reading(tmp_path):
+    # Everything after the requested key is never parsed.
+    path = tmp_path / "terraform.tfstate"
+    path.write_text('{"outputs": {}, "resources": [not valid json')
+    assert read_json_keys(path, ["outputs"], chunk_size=4) == {"outputs": {}}
+
+
+def test_get_local_state_path(tmp_path, monkeypatch):
+    monkeypatch.delenv("TF_WORKSPACE", raising=False)
+
+    assert get_local_state_path(tmp_path) == tmp_path / "terraform.tfstate"
+
+    (tmp_path / ".terraform").mkdir()
+    (tmp_path / ".terraform" / "environment").write_text("dev")
+    assert get_local_state_path(tmp_path) == (
+        tmp_path / "terraform.tfstate.d" / "dev" / "terraform.tfstate"
+    )
+
+    (tmp_path / ".terraform" / "terraform.tfstate").write_text(
+        json.dumps({"backend": {"type": "s3", "config": {}}})
+    )
+    assert get_local_state_path(tmp_path) is None
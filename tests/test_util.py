@@ -0,0 +1,151 @@
+import os
+import threading
+from pathlib import Path
+
+import pytest
+
+from pretf import util
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for path in (
+        "main.tf",
+        "main.tf.json",
+        ".hidden.tf",
+        "a/one.tf",
+        "a/b/two.tf",
+        "a/b/two.txt",
+        ".terraform/modules/three.tf",
+        "_vendor/four.tf",
+    ):
+        path = tmp_path / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+    util.directory_index.clear()
+    return tmp_path
+
+
+def names(paths, root):
+    return [str(Path(path).relative_to(root)) for path in paths]
+
+
+@pytest.mark.parametrize(
+    "path_patterns,exclude_name_patterns,expected",
+    [
+        (["*.tf"], [], [".hidden.tf", "main.tf"]),
+        (["*.tf"], [".*"], ["main.tf"]),
+        (["*.tf", "*.json", "*.tf"], [], [".hidden.tf", "main.tf", "main.tf.json"]),
+        (["a", "missing"], [], ["a"]),
+        (["a/*/*.tf"], [], ["a/b/two.tf"]),
+        (
+            ["**/*.tf"],
+            [],
+            [
+                ".hidden.tf",
+                ".terraform/modules/three.tf",
+                "_vendor/four.tf",
+                "a/b/two.tf",
+                "a/one.tf",
+                "main.tf",
+            ],
+        ),
+        # Excluded directories are not searched by wildcards.
+        (["**/*.tf"], [".*", "_*"], ["a/b/two.tf", "a/one.tf", "main.tf"]),
+        (["*/*.tf"], ["_*"], ["a/one.tf"]),
+        # But they can be searched explicitly.
+        (["_vendor/*"], ["_*"], ["_vendor/four.tf"]),
+        (["a/**"], [], ["a", "a/b"]),
+    ],
+)
+def test_find_paths(tree, path_patterns, exclude_name_patterns, expected):
+    paths = util.find_paths(
+        path_patterns=path_patterns,
+        exclude_name_patterns=exclude_name_patterns,
+        cwd=tree,
+    )
+    assert sorted(names(paths, tree)) == expected
+
+
+def test_find_paths_pattern_order(tree):
+    paths = names(util.find_paths(path_patterns=["a/*.tf", "*.tf"], cwd=tree), tree)
+    assert paths[0] == "a/one.tf"
+    assert sorted(paths[1:]) == [".hidden.tf", "main.tf"]
+
+
+def test_find_paths_relative(tree):
+    paths = util.find_paths(path_patterns=["../a/b/*.txt"], cwd=tree / "a")
+    assert list(paths) == [tree / "a" / ".." / "a" / "b" / "two.txt"]
+
+
+def test_single_flight():
+
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow(value):
+        calls.append(value)
+        started.set()
+        release.wait(5)
+        return value * 2
+
+    flight = util.SingleFlight()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.do("key", slow, 1)))
+        for _ in range(5)
+    ]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    # Only one call was made, and every thread got its result.
+    assert calls == [1]
+    assert results == [2, 2, 2, 2, 2]
+
+    # Results are not kept once the call has finished.
+    assert flight.do("key", slow, 2) == 4
+    assert calls == [1, 2]
+
+
+def test_clear_run_caches(monkeypatch):
+
+    flight = util.SingleFlight(cache_results=True)
+    assert flight.do("key", lambda: 1) == 1
+    assert flight.do("key", lambda: 2) == 1
+
+    cleared = []
+    monkeypatch.setattr(util, "_run_cache_clear_functions", [])
+    util.register_run_cache(lambda: cleared.append(True))
+    util.clear_run_caches()
+    assert flight.do("key", lambda: 2) == 2
+    assert cleared == [True]
+
+
+def test_cache_file(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("TF_WORKSPACE", raising=False)
+
+    source = tmp_path / "source.py"
+    source.write_text("")
+    assert util.get_source_file(test_cache_file) == __file__
+    assert util.get_source_file(sorted) == "builtins"
+
+    cache_file = util.CacheFile(tmp_path / "cache.json", str(source), 60)
+    assert cache_file.load() is None
+    cache_file.save({"value": 1})
+    assert cache_file.load()["value"] == 1
+
+    # Changes to the source file make the cache invalid.
+    os.utime(source, (0, 0))
+    assert util.CacheFile(tmp_path / "cache.json", str(source), 60).load() is None
+
+    assert util.is_json_stable({"a": [1, "b"]})
+    assert not util.is_json_stable({1: "a"})
+    assert not util.is_json_stable(object())
@@ -0,0 +1,155 @@
+import json
+
+from pretf import util, workflow
+from pretf.command import TerraformCommand
+
+
+def test_link_modules(tmp_path, monkeypatch):
+
+    # Fake "terraform get" by creating the module directories
+    # and manifest that Terraform would have created.
+    calls = []
+
+    def get(self, *args):
+        calls.append(self.cwd)
+        config = json.loads((self.cwd / "main.tf.json").read_text())
+        modules = config[0]["module"]
+        manifest = {"Modules": []}
+        for key, body in modules.items():
+            module_dir = self.cwd / ".terraform" / "modules" / key
+            module_dir.mkdir(parents=True)
+            (module_dir / f"{key}.tf").write_text("")
+            manifest["Modules"].append({"Key": key, "Dir": str(module_dir)})
+        (self.cwd / ".terraform" / "modules" / "modules.json").write_text(
+            json.dumps(manifest)
+        )
+        return ""
+
+    monkeypatch.setattr(TerraformCommand, "get", get)
+
+    local_module = tmp_path / "local"
+    local_module.mkdir()
+    (local_module / "local.tf").write_text("")
+
+    cwd = tmp_path / "cwd"
+    cwd.mkdir()
+
+    created = workflow.link_modules(
+        [
+            "claranet/vpc-modules/aws",
+            {"source": "claranet/lambda/aws", "version": "1.0.0"},
+            str(local_module),
+        ],
+        cwd=cwd,
+        verbose=False,
+    )
+
+    # Terraform only ran once for both remote modules.
+    assert len(calls) == 1
+
+    assert sorted(path.name for path in created) == [
+        "local.tf",
+        "mirror-module-0.tf",
+        "mirror-module-1.tf",
+    ]
+    for path in created:
+        assert path.is_symlink()
+
+
+def test_sync_links(tmp_path):
+
+    src = tmp_path / "src"
+    src.mkdir()
+    for name in ("a.tf", "b.tf", "c.tf"):
+        (src / name).write_text("")
+
+    cwd = tmp_path / "cwd"
+    cwd.mkdir()
+    (cwd / "local.tf").write_text("")
+
+    # The first run creates all symlinks.
+    changes = workflow.sync_links("../src/*.tf", cwd=cwd, verbose=False)
+    assert sorted(path.name for path in changes.created) == ["a.tf", "b.tf", "c.tf"]
+    assert changes.deleted == []
+    assert changes.unchanged == []
+
+    # Remove a source file and point another symlink somewhere else.
+    (src / "c.tf").unlink()
+    (cwd / "b.tf").unlink()
+    (cwd / "b.tf").symlink_to("local.tf")
+    a_inode = (cwd / "a.tf").lstat().st_ino
+
+    # The second run only changes what is different.
+    util.directory_index.clear()
+    changes = workflow.sync_links("../src/*.tf", cwd=cwd, verbose=False)
+    assert [path.name for path in changes.created] == ["b.tf"]
+    assert sorted(path.name for path in changes.deleted) == ["b.tf", "c.tf"]
+    assert [path.name for path in changes.unchanged] == ["a.tf"]
+    assert (cwd / "a.tf").lstat().st_ino == a_inode
+    assert (cwd / "b.tf").resolve() == (src / "b.tf").resolve()
+    assert not (cwd / "c.tf").is_symlink()
+    assert (cwd / "local.tf").exists()
+
+
+def test_directory_index(tmp_path):
+
+    (tmp_path / "a.tf.json").write_text("[]")
+    (tmp_path / "b.tf.py").write_text("")
+
+    # The directory is listed once and then updated by workflow steps.
+    assert sorted(path.name for path in util.find_paths(["*"], cwd=tmp_path)) == [
+        "a.tf.json",
+        "b.tf.py",
+    ]
+    deleted = workflow.delete_files(cwd=tmp_path, verbose=False)
+    assert [path.name for path in deleted] == ["a.tf.json"]
+    assert util.directory_index.lookup(tmp_path / "a.tf.json") is None
+
+    # Changes made outside of the index are seen too.
+    (tmp_path / "c.tf.json").write_text("[]")
+    assert util.directory_index.lookup(tmp_path / "c.tf.json")
+    (tmp_path / "b.tf.py").unlink()
+    assert sorted(path.name for path in util.directory_index.iterdir(tmp_path)) == [
+        "c.tf.json"
+    ]
+
+
+def test_mirror_files_directory_index(tmp_path, monkeypatch):
+
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "main.tf.py").write_text(
+        "from pretf.api import block\n\n"
+        "def pretf_blocks():\n"
+        '    yield block("locals", {"a": 1})\n'
+    )
+    stack = tmp_path / "stack"
+    stack.mkdir()
+    monkeypatch.chdir(stack)
+
+    util.directory_index.lookup(stack / "main.tf.py")
+    workflow.mirror_files("../src/*", verbose=False)
+    created = workflow.create_files(verbose=False)
+    assert [path.name for path in created] == ["main.tf.json"]
+
+
+def test_create_files_coalesce(tmp_path):
+
+    (tmp_path / "main.tf.py").write_text("""from pretf.api import block
+
+
+def pretf_blocks():
+    for index in range(3):
+        yield block("resource", "null_resource", f"r{index}", {})
+""")
+
+    created = workflow.create_files(tmp_path, verbose=False)
+    assert json.loads(created[0].read_text()) == [
+        {"resource": {"null_resource": {f"r{index}": {}}}} for index in range(3)
+    ]
+
+    util.directory_index.clear()
+    created = workflow.create_files(tmp_path, verbose=False, coalesce=True)
+    assert json.loads(created[0].read_text()) == [
+        {"resource": {"null_resource": {"r0": {}, "r1": {}, "r2": {}}}}
+    ]